@@ -2,15 +2,26 @@ import threading
 import signal
 import sys
 
+import tub_api
 from tub_api import start_api_server, handle_exit_api
-from tub_control import start_tub_system, handle_exit_tub, send_discord_hook
+
+# run the control loop in its own process so API and WebSocket load can't delay the safety checks
+SEPARATE_CONTROL_PROCESS = False
+
+control_process = None
 
 
 def combined_exit_handler(signal_received, frame):
     message = 'exit handler received the following signal: ' + str(signal_received)
-    send_discord_hook(message)
-    handle_exit_api(signal_received, frame)
-    handle_exit_tub(signal_received, frame)
+    if control_process:
+        # the control process does its own hardware cleanup and notification on the way out
+        handle_exit_api(signal_received, frame)
+        control_process.stop()
+    else:
+        from tub_control import handle_exit_tub, send_discord_hook
+        send_discord_hook(message)
+        handle_exit_api(signal_received, frame)
+        handle_exit_tub(signal_received, frame)
     sys.exit(0)
 
 
@@ -18,5 +29,11 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, combined_exit_handler)
     signal.signal(signal.SIGTERM, combined_exit_handler)
 
-    threading.Thread(target=start_tub_system, daemon=True).start()
+    if SEPARATE_CONTROL_PROCESS:
+        from tub_ipc import ControlProcess
+        control_process = ControlProcess()
+        tub_api.control = control_process.start()
+    else:
+        from tub_control import start_tub_system
+        threading.Thread(target=start_tub_system, daemon=True).start()
     start_api_server()
@@ -0,0 +1,36 @@
+import pytest
+
+import tub_control
+from tub_hal import VirtualClock
+from tub_sim import SimBackend
+
+
+@pytest.fixture(scope='session')
+def control():
+    # tub_control builds one system per process, every test that needs it shares this one on virtual time
+    clock = VirtualClock()
+    sim = SimBackend(clock)
+    system = tub_control.init_system(sim, clock)
+    return system, sim, clock
+
+
+@pytest.fixture
+def system(control):
+    system, _, _ = control
+    system.commands.drain()
+    system.commands_in_flight = []
+    system.command_window = None
+    for device in system.devices.values():
+        device.cleanup()
+    tub_control.timers.run_due()
+    tub_control.outputs.commit()
+    return system
+
+
+@pytest.fixture
+def api(control):
+    # the API on the shared system, nothing ticks the control loop unless the test does
+    from fastapi.testclient import TestClient
+    import tub_api
+    with TestClient(tub_api.app) as client:
+        yield client
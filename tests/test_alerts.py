@@ -0,0 +1,111 @@
+import pytest
+
+from tub_alerts import ALERT_RULES, AlertEngine, load_rules
+
+
+@pytest.fixture
+def inputs():
+    return {'temperature.water': 100.0, 'device.heater': False, 'flow': True}
+
+
+def engine_for(rules, inputs, sent):
+    def resolve(name):
+        if name not in inputs:
+            raise KeyError(name)
+        return lambda: inputs[name]
+
+    return AlertEngine(rules, resolve, lambda message, key: sent.append(key))
+
+
+def test_alert_waits_out_its_duration_without_new_input(inputs):
+    sent = []
+    engine = engine_for([{'name': 'cold', 'if': ['temperature.water', '<', 95], 'for': 60}], inputs, sent)
+    engine.evaluate(0)
+    inputs['temperature.water'] = 90.0
+    engine.evaluate(10)
+    engine.evaluate(69)
+    assert sent == [] and engine.waiting
+    engine.evaluate(70)  # nothing changed, the deadline alone re-checks the rule
+    assert sent == ['alert:cold'] and engine.active() == ['cold']
+    assert not engine.waiting
+
+
+def test_condition_that_lets_go_restarts_the_duration(inputs):
+    sent = []
+    engine = engine_for([{'name': 'cold', 'if': ['temperature.water', '<', 95], 'for': 60}], inputs, sent)
+    inputs['temperature.water'] = 90.0
+    engine.evaluate(0)
+    inputs['temperature.water'] = 96.0
+    engine.evaluate(30)
+    inputs['temperature.water'] = 90.0
+    engine.evaluate(40)
+    engine.evaluate(60)
+    assert sent == []
+    engine.evaluate(100)
+    assert sent == ['alert:cold']
+
+
+def test_hysteresis_holds_the_alert_until_past_the_band(inputs):
+    sent = []
+    engine = engine_for([{'name': 'cold', 'if': ['temperature.water', '<', 95], 'hysteresis': 2}], inputs, sent)
+    inputs['temperature.water'] = 94.0
+    engine.evaluate(0)
+    inputs['temperature.water'] = 96.0
+    engine.evaluate(1)
+    assert engine.active() == ['cold']
+    inputs['temperature.water'] = None  # an unknown reading neither holds nor clears
+    engine.evaluate(2)
+    assert engine.active() == ['cold']
+    inputs['temperature.water'] = 97.0
+    engine.evaluate(3)
+    assert engine.active() == [] and sent == ['alert:cold', 'alert:cold:cleared']
+
+
+def test_guard_gates_and_clears(inputs):
+    sent = []
+    rule = {'name': 'cold_heating', 'if': ['temperature.water', '<', 95], 'while': [['device.heater', '==', True]],
+            'message': 'water {value}F'}
+    engine = engine_for([rule], inputs, sent)
+    inputs['temperature.water'] = 90.0
+    engine.evaluate(0)
+    assert sent == []
+    inputs['device.heater'] = True
+    engine.evaluate(1)
+    assert sent == ['alert:cold_heating']
+    inputs['device.heater'] = False
+    engine.evaluate(2)
+    assert sent[-1] == 'alert:cold_heating:cleared'
+
+
+def test_only_rules_on_changed_inputs_are_checked(inputs):
+    engine = engine_for([{'name': 'cold', 'if': ['temperature.water', '<', 95]},
+                         {'name': 'dry', 'if': ['flow', '==', False]}], inputs, [])
+    engine.evaluate(0)
+    checked = []
+    for rule in engine.rules:
+        rule.check = lambda values, now, rule=rule, check=rule.check: (checked.append(rule.name), check(values, now))[1]
+    inputs['flow'] = False
+    engine.evaluate(1)
+    assert checked == ['dry'] and engine.active() == ['dry']
+
+
+def test_bad_rules_are_skipped(inputs):
+    engine = engine_for([{'name': 'odd', 'if': ['temperature.water', '~', 95]},
+                         {'name': 'nothing', 'if': ['temperature.moon', '<', 95]},
+                         {'if': ['flow', '==', False]},
+                         {'name': 'dry', 'if': ['flow', '==', False]}], inputs, [])
+    assert [rule.name for rule in engine.rules] == ['dry']
+    assert list(engine.getters) == ['flow']
+
+
+def test_rules_file_falls_back_to_the_built_in_ones(tmp_path):
+    assert load_rules(str(tmp_path / 'missing.json')) is ALERT_RULES
+    broken = tmp_path / 'alerts.json'
+    broken.write_text('[{')
+    assert load_rules(str(broken)) is ALERT_RULES
+    broken.write_text('[{"name": "dry", "if": ["flow", "==", false]}]')
+    assert load_rules(str(broken)) == [{'name': 'dry', 'if': ['flow', '==', False]}]
+
+
+def test_built_in_rules_all_resolve(system):
+    assert len(system.alerts.rules) == len(ALERT_RULES)
@@ -0,0 +1,58 @@
+import gzip
+
+import tub_assets
+from tub_assets import StaticAsset, accepted_encodings, load_asset
+
+
+def test_accept_encoding_parsing():
+    assert accepted_encodings('gzip, br;q=0.5, identity;q=0') == {'gzip': 1.0, 'br': 0.5, 'identity': 0.0}
+    assert accepted_encodings('') == {}
+    assert accepted_encodings('gzip;q=bad') == {'gzip': 0.0}
+
+
+def test_asset_is_held_compressed_and_named_by_its_content(tmp_path):
+    path = tmp_path / 'page.html'
+    path.write_text('<html>hot tub</html>' * 50)
+    asset = StaticAsset(str(path))
+    assert asset.hashed_name.startswith('page.') and asset.hashed_name.endswith('.html')
+    assert gzip.decompress(asset.variants['gzip']) == path.read_bytes()
+    assert len(asset.variants['gzip']) < len(asset.variants['identity'])
+    assert asset.select('gzip') == 'gzip'
+    assert asset.select('gzip;q=0') == 'identity'
+    assert asset.select('') == 'identity'
+
+
+def test_a_changed_file_gets_a_new_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(tub_assets, 'ASSET_CHECK_INTERVAL', 0)
+    path = tmp_path / 'page.html'
+    path.write_text('first')
+    asset = StaticAsset(str(path))
+    name = asset.hashed_name
+    path.write_text('second version')
+    asset.refresh()
+    assert asset.hashed_name != name and asset.variants['identity'] == b'second version'
+
+
+def test_missing_asset_is_not_fatal(tmp_path):
+    assert load_asset(str(tmp_path / 'missing.html')) is None
+
+
+def test_pages_redirect_to_their_hashed_copy(api):
+    root = api.get('/', follow_redirects=False)
+    assert root.status_code == 302 and root.headers['cache-control'] == tub_assets.REVALIDATE_CACHE_CONTROL
+    location = root.headers['location']
+    page = api.get(location, headers={'Accept-Encoding': 'gzip'})
+    assert page.status_code == 200 and page.headers['content-encoding'] == 'gzip'
+    assert page.headers['cache-control'] == tub_assets.IMMUTABLE_CACHE_CONTROL
+    with open('index.html', 'rb') as file:
+        assert page.content == file.read()
+    cached = api.get(location, headers={'Accept-Encoding': 'gzip', 'If-None-Match': page.headers['etag']})
+    assert cached.status_code == 304
+
+
+def test_an_old_hash_redirects_to_the_current_one(api):
+    location = api.get('/admin', follow_redirects=False).headers['location']
+    stale = api.get('/assets/admin.000000000000.html', follow_redirects=False)
+    assert stale.status_code == 302 and stale.headers['location'] == location
+    assert api.get('/assets/nothing.html').status_code == 404
+
@@ -0,0 +1,38 @@
+import tub_control
+
+
+def test_batch_rejects_unknown_states_before_queueing(api, system):
+    queued = len(system.commands.pending)
+    response = api.post('/batch?wait=false', json={'changes': [{'device': 'light', 'state': 'bright'},
+                                                                {'device': 'pump1', 'state': 'fast'},
+                                                                {'device': 'blower', 'state': 'on'}]})
+    body = response.json()
+    assert body['status'] == 'error'
+    assert 'Invalid state for light.' in body['message'] and 'Invalid state for pump1.' in body['message']
+    assert len(system.commands.pending) == queued
+
+
+def test_batch_rejects_unknown_devices_and_presets(api, system):
+    assert api.post('/batch?wait=false', json={'changes': [{'device': 'sauna', 'state': 'on'}]}).json() == {
+        'status': 'error', 'message': 'Unknown device sauna.'}
+    assert api.post('/batch?wait=false', json={'preset': 'party'}).json()['message'] == 'Unknown preset party.'
+    assert api.post('/batch?wait=false', json={}).json()['message'] == 'Nothing to apply.'
+
+
+def test_preset_with_overrides_lands_in_one_pass(api, system, control):
+    _, _, clock = control
+    setpoint = system.set_temperature
+    try:
+        response = api.post('/batch?wait=false', json={'preset': 'soak',
+                                                       'changes': [{'device': 'blower', 'state': 'off'}]}).json()
+        assert response['status'] == 'success'
+        assert {command['device']: command['value'] for command in response['commands']} == {
+            'pump1': 'high', 'blower': False, 'light': True, 'setpoint': 102.0}
+        clock.advance(tub_control.COMMAND_WINDOW)
+        tub_control.timers.run_due()
+        system.process_commands()
+        assert system.light.get_state() is True and system.blower.get_state() is False
+        assert system.set_temperature == 102.0
+        assert not system.commands.pending
+    finally:
+        system.change_setpoint(setpoint)
@@ -0,0 +1,116 @@
+import tub_control
+from tub_commands import CommandQueue
+
+
+def after_window(system, clock):
+    # let the command window close and run the tick it wakes
+    clock.advance(tub_control.COMMAND_WINDOW)
+    tub_control.timers.run_due()
+    return system.process_commands()
+
+
+def test_queue_drains_in_order_and_only_once():
+    queue = CommandQueue()
+    heard = []
+    queue.listeners.append(heard.append)
+    first = queue.submit('light', 'toggle')
+    second = queue.submit('blower', 'set', True)
+    assert heard == [first, second]
+    assert queue.drain() == [first, second]
+    assert queue.drain() == []
+    assert queue.get(first.id) is first
+
+
+def test_history_keeps_unfinished_commands():
+    queue = CommandQueue(history=2)
+    commands = [queue.submit('light', 'toggle') for _ in range(3)]
+    assert queue.get(commands[0].id) is commands[0]  # still queued, so not trimmed
+    for command in commands:
+        command.complete('done')
+    queue.submit('light', 'toggle')
+    assert queue.get(commands[0].id) is None
+
+
+def test_toggles_in_one_window_coalesce(system, control):
+    light = system.light
+    switches = []
+    original = light.set_state
+    light.set_state = lambda state: (switches.append(state), original(state))
+    try:
+        commands = system.commands.submit_batch([('light', 'toggle', None)] * 3)
+        after_window(system, control[2])
+    finally:
+        del light.set_state
+    assert switches == [True]
+    assert light.get_state() is True
+    assert [command.status for command in commands] == ['done'] * 3
+
+
+def test_toggles_that_cancel_out_leave_the_relay_alone(system, control):
+    writes = []
+    bank = tub_control.outputs
+    original = bank.hardware.write_port
+    bank.hardware.write_port = lambda port, value: (writes.append(port), original(port, value))
+    try:
+        commands = system.commands.submit_batch([('blower', 'toggle', None), ('blower', 'toggle', None)])
+        after_window(system, control[2])
+        bank.commit()
+    finally:
+        del bank.hardware.write_port
+    assert system.blower.get_state() is False
+    assert writes == []
+    assert all(command.status == 'done' for command in commands)
+
+
+def test_pump_advances_fold_into_one_target(system, control):
+    commands = system.commands.submit_batch([('pump2', 'advance', None), ('pump2', 'advance', None)])
+    after_window(system, control[2])
+    assert system.pump2.get_target() == 'high'
+    assert all(command.status == 'running' for command in commands)  # the relay sequence is still stepping
+
+
+def test_last_set_wins(system, control):
+    commands = system.commands.submit_batch([('fans', 'set', True), ('fans', 'set', False), ('fans', 'set', True)])
+    after_window(system, control[2])
+    assert system.fans.get_state() is True
+    assert all(command.result == {'state': True} for command in commands)
+
+
+def test_separate_submits_within_the_window_coalesce(system, control):
+    _, sim, clock = control
+    light = []
+    original = sim.write_port
+
+    def write_port(port, value):
+        original(port, value)
+        light.append(sim.pin(0))
+    sim.write_port = write_port
+    try:
+        first = system.commands.submit('light', 'toggle')
+        clock.advance(0.1)
+        system.tick({'command'})
+        assert first.status == 'queued'  # held back, the window is still open
+        second = system.commands.submit('light', 'toggle')
+        clock.advance(tub_control.COMMAND_WINDOW)
+        system.tick(tub_control.timers.run_due())
+    finally:
+        del sim.write_port
+    assert (first.status, second.status) == ('done', 'done')
+    assert system.light.get_state() is False
+    assert True not in light
+
+
+def test_command_window_wakes_the_loop(system, control):
+    _, _, clock = control
+    system.commands.submit('fans', 'set', True)
+    assert tub_control.timers.next_deadline() <= clock.time() + tub_control.COMMAND_WINDOW
+    assert after_window(system, clock)
+    assert system.fans.get_state() is True
+
+
+def test_batches_are_trimmed_to_the_history_too():
+    queue = CommandQueue(history=4)
+    for _ in range(5):
+        for command in queue.submit_batch([('light', 'toggle', None), ('fans', 'toggle', None)]):
+            command.complete('done')
+    assert len(queue.commands) == 4
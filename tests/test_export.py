@@ -0,0 +1,64 @@
+import csv
+import io
+import json
+
+import pytest
+
+import tub_api
+import tub_export
+import tub_history
+from tub_export import export
+from tub_history import HistoryReader, HistoryStore
+
+
+@pytest.fixture
+def reader(tmp_path):
+    path = str(tmp_path / 'history.db')
+    store = HistoryStore(path)
+    store.open()
+    for second in range(10):
+        store.record(1000.0 + second, {'water': 100.0 + second, 'ambient': 50.0 - second})
+    store.flush()
+    store.stop()
+    return HistoryReader(path, clock=lambda: 2000.0)
+
+
+def test_rows_merge_channels_in_time_order_across_pages(reader, monkeypatch):
+    monkeypatch.setattr(tub_history, 'EXPORT_PAGE', 3)
+    rows = list(reader.rows())
+    assert len(rows) == 20
+    assert [row[0] for row in rows] == sorted(row[0] for row in rows)
+    assert rows[:2] == [(1000.0, 'ambient', 50.0), (1000.0, 'water', 100.0)]
+    assert [row[1] for row in reader.rows(['water', 'sauna'])] == ['water'] * 10
+
+
+def test_rows_from_a_rollup_tier(reader):
+    assert list(reader.rows(['water'], tier=60)) == [(960, 'water', 10, 100.0, 109.0, 104.5)]
+
+
+def test_no_database_exports_nothing(tmp_path):
+    assert list(HistoryReader(str(tmp_path / 'missing.db')).rows()) == []
+
+
+def test_rows_are_chunked(monkeypatch):
+    monkeypatch.setattr(tub_export, 'EXPORT_PAUSE', 0)
+    assert list(tub_export.chunked(iter(range(10)), 4)) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert list(tub_export.chunked(iter([]), 4)) == []
+
+
+def test_csv_and_ndjson_formats(reader):
+    table = list(csv.reader(io.StringIO(b''.join(export(reader.rows(['water']), 'csv')).decode())))
+    assert table[0] == ['timestamp', 'channel', 'value'] and table[1] == ['1000.0', 'water', '100.0']
+    assert len(table) == 11
+    lines = b''.join(export(reader.rows(['water'], tier=60), 'ndjson', 60)).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'timestamp': 960, 'channel': 'water', 'count': 10, 'min': 100.0, 'max': 109.0, 'avg': 104.5}]
+
+
+def test_export_endpoint(api, reader, monkeypatch):
+    monkeypatch.setattr(tub_api, 'history', reader)
+    assert api.get('/export?format=xlsx').json()['status'] == 'error'
+    assert api.get('/export?tier=5').json()['message'] == 'Invalid tier. Choose one of 0, 60, 600, 3600.'
+    response = api.get('/export?channels=ambient')
+    assert response.headers['content-disposition'] == 'attachment; filename="hotcon-history.csv"'
+    assert response.text.splitlines()[1:3] == ['1000.0,ambient,50.0', '1001.0,ambient,49.0']
@@ -0,0 +1,29 @@
+import tub_control
+
+
+def outputs_on(sim):
+    return [number for number in tub_control.outputs.switch_counters if sim.pin(number)]
+
+
+def test_outputs_stay_off_after_a_sensor_fault(system, control, monkeypatch, tmp_path):
+    _, sim, clock = control
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tub_control, 'fault', None)
+    system.change_mode('automatic')
+    system.change_setpoint(104)
+    system.tick({'periodic'})
+    assert system.circpump.get_state()  # cold water, the rules start heating
+
+    system.sensor_acquisition.failures['water'] = "No such device"
+    system.tick({'sensors'})
+    assert tub_control.fault == "Error reading temperature sensor water: No such device"
+    assert outputs_on(sim) == []
+
+    command = system.commands.submit('light', 'set', True)
+    for _ in range(180):
+        clock.advance(1)
+        system.tick({'periodic'})
+        assert outputs_on(sim) == []
+    assert not system.circpump.get_state() and not system.heater.get_state()
+    assert command.status == 'rejected'
+    assert system.get_state()['fault'] == tub_control.fault
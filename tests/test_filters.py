@@ -0,0 +1,92 @@
+from tub_filters import DS18B20_POWER_ON_C, SENSOR_FAULT_LIMIT, SENSOR_REJECT_LIMIT, SensorFilter
+
+
+def feed(sensor_filter, readings, start=0.0, interval=1.0):
+    return [sensor_filter.update(temp_c, start + i * interval) for i, temp_c in enumerate(readings)]
+
+
+def test_steady_readings_settle_on_the_value():
+    sensor_filter = SensorFilter()
+    assert all(feed(sensor_filter, [38.5] * 10))
+    assert sensor_filter.filtered() == 38.5
+    assert abs(sensor_filter.rate) < 1e-9
+
+
+def test_power_on_and_out_of_range_readings_are_rejected():
+    sensor_filter = SensorFilter()
+    assert not sensor_filter.update(DS18B20_POWER_ON_C, 0.0)
+    assert not sensor_filter.update(127.0, 1.0)
+    assert sensor_filter.filtered() is None
+    assert sensor_filter.update(38.0, 2.0)
+    assert sensor_filter.filtered() == 38.0
+
+
+def test_single_spike_is_rejected_and_leaves_the_value():
+    sensor_filter = SensorFilter()
+    feed(sensor_filter, [38.0] * 5)
+    assert not sensor_filter.update(60.0, 5.0)
+    assert sensor_filter.filtered() == 38.0
+    assert sensor_filter.update(38.0, 6.0)
+    assert sensor_filter.total_rejected == 1
+
+
+def test_median_drops_a_small_outlier():
+    sensor_filter = SensorFilter()
+    feed(sensor_filter, [38.0, 38.0, 38.0])
+    sensor_filter.update(39.0, 3.0)  # within the rate limit, but alone in the window
+    assert sensor_filter.filtered() == 38.0
+
+
+def test_sustained_step_is_believed_with_its_rate():
+    sensor_filter = SensorFilter()
+    feed(sensor_filter, [40.0] * 5)
+    results = feed(sensor_filter, [50.0] * SENSOR_REJECT_LIMIT, start=5.0)
+    assert results == [False] * (SENSOR_REJECT_LIMIT - 1) + [True]
+    assert sensor_filter.filtered() == 50.0
+    # taken across the whole rejected run, from the last value before it
+    assert abs(sensor_filter.rate - 10.0 / SENSOR_REJECT_LIMIT) < 1e-9
+
+
+def test_safety_follows_a_rise_the_rate_limit_holds_back():
+    sensor_filter = SensorFilter()
+    feed(sensor_filter, [60.0] * 5)
+    assert not sensor_filter.update(66.0, 5.0)
+    assert sensor_filter.filtered() == 60.0
+    assert sensor_filter.safety() == 66.0
+
+
+def test_safety_ignores_readings_the_sensor_cannot_take():
+    sensor_filter = SensorFilter()
+    feed(sensor_filter, [40.0] * 5)
+    sensor_filter.update(DS18B20_POWER_ON_C, 5.0)
+    assert sensor_filter.safety() == 40.0
+    sensor_filter.update(-80.0, 6.0)
+    assert sensor_filter.safety() == 40.0
+
+
+def test_impossible_readings_are_never_believed():
+    for reading in [-127.0, 4095.94, DS18B20_POWER_ON_C]:
+        sensor_filter = SensorFilter()
+        feed(sensor_filter, [38.0] * 5)
+        results = feed(sensor_filter, [reading] * (SENSOR_FAULT_LIMIT * 3), start=5.0)
+        assert not any(results)
+        assert sensor_filter.fault
+        assert sensor_filter.filtered() is None
+        assert sensor_filter.safety() is None
+
+
+def test_a_good_reading_clears_a_sensor_fault():
+    sensor_filter = SensorFilter()
+    feed(sensor_filter, [-127.0] * SENSOR_FAULT_LIMIT)
+    assert sensor_filter.fault
+    assert sensor_filter.update(38.0, 10.0)
+    assert not sensor_filter.fault
+    assert sensor_filter.filtered() == 38.0
+
+
+def test_rejected_first_reading_leaves_the_value_unknown():
+    sensor_filter = SensorFilter()
+    assert not sensor_filter.update(DS18B20_POWER_ON_C, 0.0)
+    assert sensor_filter.filtered() is None
+    assert sensor_filter.safety() is None
+    assert not sensor_filter.fault
@@ -0,0 +1,78 @@
+import os
+import time
+
+import tub_history
+from tub_history import HistoryStore
+
+
+def test_a_store_that_never_started_writes_nothing(tmp_path):
+    path = tmp_path / 'history.db'
+    store = HistoryStore(str(path))
+    store.record(1000.0, {'water': 100.0})
+    assert store.flush() == 0
+    store.stop()
+    assert not os.path.exists(path)
+
+
+def test_flushes_merge_into_the_rollup_buckets(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    store.open()
+    store.record(1000020.0, {'water': 100.0, 'ambient': None})
+    store.record(1000050.0, {'water': 102.0})
+    assert store.flush() == 2
+    store.record(1000070.0, {'water': 99.0})
+    store.record(1000079.5, {'water': 101.0})
+    assert store.flush() == 2
+    assert store.db.execute("SELECT name FROM channels").fetchall() == [('water',)]  # None is never recorded
+    assert store.db.execute("SELECT count(*) FROM samples").fetchone()[0] == 4
+    # one minute bucket written by two flushes
+    assert store.db.execute("SELECT bucket, count, min, max, sum FROM rollup_60").fetchall() == [
+        (1000020, 4, 99.0, 102.0, 402.0)]
+    assert store.db.execute("SELECT bucket, count FROM rollup_600").fetchall() == [(999600, 4)]
+    store.stop()
+
+
+def test_ring_keeps_the_latest_samples(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'), ring_size=3)
+    for second in range(5):
+        store.record(float(second), {'water': 100.0 + second})
+    assert [timestamp for timestamp, _ in store.recent()] == [2.0, 3.0, 4.0]
+    assert [timestamp for timestamp, _ in store.recent(since=3)] == [3.0, 4.0]
+
+
+def test_flush_hooks_run_in_the_same_transaction(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    store.open()
+    seen = []
+    store.flush_hooks.append(lambda db: seen.append(db.in_transaction))
+    store.record(1000.0, {'water': 100.0})
+    store.flush()
+    assert seen == [True]
+    store.stop()
+
+
+def test_prune_drops_each_tier_after_its_retention(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    store.open()
+    now = 400 * 24 * 60 * 60.0
+    for age in (2 * 24 * 60 * 60, 60 * 24 * 60 * 60, 60):
+        store.record(now - age, {'water': 100.0})
+    store.flush()
+    store.prune(now)
+    assert store.db.execute("SELECT count(*) FROM samples").fetchone()[0] == 1
+    assert store.db.execute("SELECT count(*) FROM rollup_60").fetchone()[0] == 2
+    assert store.db.execute("SELECT count(*) FROM rollup_600").fetchone()[0] == 3
+    assert store.last_prune == now
+    store.stop()
+
+
+def test_writer_thread_flushes_on_its_interval(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'), flush_interval=0.01)
+    store.start()
+    store.record(time.time(), {'water': 100.0})  # the writer prunes by the real clock
+    deadline = time.monotonic() + 2
+    while store.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not store.pending
+    store.stop()
+    assert tub_history.connect(store.path).execute("SELECT count(*) FROM samples").fetchone()[0] == 1
@@ -0,0 +1,74 @@
+import pytest
+
+import tub_api
+from tub_history import HistoryReader, HistoryStore, lttb, select_tier
+
+START = 1000020.0  # on a minute boundary
+
+
+@pytest.fixture
+def reader(tmp_path):
+    # two minutes of one sample a second, value equal to the second
+    path = str(tmp_path / 'history.db')
+    store = HistoryStore(path)
+    store.open()
+    for second in range(120):
+        store.record(START + second, {'water': float(second)})
+    store.flush()
+    store.stop()
+    return HistoryReader(path, clock=lambda: START + 120)
+
+
+def test_lttb_keeps_the_ends_and_the_spike():
+    times = list(range(100))
+    values = [0.0] * 100
+    values[37] = 50.0
+    sampled_times, sampled_values = lttb(times, values, 10)
+    assert len(sampled_times) == len(sampled_values) == 10
+    assert sampled_times[0] == 0 and sampled_times[-1] == 99
+    assert 50.0 in sampled_values
+    assert lttb(times[:5], values[:5], 10) == (times[:5], values[:5])
+
+
+def test_tier_follows_the_width_and_the_retention():
+    assert select_tier(1, 60) == 0
+    assert select_tier(120, 60) == 60
+    assert select_tier(700, 60) == 600
+    assert select_tier(1, 2 * 24 * 60 * 60) == 60  # the raw samples are gone by then
+    assert select_tier(1, 10 * 365 * 24 * 60 * 60) == 3600
+
+
+def test_minmax_buckets(reader):
+    result = reader.query(['water'], START, START + 120, points=2)
+    assert result['width'] == 60 and result['tier'] == 60
+    assert result['series']['water'] == {'t': [START, START + 60], 'min': [0.0, 60.0], 'max': [59.0, 119.0],
+                                         'avg': [29.5, 89.5]}
+
+
+def test_raw_tier_for_a_narrow_range(reader):
+    result = reader.query(['water'], START, START + 10, points=10)
+    assert result['tier'] == 0
+    assert result['series']['water']['avg'] == [float(second) for second in range(10)]
+
+
+def test_unflushed_samples_are_merged_once(reader):
+    recent = [(START + 119, {'water': 119.0}), (START + 120, {'water': 500.0})]  # the first is already on disk
+    result = reader.query(['water'], START + 60, START + 180, points=2, recent=recent)
+    series = result['series']['water']
+    assert series['max'] == [119.0, 500.0]
+    assert series['min'] == [60.0, 500.0]
+    assert series['avg'][0] == 89.5  # 119 counted once
+
+
+def test_lttb_method(reader):
+    result = reader.query(['water'], START, START + 120, points=5, method='lttb')
+    assert len(result['series']['water']['t']) == 5
+    assert set(result['series']['water']) == {'t', 'value'}
+
+
+def test_history_endpoint(api, reader, monkeypatch):
+    monkeypatch.setattr(tub_api, 'history', reader)
+    assert api.get('/history?method=cubic').json()['status'] == 'error'
+    assert api.get('/history?channels=sauna').json() == {'status': 'error', 'message': 'Unknown channels: sauna.'}
+    result = api.get(f'/history?channels=water&start={START}&end={START + 120}&points=2').json()
+    assert result['series']['water']['max'] == [59.0, 119.0]
@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+from multiprocessing import Pipe, shared_memory
+
+import pytest
+
+import tub_ipc
+from tub_ipc import ControlUnavailable, RemoteControl, SharedStateBlock
+
+
+@pytest.fixture
+def block_name():
+    name = f'hotcon_test_{os.getpid()}'
+    shm = shared_memory.SharedMemory(name=name, create=True, size=4096)
+    yield name
+    shm.close()
+    shm.unlink()
+
+
+def stop(remote, other):
+    # closing the far end lets the receive thread see EOF and exit before its pipe is closed and reused
+    other.close()
+    remote.thread.join(1)
+    remote.conn.close()
+    remote.block.close()
+
+
+def test_reader_sees_each_complete_write(block_name):
+    writer = SharedStateBlock(block_name, writable=True)
+    reader = SharedStateBlock(block_name)
+    try:
+        assert reader.read() == (0, b'')
+        writer.write(b'first')
+        assert reader.read() == (2, b'first')
+        writer.write(b'2nd')
+        assert reader.seqno() == 4
+        assert reader.read() == (4, b'2nd')  # the length shrinks with the payload
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_reader_gives_up_on_a_write_that_never_finishes(block_name, monkeypatch):
+    monkeypatch.setattr(tub_ipc, 'SEQLOCK_RETRIES', 3)
+    monkeypatch.setattr(tub_ipc, 'SEQLOCK_BACKOFF', 0)
+    writer = SharedStateBlock(block_name, writable=True)
+    reader = SharedStateBlock(block_name)
+    try:
+        writer.write(b'done')
+        tub_ipc.SEQNO.pack_into(writer.map, 0, writer.seq + 1)  # a writer stopped mid update
+        assert reader.read() is None
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_oversized_payload_is_dropped(block_name):
+    writer = SharedStateBlock(block_name, writable=True)
+    try:
+        writer.write(b'kept')
+        writer.write(b'x' * 5000)
+        assert writer.read() == (2, b'kept')
+    finally:
+        writer.close()
+
+
+def test_remote_control_waits_for_the_first_publish(block_name):
+    conn, other = Pipe()
+    writer = SharedStateBlock(block_name, writable=True)
+    remote = RemoteControl(conn, block_name)
+    try:
+        with pytest.raises(ControlUnavailable):
+            remote.get_state()
+        state = {'devices': {'light': {'state': False}}, 'main_pumps': {'circ_pump': {}}}
+        writer.write(json.dumps({'state': state, 'timers': [{'name': 'circ run-on'}]}).encode())
+        assert remote.get_state() == state
+        assert remote.device_names() == ['light', 'circ_pump']
+        assert remote.pending_timers() == [{'name': 'circ run-on'}]
+    finally:
+        stop(remote, other)
+        writer.close()
+
+
+def test_remote_commands_complete_from_the_pipe(block_name):
+    conn, other = Pipe()
+    remote = RemoteControl(conn, block_name)
+    try:
+        command = remote.submit('light', 'toggle')
+        assert other.recv() == ('command', command.id, 'light', 'toggle', None)
+        finished = threading.Event()
+        command.add_done_callback(lambda done: finished.set())
+        other.send(('done', command.id, 'done', None))
+        assert finished.wait(1)
+        assert remote.get_command(command.id).status == 'done'
+    finally:
+        stop(remote, other)
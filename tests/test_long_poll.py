@@ -0,0 +1,38 @@
+import threading
+import time
+
+import tub_api
+
+
+def test_unchanged_state_answers_304(api):
+    first = api.get('/quick_state')
+    assert first.status_code == 200
+    etag = first.headers['etag']
+    again = api.get('/quick_state', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.headers['etag'] == etag
+    assert api.get('/full_state', headers={'If-None-Match': etag}).status_code == 200  # a different document
+
+
+def test_since_waits_out_the_timeout_when_nothing_changes(api):
+    version = api.get('/full_state').headers['x-state-version']
+    started = time.monotonic()
+    response = api.get(f'/full_state?since={version}&timeout=0.2')
+    assert time.monotonic() - started >= 0.2
+    assert response.status_code == 200 and response.headers['x-state-version'] == version
+
+
+def test_since_returns_as_soon_as_the_state_changes(api):
+    tub_api.current_snapshot()
+    state = dict(tub_api.feed.current.state, set_temperature=tub_api.feed.current.state['set_temperature'] + 1)
+    version = tub_api.feed.version
+    responses = []
+    waiter = threading.Thread(target=lambda: responses.append(api.get(f'/quick_state?since={version}&timeout=10')))
+    waiter.start()
+    time.sleep(0.1)
+    started = time.monotonic()
+    tub_api.feed.publish(state)
+    waiter.join(5)
+    assert time.monotonic() - started < 1
+    response = responses[0]
+    assert response.headers['x-state-version'] == str(version + 1)
+    assert response.json()['set_temperature'] == state['set_temperature']
@@ -0,0 +1,76 @@
+import math
+import threading
+
+import pytest
+
+from tub_metrics import METRICS_CONTENT_TYPE, Registry
+
+
+def test_counter_with_labels():
+    registry = Registry()
+    family = registry.counter('relays_total', "Relay switches", ['device'])
+    family.labels('light').inc()
+    family.labels('light').inc(2)
+    family.labels('say "hi"\n').inc()
+    assert registry.render() == (
+        '# HELP relays_total Relay switches\n'
+        '# TYPE relays_total counter\n'
+        'relays_total{device="light"} 3\n'
+        'relays_total{device="say \\"hi\\"\\n"} 1\n')
+    with pytest.raises(ValueError):
+        family.labels()
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram('tick_seconds', "Tick time", buckets=(0.1, 1.0)).labels()
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+    assert registry.render().splitlines()[2:] == [
+        'tick_seconds_bucket{le="0.1"} 2',
+        'tick_seconds_bucket{le="1.0"} 3',
+        'tick_seconds_bucket{le="+Inf"} 4',
+        'tick_seconds_sum 3.65',
+        'tick_seconds_count 4',
+    ]
+
+
+def test_gauge_reads_when_scraped():
+    registry = Registry()
+    values = [1.5]
+    registry.gauge('age_seconds', "Age", lambda: values[0])
+    assert registry.render().endswith('age_seconds 1.5\n')
+    values[0] = None
+    assert registry.render().endswith('age_seconds NaN\n')
+    values.clear()  # the getter raises
+    assert registry.render().endswith('age_seconds NaN\n')
+
+
+def test_updates_from_many_threads_add_up():
+    counter = Registry().counter('events_total', "Events").labels()
+    threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(counter.shards.shards) == 4
+    assert counter.samples('events_total', '') == ['events_total 4000']
+
+
+def test_a_name_keeps_its_kind():
+    registry = Registry()
+    assert registry.counter('things', "Things") is registry.counter('things', "Things")
+    with pytest.raises(ValueError):
+        registry.histogram('things', "Things")
+    assert Registry().render() == ''
+
+
+def test_metrics_endpoint(api, system):
+    system.tick({'periodic'})
+    response = api.get('/metrics')
+    assert response.headers['content-type'] == METRICS_CONTENT_TYPE
+    lines = response.text.splitlines()
+    assert '# TYPE hotcon_tick_seconds histogram' in lines
+    assert any(line.startswith('hotcon_tick_phase_seconds_bucket{phase="alerts",') for line in lines)
+    age = next(line for line in lines if line.startswith('hotcon_last_tick_age_seconds '))
+    assert not math.isnan(float(age.split()[1]))
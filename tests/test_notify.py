@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+import tub_notify
+from tub_notify import MemorySink, NotificationError, Notifier
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(tub_notify, 'NOTIFY_BACKOFF', 0)
+
+
+class GatedSink(MemorySink):
+    # holds the first send until released, so the test can queue more behind it
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def send(self, text: str) -> None:
+        self.entered.set()
+        self.release.wait(5)
+        super().send(text)
+
+
+def test_repeats_while_queued_are_folded():
+    sink = GatedSink()
+    notifier = Notifier([sink], min_interval=0)
+    notifier.notify("first")
+    assert sink.entered.wait(5)
+    for _ in range(3):
+        notifier.notify("heater1 probe reads 151F", key='heater1_high_limit')
+    sink.release.set()
+    assert notifier.flush()
+    assert sink.messages == ["first", "heater1 probe reads 151F (x3)"]
+
+
+def test_repeats_after_sending_are_held_back_and_counted():
+    sink = MemorySink()
+    notifier = Notifier([sink], min_interval=0, dedup_window=0.3)
+    notifier.notify("no flow")
+    assert notifier.flush()
+    notifier.notify("no flow")
+    notifier.notify("no flow")
+    assert notifier.flush()
+    assert sink.messages == ["no flow"]
+    time.sleep(0.35)
+    notifier.notify("no flow")
+    assert notifier.flush()
+    assert sink.messages == ["no flow", "no flow (x3)"]
+
+
+def test_failed_send_is_retried():
+    sink = MemorySink(failures=2)
+    notifier = Notifier([sink], min_interval=0)
+    notifier.notify("water freezing")
+    assert notifier.flush()
+    assert sink.messages == ["water freezing"]
+    assert sink.failures == 0
+
+
+def test_gives_up_after_the_retries():
+    sink = MemorySink(failures=tub_notify.NOTIFY_RETRIES + 1)
+    notifier = Notifier([sink], min_interval=0)
+    notifier.notify("lost")
+    notifier.notify("next")
+    assert notifier.flush()
+    assert sink.messages == ["next"]
+
+
+def test_retry_after_from_the_sink_is_honoured(monkeypatch):
+    waits = []
+    monkeypatch.setattr(tub_notify.time, 'sleep', waits.append)
+
+    class RateLimited(MemorySink):
+        def send(self, text: str) -> None:
+            if not waits:
+                raise NotificationError("rate limited", retry_after=7)
+            super().send(text)
+
+    sink = RateLimited()
+    notifier = Notifier([sink], min_interval=0)
+    assert notifier.deliver(sink, "hello")
+    assert waits == [7]
+    assert sink.messages == ["hello"]
+
+
+def test_full_queue_drops_the_oldest():
+    sink = GatedSink()
+    notifier = Notifier([sink], queue_size=2, min_interval=0)
+    notifier.notify("sending")
+    assert sink.entered.wait(5)
+    for message in ["one", "two", "three"]:
+        notifier.notify(message)
+    sink.release.set()
+    assert notifier.flush()
+    assert notifier.dropped == 1
+    assert sink.messages == ["sending", "two", "three"]
+
+
+def test_without_sinks_nothing_starts():
+    notifier = Notifier([])
+    notifier.notify("ignored")
+    assert notifier.thread is None
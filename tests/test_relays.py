@@ -0,0 +1,88 @@
+import tub_control
+
+PUMP1_HIGH, PUMP1_LOW = 6, 4
+CIRCPUMP, HEATER = 2, 7
+
+
+def settle(clock, seconds):
+    # step virtual time and let due relay steps run and reach the expander, checking every write on the way
+    deadline = clock.time() + seconds
+    while True:
+        next_deadline = tub_control.timers.next_deadline()
+        if next_deadline is None or next_deadline > deadline:
+            break
+        clock.advance(next_deadline - clock.time())
+        tub_control.timers.run_due()
+        tub_control.outputs.commit()
+    clock.advance(deadline - clock.time())
+
+
+def watch(sim, pins):
+    # records the state of the pins after every port write
+    states = []
+    original = sim.write_port
+
+    def write_port(port, value):
+        original(port, value)
+        states.append(tuple(sim.pin(pin) for pin in pins))
+    sim.write_port = write_port
+    return states
+
+
+def test_low_to_high_breaks_before_it_makes(system, control):
+    _, sim, clock = control
+    system.pump1.set_state(True, 'low')
+    tub_control.outputs.commit()
+    states = watch(sim, (PUMP1_LOW, PUMP1_HIGH))
+    try:
+        system.pump1.set_state(True, 'high')
+        tub_control.outputs.commit()
+        assert states[-1] == (False, False)
+        settle(clock, 1)
+    finally:
+        del sim.write_port
+    assert states[-1] == (False, True)
+    assert (True, True) not in states
+    assert system.pump1.get_state() == 'high'
+
+
+def test_start_on_high_goes_through_low(system, control):
+    _, sim, clock = control
+    states = watch(sim, (PUMP1_LOW, PUMP1_HIGH))
+    try:
+        system.pump1.set_state(True, 'high')
+        tub_control.outputs.commit()
+        settle(clock, 2)
+    finally:
+        del sim.write_port
+    assert states[0] == (True, False)
+    assert (True, True) not in states
+    assert states[-1] == (False, True)
+
+
+def test_new_command_cancels_a_running_sequence(system, control):
+    _, sim, clock = control
+    system.pump1.set_state(True, 'high')
+    tub_control.outputs.commit()
+    system.pump1.set_state(False)
+    tub_control.outputs.commit()
+    settle(clock, 2)
+    assert not system.pump1.sequence.busy()
+    assert (sim.pin(PUMP1_LOW), sim.pin(PUMP1_HIGH)) == (False, False)
+
+
+def test_circ_pump_runs_on_after_the_heater_stops(system, control):
+    _, sim, clock = control
+    system.circpump.set_state(True)
+    tub_control.outputs.commit()
+    settle(clock, 61)
+    system.heater.set_state(True)
+    tub_control.outputs.commit()
+    assert sim.pin(HEATER)
+    system.circpump.set_state(False)
+    tub_control.outputs.commit()
+    assert (sim.pin(HEATER), sim.pin(CIRCPUMP)) == (False, True)
+    settle(clock, 4)
+    assert sim.pin(CIRCPUMP)
+    settle(clock, 1)
+    assert not sim.pin(CIRCPUMP)
@@ -0,0 +1,61 @@
+import pytest
+
+import tub_control
+from tub_filters import DS18B20_POWER_ON_C, SensorFilter
+
+PROBES = ['water', 'heater1', 'heater2', 'ambient', 'cabinet', 'control_box']
+
+
+@pytest.fixture
+def heating(system, control):
+    # automatic mode with cold water and the circ pump running long enough that the heater may start
+    _, _, clock = control
+    system.change_mode('automatic')
+    system.change_setpoint(104)
+    system.circpump.set_state(True)
+    clock.advance(120)
+    yield system
+    clock.advance(1)
+    for sensor in system.temp_sensors:
+        sensor.filter = SensorFilter()
+        sensor.update(37.0, 98.6, clock.time())
+
+
+def reject_first_reading(sensor, clock):
+    sensor.filter = SensorFilter()
+    clock.advance(1)
+    sensor.update(DS18B20_POWER_ON_C, 185.0, clock.time())
+    assert sensor.f() is None
+
+
+@pytest.mark.parametrize('name', PROBES)
+def test_rejected_first_reading_is_unknown_not_a_crash(heating, control, name):
+    _, _, clock = control
+    sensor = {sensor.name: sensor for sensor in heating.temp_sensors}[name]
+    reject_first_reading(sensor, clock)
+    heating.sampling_update()
+    for _ in range(5):
+        clock.advance(1)
+        heating.tick({'periodic'})
+    heating.get_state()
+    if name in ('water', 'heater1', 'heater2'):
+        assert not heating.heater.get_state()
+    else:
+        assert heating.heater.get_state()
+
+
+@pytest.mark.parametrize('name', ['water', 'heater1', 'heater2'])
+def test_heater_goes_off_when_its_probes_fault(heating, control, name):
+    _, sim, clock = control
+    for _ in range(5):
+        clock.advance(1)
+        heating.tick({'periodic'})
+    assert heating.heater.get_state()
+    sensor = {sensor.name: sensor for sensor in heating.temp_sensors}[name]
+    for _ in range(10):
+        clock.advance(1)
+        sensor.update(-127.0, -196.6, clock.time())
+        heating.tick({'periodic'})
+    assert sensor.filter.fault
+    assert not heating.heater.get_state()
+    assert not sim.pin(7)
@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+from tub_state import StateFeed, diff_state
+
+
+def test_diff_keeps_only_changed_subtrees():
+    old = {'set_temperature': 104, 'devices': {'light': {'state': False}, 'ozone': {'state': True}}, 'gone': 1}
+    new = {'set_temperature': 104, 'devices': {'light': {'state': True}, 'ozone': {'state': True}}, 'added': [1]}
+    changes, removed = diff_state(old, new)
+    assert changes == {'devices': {'light': {'state': True}}, 'added': [1]}
+    assert removed == [['gone']]
+
+
+def test_diff_reports_nested_removals_and_replaces_non_dicts_whole():
+    old = {'alerts': {'active': ['freeze']}, 'timers': {'circ': 1, 'ozone': 2}, 'fault': None}
+    new = {'alerts': {'active': []}, 'timers': {'circ': 1}, 'fault': 'sensor'}
+    changes, removed = diff_state(old, new)
+    assert changes == {'alerts': {'active': []}, 'fault': 'sensor'}
+    assert removed == [['timers', 'ozone']]
+
+
+def test_version_moves_only_when_the_state_changes():
+    feed = StateFeed()
+    assert feed.version == 0
+    assert feed.publish({'a': 1, 'b': {'c': 2}})
+    assert not feed.publish({'a': 1, 'b': {'c': 2}})
+    assert feed.version == 1
+    assert feed.publish({'a': 1, 'b': {'c': 3}})
+    assert feed.version == 2
+    assert feed.current.changes == {'b': {'c': 3}}
+
+
+def test_messages_are_encoded_once_per_version():
+    feed = StateFeed()
+    feed.publish({'a': 1, 'b': 2})
+    feed.publish({'a': 1})
+    snapshot = feed.current
+    delta = snapshot.message('delta')
+    assert json.loads(delta) == {'type': 'delta', 'version': 2, 'base': 1, 'changes': {}, 'removed': [['b']]}
+    assert snapshot.message('delta') is delta
+    assert json.loads(snapshot.message('snapshot')) == {'type': 'snapshot', 'version': 2, 'state': {'a': 1}}
+    assert json.loads(snapshot.message('legacy')) == {'a': 1}
+
+
+def test_wait_returns_the_next_version_or_times_out():
+    async def scenario():
+        feed = StateFeed()
+        feed.bind(asyncio.get_running_loop())
+        feed.publish({'a': 1})
+        assert (await feed.wait(0)).version == 1  # already newer, no wait
+        assert (await feed.wait(1, 0.01)).version == 1
+        waiter = asyncio.create_task(feed.wait(1, 5))
+        await asyncio.sleep(0)
+        feed.publish({'a': 2})
+        return await waiter
+
+    assert asyncio.run(scenario()).state == {'a': 2}
+
+
+def test_delta_websocket_starts_with_a_snapshot(api):
+    import tub_api
+    tub_api.current_snapshot()  # nothing ticks the loop here, so publish the first version by hand
+    with api.websocket_connect('/state?protocol=delta') as websocket:
+        first = websocket.receive_json()
+        assert first['type'] == 'snapshot' and first['version'] == tub_api.feed.version
+        assert first['state'] == tub_api.feed.current.state
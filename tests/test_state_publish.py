@@ -0,0 +1,22 @@
+import tub_control
+
+
+def test_state_is_built_only_when_a_tick_changed_it(system, control):
+    _, _, clock = control
+    built = []
+    listener = tub_control.on_state_change(lambda cs: built.append(cs.get_state()))
+    system.tick_listeners.append(listener)
+    try:
+        system.change_mode('manual')
+        clock.advance(1 - clock.time() % 1)
+        for _ in range(5):
+            system.tick({'periodic'})
+            clock.advance(0.1)
+        assert len(built) == 1
+        system.commands.submit('light', 'set', True)
+        clock.advance(tub_control.COMMAND_WINDOW)
+        system.tick(tub_control.timers.run_due())
+        assert len(built) == 2 and built[-1]['devices']['light']['state'] is True
+    finally:
+        system.tick_listeners.remove(listener)
+        system.change_mode('automatic')
@@ -0,0 +1,54 @@
+import math
+
+import pytest
+
+from tub_history import HistoryStore
+from tub_thermal import THERMAL_MAX_CORRECTION, ThermalModel
+
+HEATING = 12 / 3600  # F per second with the heater on
+LOSS = 0.04 / 3600  # per second, times (ambient - water)
+
+
+def test_time_to_target():
+    model = ThermalModel()
+    assert model.time_to(100, 101, 50) == 0.0
+    assert model.time_to(104, 100, 50) is None  # nothing learned yet
+    model.coefficients = (HEATING, LOSS, 0.0)
+    equilibrium = 50 + HEATING / LOSS
+    assert model.time_to(104, 100, 50) == pytest.approx(math.log((equilibrium - 100) / (equilibrium - 104)) / LOSS)
+    assert model.time_to(400, 100, 50) is None  # past what the heater can hold against the losses
+
+
+def test_stagnant_correction_is_clamped():
+    model = ThermalModel()
+    assert model.correction(600) == 0.0
+    model.stagnant = (2.0, 600.0)
+    assert model.correction(0) == 0.0
+    assert model.correction(600) == pytest.approx(2.0 * (1 - math.exp(-1)))
+    model.stagnant = (10.0, 60.0)
+    assert model.correction(3600) == THERMAL_MAX_CORRECTION
+
+
+def test_state_with_unknown_readings():
+    state = ThermalModel().state(None, None, 104, 0)
+    assert state['water_estimate'] is None and state['time_to_setpoint'] is None and state['heating_rate'] is None
+
+
+def test_fit_recovers_heating_and_losses(tmp_path):
+    pytest.importorskip('numpy')
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    store.open()
+    model = ThermalModel()
+    store.flush_hooks.append(model.update)
+    start, ambient, water = 1000020.0, 50.0, 90.0
+    for second in range(0, 6 * 60 * 60, 2):
+        heater = 1.0 if (second // 1800) % 2 == 0 else 0.0  # half hours on and off
+        store.record(start + second, {'water': water, 'ambient': ambient, 'heater': heater, 'flow': 1.0,
+                                      'pump1': 0.0, 'pump2': 0.0})
+        water += 2 * (HEATING * heater + LOSS * (ambient - water))
+    store.flush()
+    store.stop()
+    heating, loss, _ = model.coefficients
+    assert heating == pytest.approx(HEATING, rel=0.05)
+    assert loss == pytest.approx(LOSS, rel=0.05)
+    assert model.state(100.0, 50.0, 104.0, 0)['time_to_setpoint'] is not None
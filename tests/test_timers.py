@@ -0,0 +1,88 @@
+from tub_timers import TimerService
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_timers_fire_in_deadline_order():
+    clock = FakeClock()
+    service = TimerService(clock)
+    fired = []
+    service.call_later(3, fired.append, 'c')
+    service.call_later(1, fired.append, 'a')
+    service.call_later(2, fired.append, 'b')
+    clock.now += 2
+    service.run_due()
+    assert fired == ['a', 'b']
+    clock.now += 1
+    service.run_due()
+    assert fired == ['a', 'b', 'c']
+
+
+def test_same_deadline_keeps_submission_order():
+    clock = FakeClock()
+    service = TimerService(clock)
+    fired = []
+    for name in 'abcd':
+        service.call_at(clock.now + 1, fired.append, name)
+    clock.now += 1
+    service.run_due()
+    assert fired == list('abcd')
+
+
+def test_cancelled_timer_never_fires():
+    clock = FakeClock()
+    service = TimerService(clock)
+    fired = []
+    first = service.call_later(1, fired.append, 'first')
+    service.call_later(2, fired.append, 'second')
+    first.cancel()
+    assert not first.active()
+    assert service.next_deadline() == clock.now + 2
+    clock.now += 5
+    service.run_due()
+    assert fired == ['second']
+    first.cancel()  # cancelling again, or after the deadline, is harmless
+    assert service.next_deadline() is None
+
+
+def test_many_cancellations_compact_the_heap():
+    clock = FakeClock()
+    service = TimerService(clock)
+    timers = [service.call_later(i + 1, lambda: None) for i in range(100)]
+    for timer in timers[:80]:
+        timer.cancel()
+    assert len(service.heap) < 100
+    assert len(service.pending()) == 20
+
+
+def test_run_due_returns_reasons_and_survives_a_failing_callback():
+    clock = FakeClock()
+    service = TimerService(clock)
+    fired = []
+
+    def broken():
+        raise RuntimeError("boom")
+
+    service.call_later(1, broken, reason='devices')
+    service.call_later(1, fired.append, 'after', reason='flow')
+    service.call_later(1, fired.append, 'bookkeeping')
+    clock.now += 1
+    assert service.run_due() == {'devices', 'flow'}
+    assert fired == ['after', 'bookkeeping']
+
+
+def test_listeners_hear_only_about_a_new_earliest_deadline():
+    clock = FakeClock()
+    service = TimerService(clock)
+    heard = []
+    service.listeners.append(lambda timer: heard.append(timer.name))
+    service.call_later(10, lambda: None, name='ten')
+    service.call_later(20, lambda: None, name='twenty')
+    service.call_later(5, lambda: None, name='five')
+    assert heard == ['ten', 'five']
@@ -0,0 +1,76 @@
+import sqlite3
+import time
+
+import pytest
+
+from tub_usage import UsageAccounting, UsageReader
+
+
+@pytest.fixture
+def half_hour_zone(monkeypatch):
+    # a zone half an hour off UTC, so local hours don't line up with UTC ones
+    monkeypatch.setenv('TZ', 'IST-5:30')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def local(hour, minute=0, day=15):
+    return time.mktime((2024, 1, day, hour, minute, 0, 0, 0, -1))
+
+
+def test_runtime_splits_at_local_hours(half_hour_zone):
+    usage = UsageAccounting()
+    usage.transition('heater', False, local(10, 5))
+    usage.transition('heater', True, local(10, 20))
+    usage.transition('heater', False, local(11, 10))
+    pending = usage.checkpoint(local(11, 10))
+    assert pending[('hour', '2024-01-15T10', 'heater', 'on')][0] == 40 * 60
+    assert pending[('hour', '2024-01-15T11', 'heater', 'on')][0] == 10 * 60
+    assert pending[('hour', '2024-01-15T10', 'heater', 'off')][0] == 15 * 60
+    seconds, starts, kwh = pending[('day', '2024-01-15', 'heater', 'on')]
+    assert seconds == 50 * 60 and starts == 1
+    assert kwh == pytest.approx(5.5 * 50 / 60)
+
+
+def test_only_changes_into_a_running_state_are_starts(half_hour_zone):
+    usage = UsageAccounting()
+    usage.transition('pump1', 'off', local(9))
+    usage.transition('pump1', 'low', local(9, 10))
+    usage.transition('pump1', 'low', local(9, 15))  # no change
+    usage.transition('pump1', 'high', local(9, 20))
+    usage.transition('pump1', 'off', local(9, 30))
+    pending = usage.checkpoint(local(9, 30))
+    starts = {key[3]: total[1] for key, total in pending.items() if key[0] == 'hour'}
+    assert starts == {'off': 0, 'low': 1, 'high': 1}
+
+
+def test_report_adds_up_flushes(tmp_path, half_hour_zone):
+    path = str(tmp_path / 'history.db')
+    now = [local(10)]
+    usage = UsageAccounting(lambda: now[0])
+    db = sqlite3.connect(path)
+    usage.transition('blower', False)
+    usage.transition('light', True)
+    now[0] = local(10, 15)
+    usage.transition('blower', True)
+    with db:
+        usage.flush(db)
+    now[0] = local(10, 30)
+    usage.transition('blower', False)
+    with db:
+        usage.flush(db)
+    report = UsageReader(path, clock=lambda: now[0]).report('hour', '2024-01-15T10', '2024-01-15T10', ['blower'])
+    assert list(report['totals']) == ['blower']
+    blower = report['buckets']['2024-01-15T10']['blower']
+    assert blower['seconds'] == {'off': 15 * 60, 'on': 15 * 60}
+    assert blower['starts'] == 1 and blower['duty_cycle'] == 0.5
+    assert blower['kwh'] == 0.25
+
+
+def test_report_before_anything_was_flushed(tmp_path):
+    sqlite3.connect(str(tmp_path / 'history.db')).close()
+    report = UsageReader(str(tmp_path / 'history.db')).report('day')
+    assert report['buckets'] == {} and report['totals'] == {}
+    assert UsageReader(str(tmp_path / 'missing.db')).report('month')['totals'] == {}
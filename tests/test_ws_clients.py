@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+import tub_api
+from tub_api import ClientConnection, ConnectionManager
+from tub_state import StateFeed
+
+
+class FakeSocket:
+    def __init__(self, stall: bool = False):
+        self.sent = []
+        self.closed = None
+        self.stall = stall
+        self.client = 'test'
+
+    async def send_text(self, message):
+        if self.stall:
+            await asyncio.sleep(60)
+        self.sent.append(json.loads(message))
+
+    async def close(self, code):
+        self.closed = code
+
+
+def versions(count):
+    feed = StateFeed()
+    snapshots = []
+    for value in range(count):
+        feed.publish({'value': value})
+        snapshots.append(feed.current)
+    return snapshots
+
+
+def test_a_client_that_falls_behind_gets_only_the_latest():
+    async def scenario():
+        socket = FakeSocket()
+        client = ClientConnection(ConnectionManager(), socket, 'legacy', 'json')
+        for snapshot in versions(tub_api.WS_QUEUE_SIZE + 3):
+            client.offer(snapshot)
+        await asyncio.sleep(0.01)
+        client.task.cancel()
+        return socket, client
+
+    socket, client = asyncio.run(scenario())
+    assert socket.sent == [{'value': tub_api.WS_QUEUE_SIZE + 2}]
+    assert client.dropped == tub_api.WS_QUEUE_SIZE + 2
+
+
+def test_delta_client_gets_a_snapshot_after_skipping_versions():
+    async def scenario():
+        socket = FakeSocket()
+        client = ClientConnection(ConnectionManager(), socket, 'delta', 'json')
+        first, second, third, fourth = versions(4)
+        client.offer(first)
+        await asyncio.sleep(0.01)
+        client.offer(second)
+        await asyncio.sleep(0.01)
+        client.offer(fourth)
+        await asyncio.sleep(0.01)
+        client.task.cancel()
+        return socket
+
+    sent = asyncio.run(scenario()).sent
+    assert [message['type'] for message in sent] == ['snapshot', 'delta', 'snapshot']
+    assert sent[1] == {'type': 'delta', 'version': 2, 'base': 1, 'changes': {'value': 1}}
+    assert sent[2]['state'] == {'value': 3}
+
+
+def test_slow_client_is_evicted_without_holding_up_the_others(monkeypatch):
+    monkeypatch.setattr(tub_api, 'WS_SEND_TIMEOUT', 0.05)
+
+    async def scenario():
+        manager = ConnectionManager()
+        slow, fast = FakeSocket(stall=True), FakeSocket()
+        for socket in (slow, fast):
+            manager.active_connections[socket] = ClientConnection(manager, socket, 'legacy', 'json')
+        snapshot = versions(1)[0]
+        manager.broadcast(snapshot)
+        await asyncio.sleep(0.01)
+        assert fast.sent == [{'value': 0}]
+        await asyncio.sleep(0.1)
+        for client in manager.active_connections.values():
+            client.task.cancel()
+        return manager, slow, fast
+
+    manager, slow, fast = asyncio.run(scenario())
+    assert slow.closed == 1008
+    assert list(manager.active_connections) == [fast]
@@ -0,0 +1,174 @@
+import json
+import logging
+import operator
+import os
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ALERT_RULES_PATH = 'alerts.json'  # overrides ALERT_RULES below when it exists
+# each rule: "if" is [input, op, threshold], "while" is a list of more conditions that must hold, "for" is how many
+# seconds it all has to stay true, "hysteresis" is how far back past the threshold the input has to go to clear.
+# inputs are temperature.<sensor>, rate.<sensor> (F per minute), sensor_age.<sensor> (seconds since the last
+# reading), device.<device>, flow, loop_time (seconds between control ticks), set_temperature and mode
+ALERT_RULES = [
+    {'name': 'water_cold_while_heating', 'if': ['temperature.water', '<', 95], 'for': 30 * 60,
+     'while': [['device.heater', '==', True]], 'hysteresis': 1,
+     'message': 'water is still {value}F after 30 minutes of heating'},
+    {'name': 'no_flow_with_circpump', 'if': ['flow', '==', False], 'for': 10,
+     'while': [['device.circpump', '==', True]], 'message': 'no flow for 10 seconds with the circ pump on'},
+    {'name': 'loop_stalled', 'if': ['loop_time', '>', 2], 'hysteresis': 1,
+     'message': 'control loop went {value}s between ticks'},
+    {'name': 'heater1_high_limit', 'if': ['temperature.heater1', '>', 150], 'hysteresis': 5,
+     'message': 'heater1 probe reads {value}F'},
+    {'name': 'heater2_high_limit', 'if': ['temperature.heater2', '>', 150], 'hysteresis': 5,
+     'message': 'heater2 probe reads {value}F'},
+    {'name': 'heater1_rising_fast', 'if': ['rate.heater1', '>', 20], 'for': 5, 'hysteresis': 5,
+     'message': 'heater1 probe rising {value}F per minute'},
+    {'name': 'water_sensor_stale', 'if': ['sensor_age.water', '>', 30], 'hysteresis': 10,
+     'message': 'no water temperature reading for {value}s'},
+    {'name': 'water_freezing', 'if': ['temperature.water', '<', 40], 'hysteresis': 2,
+     'message': 'water temperature is down to {value}F'},
+]
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '==': operator.eq,
+             '!=': operator.ne}
+
+
+def load_rules(path: str = ALERT_RULES_PATH) -> List[dict]:
+    if not os.path.exists(path):
+        return ALERT_RULES
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not load alert rules from {path}, using the built in ones: {e}")
+        return ALERT_RULES
+
+
+class Condition:
+    def __init__(self, spec: list):
+        self.input, op, self.threshold = spec
+        if op not in OPERATORS:
+            raise ValueError(f"unknown operator {op}")
+        self.op = op
+        self.compare = OPERATORS[op]
+
+    def holds(self, values: dict) -> bool:
+        value = values[self.input]
+        try:
+            return value is not None and self.compare(value, self.threshold)
+        except TypeError:
+            return False
+
+    def cleared(self, values: dict, hysteresis: float) -> bool:
+        # an active alert has to get back past the threshold by the hysteresis band before it clears
+        value = values[self.input]
+        if not hysteresis or self.op in ('==', '!='):
+            return not self.holds(values)
+        if value is None:
+            return False
+        if self.op in ('<', '<='):
+            return value >= self.threshold + hysteresis
+        return value <= self.threshold - hysteresis
+
+
+class AlertRule:
+    def __init__(self, spec: dict):
+        self.name = spec['name']
+        self.condition = Condition(spec['if'])
+        self.guards = [Condition(guard) for guard in spec.get('while', [])]
+        self.hold = spec.get('for', 0)
+        self.hysteresis = spec.get('hysteresis', 0)
+        self.message = spec.get('message', self.name)
+        self.inputs = {self.condition.input} | {guard.input for guard in self.guards}
+        self.since = None  # when the condition started holding
+        self.active = False
+        self.activated_time = None
+
+    def check(self, values: dict, now: float) -> Optional[str]:
+        # returns 'raised' or 'cleared' when the alert changes state
+        guarded = all(guard.holds(values) for guard in self.guards)
+        if self.active:
+            if not guarded or self.condition.cleared(values, self.hysteresis):
+                self.active = False
+                self.since = None
+                return 'cleared'
+            return None
+        if guarded and self.condition.holds(values):
+            if self.since is None:
+                self.since = now
+            if now - self.since >= self.hold:
+                self.active = True
+                self.activated_time = now
+                return 'raised'
+        else:
+            self.since = None
+        return None
+
+    def deadline(self) -> Optional[float]:
+        if self.active or self.since is None:
+            return None
+        return self.since + self.hold
+
+    def text(self, values: dict) -> str:
+        value = values[self.condition.input]
+        return self.message.format(value=round(value, 2) if isinstance(value, float) else value,
+                                   threshold=self.condition.threshold)
+
+
+class AlertEngine:
+    # rules are compiled once into getters for the inputs they use and an index from input to rules, each tick
+    # only re-checks the rules whose inputs changed or whose "for" duration ran out
+    def __init__(self, rules: List[dict], resolve: Callable[[str], Callable], notify: Callable[[str, str], None]):
+        self.rules = []
+        for spec in rules:
+            try:
+                self.rules.append(AlertRule(spec))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Skipping alert rule {spec.get('name', spec)}: {e}")
+        self.notify = notify
+        self.getters = {}
+        self.dependents = {}
+        for rule in list(self.rules):
+            try:
+                for name in rule.inputs:
+                    if name not in self.getters:
+                        self.getters[name] = resolve(name)
+                    self.dependents.setdefault(name, []).append(rule)
+            except (KeyError, ValueError) as e:
+                logger.error(f"Skipping alert rule {rule.name}: unknown input {e}")
+                self.rules.remove(rule)
+                for dependents in self.dependents.values():
+                    if rule in dependents:
+                        dependents.remove(rule)
+        self.values = {}
+        self.waiting = {}  # rule -> deadline, rules whose condition holds but not for long enough yet
+
+    def evaluate(self, now: float) -> None:
+        dirty = set()
+        for name, getter in self.getters.items():
+            value = getter()
+            if name not in self.values or value != self.values[name]:
+                self.values[name] = value
+                dirty.update(self.dependents[name])
+        for rule, deadline in list(self.waiting.items()):
+            if deadline <= now:
+                dirty.add(rule)
+        for rule in dirty:
+            change = rule.check(self.values, now)
+            deadline = rule.deadline()
+            if deadline is None:
+                self.waiting.pop(rule, None)
+            else:
+                self.waiting[rule] = deadline
+            if change == 'raised':
+                text = rule.text(self.values)
+                logger.warning(f"Alert {rule.name}: {text}")
+                self.notify(f"Alert {rule.name}: {text}", f"alert:{rule.name}")
+            elif change == 'cleared':
+                logger.info(f"Alert {rule.name} cleared")
+                self.notify(f"Alert {rule.name} cleared", f"alert:{rule.name}:cleared")
+
+    def active(self) -> List[str]:
+        return [rule.name for rule in self.rules if rule.active]
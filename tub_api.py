@@ -1,16 +1,65 @@
 import logging
 import asyncio
+import hashlib
+import json
 import sys
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel
-from tub_control import cs
+from tub_state import StateFeed, ENCODINGS
+from tub_assets import load_asset, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+from tub_history import HistoryReader, HISTORY_POINTS, HISTORY_METHODS, ROLLUP_TIERS
+from tub_export import export, EXPORT_FORMATS, EXPORT_MEDIA_TYPES
+from tub_usage import UsageReader, USAGE_PERIODS
+from tub_metrics import registry, METRICS_CONTENT_TYPE
+from tub_ipc import ControlUnavailable
 
 # Logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_state_feed()
+    load_ui_assets()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+# tub_control.LocalControl when the control loop runs in this process, tub_ipc.RemoteControl when it runs in its own
+control = None
+feed = StateFeed()
+UI_PAGES = ['index.html', 'admin.html']
+assets = {}  # page file name -> StaticAsset, loaded at startup and served from memory
+history = HistoryReader()
+usage = UsageReader()
+
+MAIN_PUMPS = ['pump1', 'pump2']
+COMMAND_TIMEOUT = 10  # seconds a request with ?wait=true holds on for its command to finish
+# named scenes for /batch, device -> state plus an optional setpoint, explicit changes in a request win
+PRESETS = {
+    'soak': {'changes': {'pump1': 'high', 'blower': 'on', 'light': 'on'}, 'set_temperature': 102.0},
+    'jets_off': {'changes': {'pump1': 'off', 'pump2': 'off', 'blower': 'off'}},
+    'all_off': {'changes': {'pump1': 'off', 'pump2': 'off', 'blower': 'off', 'light': 'off', 'ozone': 'off'}},
+}
+LONG_POLL_TIMEOUT = 30  # seconds a ?since= request waits for a change when no timeout is given
+LONG_POLL_MAX_TIMEOUT = 120
+WS_QUEUE_SIZE = 8  # snapshots waiting per WebSocket client before the oldest is dropped
+WS_SEND_TIMEOUT = 5  # seconds a single send may take before the client is evicted as too slow
+METRICS_TIMEOUT = 5  # seconds /metrics waits for a separate control process to render its part
+
+ws_send_seconds = registry.histogram('hotcon_websocket_send_seconds', "Time taken by one WebSocket state message",
+                                     ['kind'])
+ws_dropped = registry.counter('hotcon_websocket_dropped_total',
+                              "State updates a WebSocket client skipped because it was behind").labels()
+ws_evicted = registry.counter('hotcon_websocket_evicted_total', "WebSocket clients closed for being too slow").labels()
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,6 +70,20 @@ app.add_middleware(
 )
 
 
+def get_control():
+    global control
+    if control is None:
+        from tub_control import LocalControl
+        control = LocalControl()
+    return control
+
+
+@app.exception_handler(ControlUnavailable)
+async def control_unavailable(request: Request, error: ControlUnavailable):
+    # a separate control process that is still starting, clients should retry rather than see missing devices
+    return JSONResponse({"status": "error", "message": str(error)}, status_code=503, headers={'Retry-After': '1'})
+
+
 class TemperatureSetting(BaseModel):
     temperature: float
 
@@ -33,29 +96,110 @@ class ModeSetting(BaseModel):
     mode: str
 
 
+class DeviceChange(BaseModel):
+    device: str
+    state: str
+
+
+class BatchRequest(BaseModel):
+    preset: Optional[str] = None
+    changes: List[DeviceChange] = []
+    set_temperature: Optional[float] = None
+    mode: Optional[str] = None
+
+
+class ClientConnection:
+    # one writer task per socket so a slow client only ever holds up itself
+    def __init__(self, manager: 'ConnectionManager', websocket: WebSocket, protocol: str, encoding: str):
+        self.manager = manager
+        self.websocket = websocket
+        self.protocol = protocol
+        self.encoding = encoding
+        self.version = 0
+        self.dropped = 0
+        self.pending = deque(maxlen=WS_QUEUE_SIZE)
+        self.ready = asyncio.Event()
+        self.task = asyncio.create_task(self.writer())
+
+    def offer(self, snapshot) -> None:
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+            ws_dropped.inc()
+        self.pending.append(snapshot)
+        self.ready.set()
+
+    async def writer(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                if not self.pending:
+                    continue
+                # latest wins, a delta client that skipped versions gets a full snapshot instead
+                snapshot = self.pending[-1]
+                self.dropped += len(self.pending) - 1
+                ws_dropped.inc(len(self.pending) - 1)
+                self.pending.clear()
+                await asyncio.wait_for(self.send_snapshot(snapshot), WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Evicting slow WebSocket client {self.websocket.client}, "
+                           f"{self.dropped} updates dropped")
+            ws_evicted.inc()
+            await self.manager.disconnect(self.websocket, close=True)
+        except (RuntimeError, WebSocketDisconnect) as e:
+            logger.error(f"Failed to broadcast message: {e}")
+            await self.manager.disconnect(self.websocket)
+
+    async def send_snapshot(self, snapshot):
+        if self.protocol != 'delta':
+            kind = 'legacy'
+        elif self.version and self.version == snapshot.version - 1:
+            kind = 'delta'
+        else:
+            kind = 'snapshot'
+        message = snapshot.message(kind, self.encoding)
+        started = time.perf_counter()
+        if isinstance(message, bytes):
+            await self.websocket.send_bytes(message)
+        else:
+            await self.websocket.send_text(message)
+        ws_send_seconds.labels(kind).observe(time.perf_counter() - started)
+        self.version = snapshot.version
+
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: dict[WebSocket, ClientConnection] = {}
         self.broadcast_task = None
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, protocol: str = 'legacy', encoding: str = 'json'):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = ClientConnection(self, websocket, protocol, encoding)
+        self.active_connections[websocket] = client
+        if feed.current:
+            client.offer(feed.current)
         if not self.broadcast_task:
             self.broadcast_task = asyncio.create_task(self.broadcast_loop())
 
-    async def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+    async def disconnect(self, websocket: WebSocket, close: bool = False):
+        client = self.active_connections.pop(websocket, None)
+        if client and client.task is not asyncio.current_task():
+            client.task.cancel()
+        if close:
+            try:
+                await websocket.close(code=1008)
+            except RuntimeError:
+                pass
         if not self.active_connections and self.broadcast_task:
             self.broadcast_task.cancel()
             self.broadcast_task = None
 
     async def broadcast_loop(self):
+        version = feed.version
         while True:
-            await asyncio.sleep(1)
-            state = cs.get_state()
-            await self.broadcast(state)
+            snapshot = await feed.wait(version)
+            version = snapshot.version
+            self.broadcast(snapshot)
 
     async def send_personal_message(self, message: dict, websocket: WebSocket):
         try:
@@ -64,117 +208,308 @@ class ConnectionManager:
             logger.error(f"Failed to send message: {e}")
             await self.disconnect(websocket)
 
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except RuntimeError as e:
-                logger.error(f"Failed to broadcast message: {e}")
-                await self.disconnect(connection)
+    def broadcast(self, snapshot):
+        # only queues, never waits on a socket
+        for client in list(self.active_connections.values()):
+            if client.version < snapshot.version:
+                client.offer(snapshot)
 
     def close_all(self):
-        for connection in self.active_connections:
+        for connection in list(self.active_connections):
             connection.close()
-            self.disconnect(connection)
-        self.active_connections = []
+        self.active_connections = {}
 
 
 manager = ConnectionManager()
+registry.gauge('hotcon_websocket_clients', "Connected WebSocket clients", lambda: len(manager.active_connections))
+
+
+def start_state_feed():
+    feed.bind(asyncio.get_running_loop())
+    get_control().subscribe(feed.publish)
+
+
+def load_ui_assets():
+    for page in UI_PAGES:
+        asset = load_asset(page)
+        if asset:
+            assets[page] = asset
+
+
+def serve_asset(page: str) -> Response:
+    # the plain URL is a small revalidating redirect, the page itself comes from its hashed URL, which the
+    # browser caches for good and only fetches again once a change on disk gives it a new name
+    if page not in assets:
+        return Response(status_code=404)
+    assets[page].refresh()
+    return RedirectResponse(f"/assets/{assets[page].hashed_name}", status_code=302,
+                            headers={'Cache-Control': REVALIDATE_CACHE_CONTROL})
 
 
 @app.get("/")
 async def read_root():
-    return FileResponse("index.html")
+    return serve_asset("index.html")
 
 
 @app.get("/admin")
 async def read_admin():
-    return FileResponse("admin.html")
+    return serve_asset("admin.html")
+
+
+@app.get("/assets/{name}")
+async def read_hashed_asset(name: str, request: Request):
+    # content-hashed copies of the pages, safe to cache forever since a change on disk gives a new name
+    for asset in assets.values():
+        asset.refresh()
+        if asset.hashed_name == name:
+            return asset.response(request, IMMUTABLE_CACHE_CONTROL)
+    for asset in assets.values():
+        if asset.hashed_name.split('.')[0] == name.split('.')[0]:
+            # an old hash, e.g. a bookmark from before the page changed
+            return RedirectResponse(f"/assets/{asset.hashed_name}", status_code=302,
+                                    headers={'Cache-Control': REVALIDATE_CACHE_CONTROL})
+    return Response(status_code=404)
 
 
 @app.websocket("/state")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, protocol: str = 'legacy', encoding: str = 'json'):
+    # protocol=delta sends a full snapshot first and only the changed fields after that,
+    # encoding=msgpack switches to binary frames when msgpack is installed
+    await manager.connect(websocket, 'delta' if protocol == 'delta' else 'legacy',
+                          encoding if encoding in ENCODINGS else 'json')
     try:
         while True:
-            await websocket.receive()  # Keep the connection open
+            message = await websocket.receive()  # Keep the connection open
+            if message['type'] == 'websocket.disconnect':
+                break
     except WebSocketDisconnect:
-        await manager.disconnect(websocket)
+        pass
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
-        await manager.disconnect(websocket)
+    await manager.disconnect(websocket)
 
 
-@app.get("/quick_state")
-async def get_quick_state():
-    # Prepare the optimized quick state data
-    quick_state = {
-        'set_temperature': cs.set_temperature,
-        'water_temperature': cs.temp_water.f(),
+def quick_state_of(state: dict) -> dict:
+    return {
+        'set_temperature': state['set_temperature'],
+        'water_temperature': state['temperatures']['water'],
         'main_pumps': {
-            'pump1': cs.pump1.get_state(),
-            'pump2': cs.pump2.get_state(),
+            'pump1': state['main_pumps']['pump1']['state'],
+            'pump2': state['main_pumps']['pump2']['state'],
         },
-        'light_state': cs.light.get_state()
+        'light_state': state['devices']['light']['state'],
+        'time_to_setpoint': state['thermal']['time_to_setpoint'],
     }
-    return quick_state
+
+
+def encode_body(document: dict) -> tuple:
+    body = json.dumps(document, separators=(',', ':'), ensure_ascii=False).encode()
+    return body, '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+
+def current_snapshot():
+    if feed.current is None:
+        feed.publish(get_control().get_state())
+    return feed.current
+
+
+async def conditional_state(request: Request, kind: str, build, since: int = None, timeout: float = None):
+    # ETag/If-None-Match with 304s, and with ?since= or ?timeout= the request is held until the body would change
+    snapshot = current_snapshot()
+    client_tags = {tag.strip().removeprefix('W/') for tag in request.headers.get('if-none-match', '').split(',')}
+    if since is not None or timeout:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + min(timeout or LONG_POLL_TIMEOUT, LONG_POLL_MAX_TIMEOUT)
+        while True:
+            body, etag = snapshot.cached(kind, build)
+            if (since is None or snapshot.version > since) and etag not in client_tags:
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            snapshot = await feed.wait(snapshot.version, remaining)
+    body, etag = snapshot.cached(kind, build)
+    headers = {'ETag': etag, 'X-State-Version': str(snapshot.version), 'Cache-Control': 'no-cache'}
+    if etag in client_tags or '*' in client_tags:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+
+@app.get("/quick_state")
+async def get_quick_state(request: Request, since: int = None, timeout: float = None):
+    # Prepare the optimized quick state data
+    return await conditional_state(request, 'quick_http', lambda snapshot: encode_body(quick_state_of(snapshot.state)),
+                                   since, timeout)
+
+
+@app.get("/full_state")
+async def get_full_state(request: Request, since: int = None, timeout: float = None):
+    # same document the /state WebSocket pushes
+    return await conditional_state(request, 'full_http', lambda snapshot: encode_body(snapshot.state), since, timeout)
 
 
 @app.post("/set_temperature")
 async def set_temperature(setting: TemperatureSetting):
-    cs.set_temperature = setting.temperature
+    get_control().change_setpoint(setting.temperature)
     return {"status": "success", "message": f"Set temperature updated to {setting.temperature}°F."}
 
 
 @app.post("/toggle/{device}")
-async def toggle_device(device: str):
-    if device == 'heater':
-        cs.heater.toggle_state()
-    elif device == 'circpump':
-        cs.circpump.toggle_state()
-    elif device == 'pump1':
-        cs.pump1.advance_state()
-    elif device == 'pump2':
-        cs.pump2.advance_state()
-    elif device == 'blower':
-        cs.blower.toggle_state()
-    elif device == 'light':
-        cs.light.toggle_state()
-    elif device == 'ozone':
-        cs.ozone.toggle_state()
-    elif device == 'fans':
-        cs.fans.toggle_state()
-    else:
+async def toggle_device(device: str, wait: bool = False):
+    if device not in get_control().device_names():
         return {"status": "error", "message": "Unknown device."}
-    return {"status": "success", "message": f"{device} toggled."}
+    command = get_control().submit(device, 'advance' if device in MAIN_PUMPS else 'toggle')
+    if wait:
+        await command.wait(COMMAND_TIMEOUT)
+    return {"status": "success", "message": f"{device} toggled.", "command_id": command.id,
+            "command_status": command.status}
+
+
+def parse_device_state(device: str, new_state: str):
+    # the value a 'set' command carries for this device, or an error message
+    if device not in get_control().device_names():
+        return None, f"Unknown device {device}."
+    if device in MAIN_PUMPS:
+        if new_state not in ["off", "low", "high"]:
+            return None, f"Invalid state for {device}."
+        return new_state, None
+    return new_state == "on", None
 
 
 @app.post("/set/{device}")
-async def set_device_state(device: str, state: DeviceState):
+async def set_device_state(device: str, state: DeviceState, wait: bool = False):
     new_state = state.state.lower()
-    if device == 'heater':
-        cs.heater.set_state(new_state == "on")
-    elif device == 'circpump':
-        cs.circpump.set_state(new_state == "on")
-    elif device == 'pump1':
-        if new_state in ["off", "low", "high"]:
-            cs.pump1.set_state(new_state != "off", new_state if new_state != "off" else 'low')
+    if device not in get_control().device_names():
+        return {"status": "error", "message": "Unknown device."}
+    value, error = parse_device_state(device, new_state)
+    if error:
+        return {"status": "error", "message": error}
+    command = get_control().submit(device, 'set', value)
+    if wait:
+        await command.wait(COMMAND_TIMEOUT)
+    return {"status": "success", "message": f"{device} state set to {new_state}.", "command_id": command.id,
+            "command_status": command.status}
+
+
+@app.get("/presets")
+async def get_presets():
+    return PRESETS
+
+
+@app.post("/batch")
+async def apply_batch(batch: BatchRequest, wait: bool = True):
+    # everything is validated before anything is queued, then the whole batch lands in a single control tick
+    changes = {}
+    set_temperature = batch.set_temperature
+    if batch.preset is not None:
+        if batch.preset not in PRESETS:
+            return {"status": "error", "message": f"Unknown preset {batch.preset}."}
+        changes.update(PRESETS[batch.preset]['changes'])
+        if set_temperature is None:
+            set_temperature = PRESETS[batch.preset].get('set_temperature')
+    changes.update({change.device: change.state.lower() for change in batch.changes})
+    items = []
+    errors = []
+    for device, new_state in changes.items():
+        value, error = parse_device_state(device, new_state)
+        if error is None and device not in MAIN_PUMPS and new_state not in ["on", "off"]:
+            # /set has always read anything but "on" as off, a scene has to say exactly what it means
+            error = f"Invalid state for {device}."
+        if error:
+            errors.append(error)
         else:
-            return {"status": "error", "message": "Invalid state for pump1."}
-    elif device == 'pump2':
-        if new_state in ["off", "low", "high"]:
-            cs.pump2.set_state(new_state != "off", new_state if new_state != "off" else 'low')
+            items.append((device, 'set', value))
+    if batch.mode is not None:
+        if batch.mode.lower() not in ["automatic", "manual"]:
+            errors.append("Invalid mode. Choose 'automatic' or 'manual'.")
         else:
-            return {"status": "error", "message": "Invalid state for pump2."}
-    elif device == 'blower':
-        cs.blower.set_state(new_state == "on")
-    elif device == 'light':
-        cs.light.set_state(new_state == "on")
-    elif device == 'ozone':  # Add ozone to the set state API
-        cs.ozone.set_state(new_state == "on")
-    else:
-        return {"status": "error", "message": "Unknown device."}
-    return {"status": "success", "message": f"{device} state set to {new_state}."}
+            items.append(('mode', 'set', batch.mode.lower()))
+    if set_temperature is not None:
+        items.append(('setpoint', 'set', set_temperature))
+    if errors:
+        return {"status": "error", "message": " ".join(errors)}
+    if not items:
+        return {"status": "error", "message": "Nothing to apply."}
+    commands = get_control().submit_batch(items)
+    if wait:
+        await asyncio.gather(*(command.wait(COMMAND_TIMEOUT) for command in commands))
+    failed = [command.device for command in commands if command.status in ('rejected', 'failed')]
+    return {
+        "status": "error" if failed else "success",
+        "message": f"Not applied: {', '.join(failed)}." if failed else f"Applied {len(commands)} changes.",
+        "commands": [command.to_dict() for command in commands],
+    }
+
+
+@app.get("/commands/{command_id}")
+async def get_command(command_id: int, wait: bool = False):
+    command = get_control().get_command(command_id)
+    if command is None:
+        return {"status": "error", "message": "Unknown command."}
+    if wait:
+        await command.wait(COMMAND_TIMEOUT)
+    return command.to_dict()
+
+
+@app.get("/timers")
+async def get_timers():
+    return {"timers": get_control().pending_timers()}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text format. a control loop in its own process renders its metrics there and they're appended
+    text = registry.render()
+    remote = get_control().metrics()
+    if remote is not None and await remote.wait(METRICS_TIMEOUT) and remote.status == 'done':
+        text += remote.result
+    return Response(text, media_type=METRICS_CONTENT_TYPE)
+
+
+@app.get("/thermal")
+async def get_thermal():
+    # learned heating rate and losses, the time to reach the set temperature and the stagnant water correction
+    return get_control().get_state()['thermal']
+
+
+@app.get("/history")
+def get_history(channels: str = None, start: float = None, end: float = None, points: int = HISTORY_POINTS,
+                method: str = 'minmax'):
+    # plain def so the query runs in the threadpool and never holds up the event loop
+    if method not in HISTORY_METHODS:
+        return {"status": "error", "message": f"Invalid method. Choose one of {', '.join(HISTORY_METHODS)}."}
+    names = [name.strip() for name in channels.split(',') if name.strip()] if channels else None
+    recent = get_control().history_recent(start or 0)
+    if names:
+        known = set(history.channels()).union(*(values for _, values in recent[-1:]))
+        unknown = [name for name in names if name not in known]
+        if unknown:
+            return {"status": "error", "message": f"Unknown channels: {', '.join(unknown)}."}
+    return history.query(names, start, end, points, method, recent)
+
+
+@app.get("/export")
+def export_history(format: str = 'csv', channels: str = None, start: float = 0, end: float = None, tier: int = 0):
+    # streamed straight out of SQLite a chunk at a time, tier 0 is the raw samples, otherwise a rollup bucket size
+    if format not in EXPORT_FORMATS:
+        return {"status": "error", "message": f"Invalid format. Choose one of {', '.join(EXPORT_FORMATS)}."}
+    tiers = [0] + [bucket for bucket, _ in ROLLUP_TIERS]
+    if tier not in tiers:
+        return {"status": "error", "message": f"Invalid tier. Choose one of {', '.join(map(str, tiers))}."}
+    names = [name.strip() for name in channels.split(',') if name.strip()] if channels else None
+    rows = history.rows(names, start, end, tier)
+    filename = f"hotcon-history.{format}"
+    return StreamingResponse(export(rows, format, tier), media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@app.get("/usage")
+def get_usage(period: str = 'day', start: str = None, end: str = None, devices: str = None):
+    # runtime per state, starts, estimated kWh and duty cycle per device, start and end are bucket labels
+    if period not in USAGE_PERIODS:
+        return {"status": "error", "message": f"Invalid period. Choose one of {', '.join(USAGE_PERIODS)}."}
+    names = [name.strip() for name in devices.split(',') if name.strip()] if devices else None
+    return usage.report(period, start, end, names)
 
 
 @app.post("/set_mode")
@@ -182,8 +517,8 @@ async def set_mode(setting: ModeSetting):
     mode = setting.mode.lower()
     if mode not in ["automatic", "manual"]:
         return {"status": "error", "message": "Invalid mode. Choose 'automatic' or 'manual'."}
-    cs.mode = mode
-    return {"status": "success", "message": f"Mode set to {cs.mode}."}
+    get_control().change_mode(mode)
+    return {"status": "success", "message": f"Mode set to {mode}."}
 
 
 def start_api_server():
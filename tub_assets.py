@@ -0,0 +1,107 @@
+import gzip
+import hashlib
+import logging
+import os
+import time
+from typing import Optional
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ASSET_CHECK_INTERVAL = 2  # seconds between mtime checks for changes on disk
+# the plain URLs always revalidate so a new file shows up right away, the hashed URLs never change
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+ENCODING_SUFFIX = {'br': '-br', 'gzip': '-gz', 'identity': ''}
+
+
+def accepted_encodings(accept_encoding: str) -> dict:
+    accepted = {}
+    for part in accept_encoding.split(','):
+        if not part.strip():
+            continue
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    return accepted
+
+
+class StaticAsset:
+    # a UI page held in memory with its gzip and brotli variants, reloaded when the file on disk changes
+    def __init__(self, path: str, media_type: str = 'text/html; charset=utf-8'):
+        self.path = path
+        self.media_type = media_type
+        self.signature = None
+        self.variants = {}
+        self.digest = None
+        self.last_check = 0
+        self.load()
+
+    @property
+    def hashed_name(self) -> str:
+        root, ext = os.path.splitext(os.path.basename(self.path))
+        return f"{root}.{self.digest}{ext}"
+
+    def load(self) -> None:
+        stat = os.stat(self.path)
+        with open(self.path, 'rb') as file:
+            body = file.read()
+        variants = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli:
+            variants['br'] = brotli.compress(body, quality=11)
+        self.variants = variants
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+        self.last_check = time.time()
+        sizes = ', '.join(f"{encoding} {len(data)}" for encoding, data in variants.items())
+        logger.info(f"Loaded {self.path} as {self.hashed_name} ({sizes} bytes)")
+
+    def refresh(self) -> None:
+        if time.time() - self.last_check < ASSET_CHECK_INTERVAL:
+            return
+        self.last_check = time.time()
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_mtime_ns, stat.st_size) != self.signature:
+                self.load()
+        except OSError as e:
+            logger.error(f"Could not reload {self.path}, serving the copy in memory: {e}")
+
+    def select(self, accept_encoding: str) -> str:
+        accepted = accepted_encodings(accept_encoding)
+        for encoding in ['br', 'gzip']:
+            if encoding in self.variants and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return 'identity'
+
+    def response(self, request: Request, cache_control: str = REVALIDATE_CACHE_CONTROL) -> Response:
+        self.refresh()
+        encoding = self.select(request.headers.get('accept-encoding', ''))
+        # every encoding is its own representation, so each one gets its own strong ETag
+        etag = f'"{self.digest}{ENCODING_SUFFIX[encoding]}"'
+        headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        if etag in {tag.strip() for tag in request.headers.get('if-none-match', '').split(',')}:
+            return Response(status_code=304, headers=headers)
+        return Response(self.variants[encoding], media_type=self.media_type, headers=headers)
+
+
+def load_asset(path: str) -> Optional[StaticAsset]:
+    try:
+        return StaticAsset(path)
+    except OSError as e:
+        logger.error(f"Could not load {path}: {e}")
+        return None
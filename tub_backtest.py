@@ -0,0 +1,376 @@
+import argparse
+import itertools
+import json
+import math
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from tub_control import RULE_SETTINGS
+from tub_thermal import THERMAL_MAX_CORRECTION, ThermalModel, fill_gaps, load_grid
+from tub_usage import DEVICE_POWER
+
+BACKTEST_STEP = 10  # seconds per simulated step, fine enough for the 30 and 60 second delays in the rules
+# heating, loss and jets coefficients in F and seconds for when the history is too short to learn them, about what
+# a 5.5 kW heater does to 1500 litres under a cover
+BACKTEST_COEFFICIENTS = (1.6e-3, 4.8e-6, 8.6e-5)
+# seconds, Heater.set_state refuses to switch on this soon after its own last change or after the circ pump started
+BACKTEST_HEATER_LOCKOUT = 60
+BACKTEST_CHANNELS = ['water', 'ambient', 'cabinet', 'control_box', 'set_temperature', 'pump1', 'pump2', 'ozone',
+                     'circpump']
+BACKTEST_METRICS = [
+    # (name, format) in the order the report prints them
+    ('kwh', '.1f'), ('switches', 'd'), ('heater_switches', 'd'), ('pump_switches', 'd'), ('freeze_cycles', 'd'),
+    ('mean_deviation', '.2f'), ('cold_hours', '.1f'), ('max_overshoot', '.1f'), ('min_water', '.1f'),
+    ('blower_hours', '.1f'), ('fans_hours', '.1f'),
+]
+PUMP_SPEEDS = ['off', 'low', 'high']
+
+
+class Trace:
+    # everything the rules react to that they don't control themselves, on a uniform grid, temperatures in F. the
+    # water temperature is only used for its starting value, the engine simulates it from there
+    def __init__(self, times, step: float, columns: Dict[str, object]):
+        self.times = times
+        self.step = step
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+
+def drop_short_runs(states, step: float, limit: float):
+    # freeze cycles in a recording came from the rules being tested, they get replayed by the engine instead
+    running = np.concatenate(([False], states > 0, [False]))
+    edges = np.flatnonzero(np.diff(running.astype(np.int8)))
+    cleaned = states.copy()
+    for start, end in zip(edges[::2], edges[1::2]):
+        if (end - start) * step <= limit:
+            cleaned[start:end] = 0
+    return cleaned
+
+
+def load_trace(path: str, start: float, end: float, step: float = BACKTEST_STEP) -> Trace:
+    # raw samples at this step when they still cover the range, otherwise the one minute rollups
+    db = sqlite3.connect(path)
+    try:
+        tier = 60 if step >= 60 or start < time.time() - 24 * 60 * 60 else 0
+        step = max(step, tier)
+        times, data = load_grid(db, BACKTEST_CHANNELS, start, end, step, tier)
+    finally:
+        db.close()
+    if times is None:
+        raise ValueError(f"{path} has no history for some of {', '.join(BACKTEST_CHANNELS)}")
+    for name, values in data.items():
+        values = fill_gaps(values, len(values))
+        first = np.flatnonzero(np.isfinite(values))
+        if not len(first):
+            raise ValueError(f"{path} has no {name} samples between {start} and {end}")
+        values[:first[0]] = values[first[0]]
+        data[name] = values
+    for name in ('pump1', 'pump2'):
+        data[name] = drop_short_runs(np.round(data[name]), step, RULE_SETTINGS['freeze_run_time'] + step)
+    return Trace(times, step, data)
+
+
+def synthetic_trace(days: float = 30, step: float = BACKTEST_STEP, start: Optional[float] = None,
+                    ambient_mean: float = 40.0, ambient_swing: float = 12.0, set_temperature: float = 102.0,
+                    soak_chance: float = 0.6, seed: int = 0) -> Trace:
+    # a daily ambient swing with a wandering weather offset, evening soaks on pump1, the 2 AM ozone run and the
+    # 3 AM filter cycle. the cabinet follows the ambient and warms up while a pump runs
+    random = np.random.default_rng(seed)
+    start = time.time() // 86400 * 86400 if start is None else start
+    times = start + step * np.arange(int(days * 86400 / step))
+    hours = (times + time.localtime(start).tm_gmtoff) % 86400 / 3600
+    # weather fronts: a few slow swings of two to ten days on top of the daily one
+    periods = random.uniform(2, 10, 4) * 86400
+    weather = sum(random.uniform(2, 5) * np.sin(2 * np.pi * times / period + random.uniform(0, 2 * np.pi))
+                  for period in periods)
+    ambient = ambient_mean + ambient_swing * np.sin(2 * np.pi * (hours - 9) / 24) + weather
+    ozone = ((hours >= 2) & (hours < 3)).astype(float)
+    pump1 = np.zeros(len(times))
+    pump1[(hours >= 3) & (hours < 3 + 20 / 60)] = 2
+    midnight = start - hours[0] * 3600
+    for day in range(int(math.ceil(days)) + 1):
+        if random.random() < soak_chance:
+            soak = int(np.searchsorted(times, midnight + day * 86400 + (18 + 3 * random.random()) * 3600))
+            pump1[soak:soak + int(20 * 60 / step)] = 2
+    cabinet = ambient + 10 + 15 * (pump1 > 0)
+    columns = {
+        'water': np.full(len(times), set_temperature),
+        'ambient': ambient,
+        'cabinet': cabinet,
+        'control_box': cabinet + 9,
+        'set_temperature': np.full(len(times), set_temperature),
+        'pump1': pump1,
+        'pump2': np.zeros(len(times)),
+        'ozone': ozone,
+        'circpump': np.ones(len(times)),
+    }
+    return Trace(times, step, columns)
+
+
+def learned_model(path: str) -> tuple:
+    # the heating coefficients and the stagnant water correction (scale F, time constant seconds), the correction
+    # is None when the history has too few pump starts to fit it
+    model = ThermalModel()
+    db = sqlite3.connect(path)
+    try:
+        model.update(db)
+    finally:
+        db.close()
+    return model.coefficients or BACKTEST_COEFFICIENTS, model.stagnant
+
+
+def parameter_grid(options: Dict[str, list]) -> List[dict]:
+    # every combination of the given values, anything not given stays at its RULE_SETTINGS value
+    unknown = set(options) - set(RULE_SETTINGS)
+    if unknown:
+        raise ValueError(f"unknown rule settings: {', '.join(sorted(unknown))}")
+    names = list(options)
+    return [{**RULE_SETTINGS, **dict(zip(names, values))} for values in itertools.product(*options.values())]
+
+
+def simulate(trace: Trace, variants: List[dict], coefficients: tuple = BACKTEST_COEFFICIENTS,
+             stagnant: Optional[tuple] = None) -> Dict[str, object]:
+    # every variant steps through the trace together: each rule is the same comparison as in tub_control, done on
+    # an array with one entry per variant, so the cost per step barely depends on how many variants there are.
+    # the simulated water is what the probe reads, the heater rules see it plus the stagnant water correction
+    # ThermalModel.correction would add, and the heater keeps its short cycling lockout
+    count = len(variants)
+    settings = {name: np.array([variant[name] for variant in variants], dtype=float) for name in RULE_SETTINGS}
+    heating, loss, jets_rate = coefficients
+    step = trace.step
+    decay = math.exp(-loss * step)
+    columns = trace.columns
+    start = float(trace.times[0])
+
+    water = np.full(count, float(columns['water'][0]))
+    heater = np.zeros(count, dtype=bool)
+    heater_change = np.full(count, start)
+    circpump = np.full(count, bool(columns['circpump'][0] > 0))
+    circ_since = np.full(count, start - 24 * 60 * 60)
+    blower = np.zeros(count, dtype=bool)
+    fans = np.zeros(count, dtype=bool)
+    pumps = [np.zeros(count, dtype=bool), np.zeros(count, dtype=bool)]
+    pump_change = [np.full(count, start), np.full(count, start)]
+    freeze_until = [np.full(count, -np.inf), np.full(count, -np.inf)]
+
+    seconds = {name: np.zeros(count) for name in ('heater', 'circpump', 'blower', 'fans')}
+    switches = {name: np.zeros(count, dtype=np.int64) for name in ('heater', 'circpump', 'blower', 'fans', 'pump1',
+                                                                     'pump2')}
+    pump_energy = np.zeros(count)
+    freeze_cycles = np.zeros(count, dtype=np.int64)
+    deviation = np.zeros(count)
+    cold = np.zeros(count)
+    overshoot = np.full(count, -np.inf)
+    min_water = np.full(count, np.inf)
+    fixed_energy = 0.0
+    low_power = DEVICE_POWER['pump1']['low']
+
+    rows = zip(trace.times.tolist(), columns['ambient'].tolist(), columns['cabinet'].tolist(),
+               columns['control_box'].tolist(), columns['set_temperature'].tolist(), columns['pump1'].tolist(),
+               columns['pump2'].tolist(), columns['ozone'].tolist())
+    for now, ambient, cabinet, control_box, set_temperature, user1, user2, ozone in rows:
+        ozone = ozone > 0
+        fixed_energy += DEVICE_POWER['ozone']['on'] * ozone
+        freezing = ambient < settings['freeze_temperature']
+        for index, (user, interval) in enumerate(((user1, 'freeze_pump1_interval'), (user2, 'freeze_pump2_interval'))):
+            # the trace runs the pump for a soak or filter cycle, the rule under test adds its freeze cycles
+            running = pumps[index]
+            speed = PUMP_SPEEDS[int(user)] if user > 0 else None
+            state = (now < freeze_until[index]) if speed is None else np.ones(count, dtype=bool)
+            changed = state != running
+            switches[f'pump{index + 1}'] += changed
+            pump_change[index] = np.where(changed, now, pump_change[index])
+            start_cycle = freezing & ~state & (now - pump_change[index] > settings[interval])
+            if start_cycle.any():
+                freeze_until[index] = np.where(start_cycle, now + settings['freeze_run_time'], freeze_until[index])
+                pump_change[index] = np.where(start_cycle, now, pump_change[index])
+                switches[f'pump{index + 1}'] += start_cycle
+                freeze_cycles += start_cycle
+                state = state | start_cycle
+            pumps[index] = state
+            if speed is None:
+                pump_energy += state * low_power
+            else:
+                fixed_energy += DEVICE_POWER[f'pump{index + 1}'][speed]
+        jets = pumps[0] | pumps[1]
+
+        # automatic_heater_logic, on water_estimate
+        estimate = water
+        if stagnant is not None:
+            scale, tau = stagnant
+            off = np.where(jets, 0.0, now - np.maximum(pump_change[0], pump_change[1]))
+            estimate = water + np.clip(scale * (1 - np.exp(-off / tau)), -THERMAL_MAX_CORRECTION,
+                                       THERMAL_MAX_CORRECTION)
+        circ_on = (estimate < set_temperature) & ~circpump
+        circ_since = np.where(circ_on, now, circ_since)
+        switches['circpump'] += circ_on
+        circpump |= circ_on
+        flow = circpump | jets
+        active = flow & circpump
+        heater_on = (active & ~heater & (estimate < set_temperature - settings['heater_on_below'])
+                     & (now - circ_since >= np.maximum(settings['heater_circ_delay'], BACKTEST_HEATER_LOCKOUT))
+                     & (now - heater_change >= BACKTEST_HEATER_LOCKOUT))
+        heater_off = heater & (~active | (estimate > set_temperature + settings['heater_off_above']))
+        switches['heater'] += heater_on | heater_off
+        heater_change = np.where(heater_on | heater_off, now, heater_change)
+        heater = (heater | heater_on) & ~heater_off
+
+        # automatic_blower_logic
+        blower_on = ((cabinet > settings['blower_cabinet_on']) | (control_box > settings['blower_control_box_on'])
+                     | (pumps[0] & (now - pump_change[0] >= settings['blower_pump_delay']))
+                     | (pumps[1] & (now - pump_change[1] >= settings['blower_pump_delay']))
+                     | ozone | (water > set_temperature + settings['blower_water_on']))
+        blower_off = (~blower_on & (cabinet < settings['blower_cabinet_off'])
+                      & (control_box < settings['blower_control_box_off'])
+                      & (water < set_temperature + settings['blower_water_off']))
+        new_blower = (blower | blower_on) & ~blower_off
+        switches['blower'] += new_blower != blower
+        blower = new_blower
+
+        # automatic_fans_logic
+        fans_on = (cabinet > settings['fans_cabinet_on']) | (control_box > settings['fans_control_box_on']) | ozone
+        fans_off = (~fans_on & (cabinet < settings['fans_cabinet_off'])
+                    & (control_box < settings['fans_control_box_off']))
+        new_fans = (fans | fans_on) & ~fans_off
+        switches['fans'] += new_fans != fans
+        fans = new_fans
+
+        # the water over this step, the same model tub_thermal fits
+        equilibrium = ambient + (heating * (heater & flow) + jets_rate * jets) / loss
+        water = equilibrium + (water - equilibrium) * decay
+        offset = water - set_temperature
+        deviation += np.abs(offset)
+        cold += offset < -2
+        np.maximum(overshoot, offset, out=overshoot)
+        np.minimum(min_water, water, out=min_water)
+        seconds['heater'] += heater
+        seconds['circpump'] += circpump
+        seconds['blower'] += blower
+        seconds['fans'] += fans
+
+    steps = len(trace)
+    energy = (fixed_energy + pump_energy + sum(seconds[name] * DEVICE_POWER[name]['on'] for name in seconds)) * step
+    return {
+        'kwh': energy / 3.6e6,
+        'switches': sum(switches.values()),
+        'heater_switches': switches['heater'],
+        'pump_switches': switches['pump1'] + switches['pump2'],
+        'freeze_cycles': freeze_cycles,
+        'mean_deviation': deviation / steps,
+        'cold_hours': cold * step / 3600,
+        'max_overshoot': overshoot,
+        'min_water': min_water,
+        'blower_hours': seconds['blower'] * step / 3600,
+        'fans_hours': seconds['fans'] * step / 3600,
+        'heater_hours': seconds['heater'] * step / 3600,
+    }
+
+
+worker_trace = None
+
+
+def init_worker(trace: Trace, coefficients: tuple, stagnant: Optional[tuple]) -> None:
+    global worker_trace
+    worker_trace = (trace, coefficients, stagnant)
+
+
+def simulate_chunk(variants: List[dict]) -> Dict[str, object]:
+    trace, coefficients, stagnant = worker_trace
+    return simulate(trace, variants, coefficients, stagnant)
+
+
+def backtest(trace: Trace, variants: List[dict], coefficients: tuple = BACKTEST_COEFFICIENTS,
+             stagnant: Optional[tuple] = None, workers: int = 1) -> Dict[str, object]:
+    # with workers the variants are split into one chunk per process, each process gets the trace once
+    if workers <= 1 or len(variants) < 2 * workers:
+        return simulate(trace, variants, coefficients, stagnant)
+    size = math.ceil(len(variants) / workers)
+    chunks = [variants[i:i + size] for i in range(0, len(variants), size)]
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(trace, coefficients, stagnant)) as pool:
+        results = list(pool.map(simulate_chunk, chunks))
+    return {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+
+
+def report_rows(variants: List[dict], results: Dict[str, object]) -> List[dict]:
+    # one row per variant with the settings that differ from RULE_SETTINGS, the metrics, and the change in energy
+    # and relay switches against the first variant
+    rows = []
+    for i, variant in enumerate(variants):
+        row = {'variant': i, 'settings': {name: value for name, value in variant.items()
+                                          if value != RULE_SETTINGS[name]}}
+        for name in results:
+            value = results[name][i]
+            row[name] = int(value) if np.issubdtype(results[name].dtype, np.integer) else round(float(value), 3)
+        for name in ('kwh', 'switches'):
+            base = float(results[name][0])
+            row[f'{name}_change'] = round((float(results[name][i]) - base) / base * 100, 1) if base else None
+        rows.append(row)
+    return rows
+
+
+def print_report(rows: List[dict], sort: str = 'kwh', top: int = 20) -> None:
+    header = ['#'] + [name for name, _ in BACKTEST_METRICS] + ['kwh %', 'switch %', 'settings']
+    print('  '.join(header))
+    ordered = [rows[0]] + sorted(rows[1:], key=lambda row: row[sort])[:top]
+    for row in ordered:
+        cells = [str(row['variant'])] + [format(row[name], spec) for name, spec in BACKTEST_METRICS]
+        cells += [f"{row['kwh_change']:+.1f}", f"{row['switches_change']:+.1f}",
+                  ' '.join(f"{name}={value:g}" for name, value in row['settings'].items()) or 'current']
+        print('  '.join(cells))
+
+
+def parse_option(text: str) -> tuple:
+    name, _, values = text.partition('=')
+    return name, [float(value) for value in values.split(',') if value]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded or synthetic data against variants of the "
+                                                 "automatic rules and compare energy, relay cycles and temperatures")
+    parser.add_argument('--history', help="history database to replay, synthetic data when not given")
+    parser.add_argument('--start', help="local start time of the replay, e.g. 2024-01-01T00:00")
+    parser.add_argument('--end', help="local end time of the replay, defaults to now")
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--step', type=float, default=BACKTEST_STEP)
+    parser.add_argument('--ambient', type=float, default=40.0, help="synthetic mean ambient in F")
+    parser.add_argument('--swing', type=float, default=12.0, help="synthetic daily ambient swing in F")
+    parser.add_argument('--setpoint', type=float, default=102.0, help="synthetic set temperature in F")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vary', action='append', default=[], metavar='SETTING=V1,V2,...',
+                        help=f"values to try for one of {', '.join(RULE_SETTINGS)}")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--sort', default='kwh', choices=[name for name, _ in BACKTEST_METRICS])
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help="print every variant as a JSON line")
+    args = parser.parse_args()
+
+    end_time = datetime.fromisoformat(args.end).timestamp() if args.end else time.time()
+    start_time = datetime.fromisoformat(args.start).timestamp() if args.start else end_time - args.days * 86400
+    if args.history:
+        replay = load_trace(args.history, start_time, end_time, args.step)
+        fitted, correction = learned_model(args.history)
+    else:
+        replay = synthetic_trace(args.days, args.step, start_time, args.ambient, args.swing, args.setpoint,
+                                 seed=args.seed)
+        fitted, correction = BACKTEST_COEFFICIENTS, None
+    grid = [dict(RULE_SETTINGS)] + parameter_grid(dict(parse_option(option) for option in args.vary))
+    started = time.perf_counter()
+    outcome = backtest(replay, grid, fitted, correction, args.workers)
+    elapsed = time.perf_counter() - started
+    report = report_rows(grid, outcome)
+    if args.json:
+        for line in report:
+            print(json.dumps(line))
+    else:
+        print(f"{len(grid)} variants over {len(replay) * replay.step / 86400:.1f} days in {elapsed:.1f}s, "
+              f"coefficients {', '.join(f'{value:.3g}' for value in fitted)}, "
+              + (f"stagnant correction {correction[0]:+.2f}F over {correction[1] / 60:.0f} min" if correction
+                 else "no stagnant correction fitted"))
+        print_report(report, args.sort, args.top)
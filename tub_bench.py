@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from tub_sim import SimBackend
+
+BENCH_PROBE_INTERVAL = 0.25  # seconds between probe timers, so the loop has deadlines to be late for under any load
+BENCH_WARMUP = 3.0  # seconds of load before anything is recorded
+BENCH_STARTUP_TIMEOUT = 30  # seconds the server gets to answer its first request
+BENCH_REPORT_TIMEOUT = 30  # seconds to wait for the server's numbers after it was told to stop
+BENCH_WRITE_DEVICES = ['light']
+BENCH_REGRESSION = 10  # percent a metric may move the wrong way before the comparison flags it
+# which way is better for the flat metrics, by name suffix, counts and sizes only depend on the config
+BENCH_LOWER_IS_BETTER = ('_ms', 'errors', 'disconnects', 'server', 'client')
+BENCH_HIGHER_IS_BETTER = ('per_second', 'coverage')
+
+
+def percentile(ordered: List[float], q: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def summary(seconds: List[float]) -> dict:
+    ordered = sorted(seconds)
+    result = {'count': len(ordered)}
+    for name, q in (('p50_ms', 50), ('p99_ms', 99), ('max_ms', 100)):
+        value = percentile(ordered, q)
+        result[name] = None if value is None else round(value * 1000, 2)
+    return result
+
+
+class ServerStats:
+    # collected inside the server process: how long each control tick took, how late timers fired, and the wall
+    # time every state version was published at, which the clients turn into broadcast lag
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ticks = []
+        self.late = []
+        self.published = {}
+        self.cpu_start = time.process_time()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.ticks = []
+            self.late = []
+            self.cpu_start = time.process_time()
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                'tick': summary(self.ticks),
+                'timer_late': summary(self.late),
+                'published': self.published,
+                'cpu_seconds': round(time.process_time() - self.cpu_start, 2),
+            }
+
+
+def instrument(system, timers, feed, stats: ServerStats) -> None:
+    tick = system.tick
+    pop_due = timers.pop_due
+    publish = feed.publish
+
+    def timed_tick(reasons):
+        started = time.perf_counter()
+        tick(reasons)
+        with stats.lock:
+            stats.ticks.append(time.perf_counter() - started)
+
+    def timed_pop_due(now):
+        due = pop_due(now)
+        fired = time.time()
+        with stats.lock:
+            stats.late.extend(fired - timer.deadline for timer in due)
+        return due
+
+    def timed_publish(state):
+        changed = publish(state)
+        if changed:
+            stats.published[feed.version] = time.time()
+        return changed
+
+    def probe():
+        timers.call_later(BENCH_PROBE_INTERVAL, probe, name='bench probe')
+
+    system.tick = timed_tick
+    timers.pop_due = timed_pop_due
+    feed.publish = timed_publish  # before the API's lifespan subscribes it to the control loop
+    probe()
+
+
+def serve(port: int, history_path: str, connection) -> None:
+    # the server process: the real control loop on a simulated tub in real time, with the API in front of it the
+    # same way main.py runs them. takes 'reset' and 'stop' over the pipe and answers 'stop' with its numbers
+    import uvicorn
+    import tub_api
+    import tub_control
+    from tub_history import HistoryStore
+    logging.getLogger().setLevel(logging.WARNING)
+    system = tub_control.init_system(SimBackend(tub_control.clock))
+    store = HistoryStore(history_path)
+    store.flush_hooks = system.history.flush_hooks
+    system.history = store
+    stats = ServerStats()
+    instrument(system, tub_control.timers, tub_api.feed, stats)
+    threading.Thread(target=tub_control.start_tub_system, name='tub_loop', daemon=True).start()
+    server = uvicorn.Server(uvicorn.Config(tub_api.app, host='127.0.0.1', port=port, log_level='warning'))
+
+    def commands():
+        while True:
+            command = connection.recv()
+            if command == 'reset':
+                stats.reset()
+            elif command == 'stop':
+                server.should_exit = True
+                return
+    threading.Thread(target=commands, name='bench_commands', daemon=True).start()
+    server.run()
+    connection.send(stats.report())
+    tub_control.stop_tub_system()
+    store.stop()
+
+
+class Recorder:
+    # collected in the client process, nothing counts until the warmup is over
+    def __init__(self):
+        self.recording = False
+        self.started = None
+        self.latencies = {}
+        self.errors = {}
+        self.receipts = []  # (subscriber, version, wall time)
+        self.messages = 0
+        self.bytes = 0
+        self.disconnects = 0
+
+    def start(self) -> None:
+        self.recording = True
+        self.started = time.perf_counter()
+
+    def request(self, name: str, seconds: float, ok: bool) -> None:
+        if not self.recording:
+            return
+        self.latencies.setdefault(name, []).append(seconds)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def receipt(self, subscriber: int, version: Optional[int], received: float, size: int) -> None:
+        if not self.recording:
+            return
+        self.messages += 1
+        self.bytes += size
+        self.receipts.append((subscriber, version, received))
+
+
+async def subscriber(index: int, url: str, recorder: Recorder) -> None:
+    import websockets
+    decode = json.loads
+    if 'encoding=msgpack' in url:
+        import msgpack
+        decode = msgpack.unpackb
+    try:
+        async with websockets.connect(url, max_size=None) as websocket:
+            async for message in websocket:
+                received = time.time()
+                recorder.receipt(index, decode(message).get('version'), received, len(message))
+    except websockets.ConnectionClosed:
+        recorder.disconnects += 1
+
+
+async def poller(base_url: str, path: str, interval: float, recorder: Recorder) -> None:
+    import httpx
+    etag = None
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await client.get(path, headers={'If-None-Match': etag} if etag else {})
+                ok = response.status_code in (200, 304)
+                etag = response.headers.get('etag', etag)
+            except httpx.HTTPError:
+                ok = False
+            recorder.request(path.strip('/'), time.perf_counter() - started, ok)
+            await asyncio.sleep(interval)
+
+
+async def writer(base_url: str, devices: List[str], interval: float, wait: bool, recorder: Recorder) -> None:
+    # toggles a device and then sets it off again, so every other request changes something
+    import httpx
+    params = {'wait': 'true'} if wait else {}
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        count = 0
+        while True:
+            device = devices[count // 2 % len(devices)]
+            if count % 2 == 0:
+                name, request = 'toggle', client.post(f'/toggle/{device}', params=params)
+            else:
+                name, request = 'set', client.post(f'/set/{device}', params=params, json={'state': 'off'})
+            count += 1
+            started = time.perf_counter()
+            try:
+                response = await request
+                body = response.json()
+                ok = response.status_code == 200 and body.get('status') == 'success'
+                ok = ok and not (wait and body.get('command_status') in ('queued', 'failed'))
+            except (httpx.HTTPError, ValueError):
+                ok = False
+            recorder.request(name, time.perf_counter() - started, ok)
+            await asyncio.sleep(interval)
+
+
+async def wait_until_ready(base_url: str) -> None:
+    import httpx
+    deadline = time.monotonic() + BENCH_STARTUP_TIMEOUT
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                if (await client.get('/quick_state')).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"server did not answer within {BENCH_STARTUP_TIMEOUT}s")
+            await asyncio.sleep(0.2)
+
+
+async def drive(port: int, args, connection) -> Recorder:
+    base_url = f'http://127.0.0.1:{port}'
+    await wait_until_ready(base_url)
+    recorder = Recorder()
+    ws_url = f'ws://127.0.0.1:{port}/state?protocol=delta&encoding={args.encoding}'
+    tasks = [asyncio.create_task(subscriber(index, ws_url, recorder)) for index in range(args.subscribers)]
+    tasks += [asyncio.create_task(poller(base_url, args.poll_path, args.poll_interval, recorder))
+              for _ in range(args.pollers)]
+    tasks += [asyncio.create_task(writer(base_url, args.devices, args.write_interval, args.wait, recorder))
+              for _ in range(args.writers)]
+    await asyncio.sleep(args.warmup)
+    connection.send('reset')
+    recorder.start()
+    await asyncio.sleep(args.duration)
+    recorder.recording = False
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return recorder
+
+
+def broadcast_lag(recorder: Recorder, published: Dict[int, float], subscribers: int) -> dict:
+    lags = [received - published[version] for _, version, received in recorder.receipts if version in published]
+    seen = {(index, version) for index, version, _ in recorder.receipts}
+    versions = {version for _, version, _ in recorder.receipts}
+    # share of the versions published while recording that each subscriber got, the rest were coalesced away
+    window = [version for version in published if versions and min(versions) <= version <= max(versions)]
+    coverage = len(seen) / (len(window) * subscribers) if window and subscribers else None
+    result = {'subscribers': subscribers, 'messages': recorder.messages, 'bytes': recorder.bytes,
+              'versions': len(window), 'coverage': None if coverage is None else round(coverage, 3),
+              'disconnects': recorder.disconnects}
+    result.update({f'lag_{name}': value for name, value in summary(lags).items() if name != 'count'})
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(document: dict, prefix: str = '') -> dict:
+    flat = {}
+    for name, value in document.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{name}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{name}'] = value
+    return flat
+
+
+def run_benchmark(args) -> dict:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    context = multiprocessing.get_context('spawn')
+    connection, child_connection = context.Pipe()
+    with tempfile.TemporaryDirectory() as directory:
+        server = context.Process(target=serve, args=(port, os.path.join(directory, 'history.db'), child_connection),
+                                 daemon=True)
+        server.start()
+        client_cpu = time.process_time()
+        try:
+            recorder = asyncio.run(drive(port, args, connection))
+            client_cpu = time.process_time() - client_cpu
+            connection.send('stop')
+            if not connection.poll(BENCH_REPORT_TIMEOUT):
+                raise RuntimeError("server did not report back")
+            stats = connection.recv()
+        finally:
+            server.join(BENCH_REPORT_TIMEOUT)
+            if server.is_alive():
+                server.terminate()
+    elapsed = time.perf_counter() - recorder.started
+    endpoints = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        endpoints[name] = summary(latencies)
+        endpoints[name]['per_second'] = round(len(latencies) / elapsed, 1)
+        endpoints[name]['errors'] = recorder.errors.get(name, 0)
+    published = {int(version): at for version, at in stats['published'].items()}
+    result = {
+        'commit': git_commit(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'config': {name: getattr(args, name) for name in ('subscribers', 'pollers', 'poll_path', 'poll_interval',
+                                                          'writers', 'write_interval', 'devices', 'wait',
+                                                          'encoding', 'duration', 'warmup')},
+        'endpoints': endpoints,
+        'websocket': broadcast_lag(recorder, published, args.subscribers),
+        'loop': {'ticks_per_second': round(stats['tick']['count'] / elapsed, 1),
+                 'tick': stats['tick'], 'timer_late': stats['timer_late']},
+        'cpu_seconds': {'server': stats['cpu_seconds'], 'client': round(client_cpu, 2)},
+    }
+    result['metrics'] = flatten({name: result[name] for name in ('endpoints', 'websocket', 'loop', 'cpu_seconds')})
+    return result
+
+
+def compare(baseline: dict, result: dict) -> None:
+    # ! marks a metric that got worse by more than BENCH_REGRESSION percent
+    if baseline.get('config') != result['config']:
+        print("warning: the baseline ran with a different load, the numbers are not comparable")
+    print(f"{'metric':<36}{'baseline':>16}{'current':>16}{'change':>9}")
+    print(f"{'commit':<36}{str(baseline.get('commit')):>16}{str(result.get('commit')):>16}")
+    for name, value in result['metrics'].items():
+        before = baseline.get('metrics', {}).get(name)
+        if before is None or value is None:
+            continue
+        change = (value - before) / before * 100 if before else (0.0 if value == before else math.inf)
+        if name.endswith(BENCH_LOWER_IS_BETTER):
+            worse = change > BENCH_REGRESSION
+        else:
+            worse = name.endswith(BENCH_HIGHER_IS_BETTER) and change < -BENCH_REGRESSION
+        print(f"{name:<36}{before:>16g}{value:>16g}{change:>+8.1f}%{' !' if worse else ''}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the API with WebSocket subscribers, pollers and command "
+                                                 "writers against a simulated tub and measure the API and the "
+                                                 "control loop")
+    parser.add_argument('--subscribers', type=int, default=20, help="delta WebSocket clients on /state")
+    parser.add_argument('--pollers', type=int, default=5)
+    parser.add_argument('--poll-path', default='/quick_state', choices=['/quick_state', '/full_state'])
+    parser.add_argument('--poll-interval', type=float, default=0.5, help="seconds between polls, 0 for flat out")
+    parser.add_argument('--writers', type=int, default=1)
+    parser.add_argument('--write-interval', type=float, default=1.0)
+    parser.add_argument('--devices', default=','.join(BENCH_WRITE_DEVICES), type=lambda text: text.split(','),
+                        help="comma separated devices the writers toggle")
+    parser.add_argument('--wait', action='store_true', help="writers wait for the control loop to apply commands")
+    parser.add_argument('--encoding', default='json', choices=['json', 'msgpack'])
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=BENCH_WARMUP)
+    parser.add_argument('--output', help="write the results here as JSON, they go to stdout otherwise")
+    parser.add_argument('--compare', metavar='BASELINE', help="results of an earlier run to compare against")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    outcome = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(outcome, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), outcome)
+    elif not args.output:
+        print(json.dumps(outcome, indent=2))
@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+COMMAND_HISTORY = 200  # finished commands kept around so clients can still look them up
+
+
+class Command:
+    def __init__(self, command_id: int, device: str, action: str, value=None):
+        self.id = command_id
+        self.device = device
+        self.action = action  # 'set', 'toggle' or 'advance'
+        self.value = value
+        self.status = 'queued'
+        self.result = None
+        self.submitted_time = time.time()
+        self.completed_time = None
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def done(self) -> bool:
+        return self.completed_time is not None
+
+    def complete(self, status: str, result=None) -> None:
+        with self.lock:
+            if self.done():
+                return
+            self.status = status
+            self.result = result
+            self.completed_time = time.time()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback: Callable[['Command'], None]) -> None:
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    async def wait(self, timeout: float) -> bool:
+        # completion happens on the control thread, hand it back to the caller's event loop
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(command: 'Command') -> None:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(command))
+
+        self.add_done_callback(resolve)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def to_dict(self) -> dict:
+        return {
+            'command_id': self.id,
+            'device': self.device,
+            'action': self.action,
+            'value': self.value,
+            'status': self.status,
+            'result': self.result,
+            'submitted_time': self.submitted_time,
+            'completed_time': self.completed_time,
+        }
+
+
+class CommandQueue:
+    def __init__(self, history: int = COMMAND_HISTORY):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = []
+        self.commands = OrderedDict()
+        self.history = history
+        self.listeners = []
+
+    def submit(self, device: str, action: str, value=None) -> Command:
+        with self.lock:
+            command = Command(next(self.ids), device, action, value)
+            self.pending.append(command)
+            self.commands[command.id] = command
+            self.trim()
+        for listener in self.listeners:
+            listener(command)
+        return command
+
+    def submit_batch(self, items: List[tuple]) -> List[Command]:
+        # (device, action, value) items queued under one lock so they are all drained by the same tick
+        with self.lock:
+            commands = [Command(next(self.ids), device, action, value) for device, action, value in items]
+            self.pending.extend(commands)
+            for command in commands:
+                self.commands[command.id] = command
+            self.trim()
+        for listener in self.listeners:
+            listener(commands[0])
+        return commands
+
+    def trim(self) -> None:
+        # called with the lock held, drops the oldest finished commands past the history size
+        while len(self.commands) > self.history:
+            oldest = next(iter(self.commands.values()))
+            if not oldest.done():
+                break
+            self.commands.popitem(last=False)
+
+    def drain(self) -> List[Command]:
+        with self.lock:
+            pending, self.pending = self.pending, []
+        return pending
+
+    def get(self, command_id: int) -> Optional[Command]:
+        return self.commands.get(command_id)
@@ -1,79 +1,284 @@
 import sys
 import os
+import math
 import time
 import logging
 import signal
-import sched
 import asyncio
 import threading
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 from multiprocessing import Manager
-import board
-import busio
-import digitalio
-from adafruit_mcp230xx.mcp23017 import MCP23017
 from datetime import datetime, timedelta
-import requests
-import json
+from tub_commands import CommandQueue
+from tub_timers import TimerService
+from tub_events import Wakeup
+from tub_history import HistoryStore, HISTORY_INTERVAL
+from tub_usage import UsageAccounting
+from tub_filters import SensorFilter
+from tub_notify import Notifier, DiscordSink
+from tub_alerts import AlertEngine, load_rules
+from tub_thermal import ThermalModel
+from tub_hal import SystemClock, PiBackend
+from tub_metrics import registry
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize the I2C bus
-i2c = busio.I2C(board.SCL, board.SDA)
-mcp = MCP23017(i2c, address=0x20)  # MCP23017 w/ A0 set
-
-# Globally set the directory where the sensor data resides
-os.system('modprobe w1-gpio')
-os.system('modprobe w1-therm')
-base_dir = '/sys/bus/w1/devices/'
+# the hardware and the clock everything runs on, both set up by init_system(). nothing touches the board at import
+# time, tub_hal.PiBackend is the real one and tub_sim.SimBackend a simulated tub
+backend = None
+clock = SystemClock()
+# set by fatal_error and never cleared: a faulted system keeps every output off until the process is restarted
+fault = None
+
+# 1-wire address of each temperature probe e.g. 28-000000000000
+SENSOR_IDS = {
+    'water': '',
+    'heater1': '',
+    'heater2': '',
+    'ambient': '',
+    'cabinet': '',
+    'control_box': '',
+}
+SENSOR_INTERVAL = 1.0  # default seconds between samples of a temperature sensor
+W1_CRC_RETRIES = 3
+# DS18B20 conversion time in seconds for each resolution in bits
+W1_CONVERSION_TIME = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
+
+# BCM pin on the pi wired to the MCP23017 INTB output, None polls the flow switch over I2C instead
+FLOW_INTERRUPT_GPIO = None
+FLOW_DEBOUNCE = 0.05  # seconds flow must be stable before it counts as restored
+FLOW_RESYNC_INTERVAL = 5  # seconds between safety reads in interrupt mode, covers a missed edge
+
+# wake the control loop on sensor, flow, command and timer events instead of polling on a fixed tick
+EVENT_DRIVEN_LOOP = True
+LOOP_INTERVAL = 0.2  # fixed tick, and the safety net interval while the flow switch is polled
+LOOP_MAX_INTERVAL = 1.0  # safety net interval when every input raises its own events
+# seconds a command waits for more commands to coalesce with, e.g. a second tap in the UI, before it is applied
+COMMAND_WINDOW = 0.3
+
+# order device changes are applied within one tick: heat sources go off first and on last, the circ pump
+# comes on before anything that depends on it
+SHUTDOWN_ORDER = ['heater', 'ozone', 'blower', 'fans', 'light', 'pump1', 'pump2', 'circpump']
+STARTUP_ORDER = ['circpump', 'pump1', 'pump2', 'blower', 'fans', 'light', 'ozone', 'heater']
+
+# thresholds of the automatic rules, F and seconds. tub_backtest replays recorded or synthetic data against variants
+# of these before any of them change here
+RULE_SETTINGS = {
+    'heater_on_below': 1.0,  # heater comes on this far below the set temperature
+    'heater_off_above': 0.0,  # and goes off this far above it
+    'heater_circ_delay': 60,  # circ pump runtime before the heater may start
+    'blower_cabinet_on': 90,
+    'blower_control_box_on': 100,
+    'blower_cabinet_off': 80,
+    'blower_control_box_off': 90,
+    'blower_pump_delay': 30,  # main pump runtime before the blower follows it
+    'blower_water_on': 3,  # above the set temperature, the blower sheds heat
+    'blower_water_off': 2,
+    'fans_cabinet_on': 85,
+    'fans_control_box_on': 90,
+    'fans_cabinet_off': 80,
+    'fans_control_box_off': 80,
+    'freeze_temperature': 20,  # ambient below which the main pumps get cycled
+    'freeze_pump1_interval': 4 * 60 * 60,  # idle time before pump1 gets a freeze cycle
+    'freeze_pump2_interval': 60,
+    'freeze_run_time': 60,  # length of a freeze cycle
+}
+
+# control rules, whether they only run in automatic mode, and the events that can change their outcome.
+# a 'periodic' wake runs all of them, which also covers the rules that depend on elapsed time
+CONTROL_RULES = [
+    ('automatic_heater_logic', True, {'sensors', 'flow', 'setpoint', 'mode', 'devices'}),
+    ('automatic_blower_logic', True, {'sensors', 'setpoint', 'mode', 'devices'}),
+    ('automatic_fans_logic', True, {'sensors', 'mode', 'devices'}),
+    ('freeze_protection', True, {'sensors', 'mode'}),
+]
 
 # set up the discord webhook
 DISCORD_WEBHOOK_URL = ""
-
-# Initialize scheduler
-scheduler = sched.scheduler(time.time, time.sleep)
+notifier = Notifier([DiscordSink(DISCORD_WEBHOOK_URL)] if DISCORD_WEBHOOK_URL else [])
+
+# Initialize the timer service, every timer in the system fires from the control loop
+timers = TimerService(lambda: clock.time())
+
+# runtime, relay starts and energy per device, fed by every state transition
+usage = UsageAccounting(lambda: clock.time())
+
+# loop health for /metrics, see tub_metrics. the tick phases are the ones tick() runs, in order
+TICK_PHASES = (['timers', 'commands', 'temp_sensor_update', 'sampling_update'] + [rule for rule, _, _ in CONTROL_RULES]
+               + ['heater_high_limit_check', 'flow_check', 'commit', 'alerts', 'listeners'])
+tick_seconds = registry.histogram('hotcon_tick_seconds', "Time spent in one control loop tick").labels()
+tick_phase_seconds = registry.histogram('hotcon_tick_phase_seconds', "Time spent in each phase of a control loop tick",
+                                        ['phase'])
+sensor_read_seconds = registry.histogram('hotcon_sensor_read_seconds',
+                                         "Time taken by one 1-wire temperature read, CRC retries included", ['sensor'])
+sensor_crc_retries = registry.counter('hotcon_sensor_crc_retries_total', "1-wire reads repeated after a bad CRC",
+                                      ['sensor'])
+sensor_crc_failures = registry.counter('hotcon_sensor_crc_failures_total',
+                                       "1-wire reads that still had a bad CRC after every retry", ['sensor'])
+relay_transitions = registry.counter('hotcon_relay_transitions_total', "Relay contacts switched, per device",
+                                     ['device'])
+registry.gauge('hotcon_last_tick_age_seconds', "Seconds since the control loop last finished a tick",
+               lambda: clock.time() - cs.loop_time if cs is not None else None)
 
 
 # Function to handle fatal errors and cleanup before exiting
 def fatal_error(message):
-    cs.cleanup()
+    global fault
+    if fault is None:
+        fault = message
+        if cs is not None:
+            cs.cleanup()
     send_discord_hook(message)
     logger.critical(message)
 
 
+def above(value: Optional[float], limit: float) -> bool:
+    # an unknown reading is neither above nor below anything, the rules leave a device as it is on one
+    return value is not None and value > limit
+
+
+def below(value: Optional[float], limit: float) -> bool:
+    return value is not None and value < limit
+
+
 def send_discord_hook(message):
-    if DISCORD_WEBHOOK_URL != '':
-        data = {"content": message}
-        response = requests.post(DISCORD_WEBHOOK_URL, data=json.dumps(data), headers={"Content-Type": "application/json"})
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as err:
-            print(f"HTTPError: {err}")
+    # only queues the message, the notifier thread does the network work
+    notifier.notify(message)
 
 
 def schedule_task_at(hour: int, minute: int, func, *args):
-    now = datetime.now()
+    now = clock.now()
     target_time = datetime.combine(now.date(), datetime.min.time()) + timedelta(hours=hour, minutes=minute)
-    if target_time < now:
+    if target_time <= now:
         target_time += timedelta(days=1)  # Schedule for the next day if the target time already passed today
-    delay = (target_time - now).total_seconds()
-    scheduler.enter(delay, 1, func, args)
+    timers.call_at(target_time.timestamp(), func, *args, name=f"{func.__qualname__} at {hour:02}:{minute:02}",
+                   reason='devices')
     return target_time
 
 
+class ShadowPin:
+    def __init__(self, bank: 'OutputBank', number: int):
+        self.bank = bank
+        self.number = number
+
+    @property
+    def value(self) -> bool:
+        return self.bank.get(self.number)
+
+    @value.setter
+    def value(self, new_value: bool) -> None:
+        self.bank.set(self.number, new_value)
+
+
+class OutputBank:
+    # in-memory copy of the GPIOA/GPIOB output latches. pin writes only touch the shadow and commit() pushes
+    # each changed port to the chip in a single register write
+    def __init__(self, hardware):
+        self.hardware = hardware
+        self.lock = threading.RLock()
+        self.latch = [hardware.read_port(0), hardware.read_port(1)]
+        self.shadow = list(self.latch)
+        self.switch_counters = {}  # pin number -> relay_transitions counter of the device it drives
+
+    def pin(self, number: int, device: str) -> ShadowPin:
+        self.hardware.setup_output(number)
+        port, mask = number // 8, 1 << (number % 8)
+        with self.lock:
+            self.latch[port] &= ~mask
+            self.shadow[port] &= ~mask
+        self.switch_counters[number] = relay_transitions.labels(device)
+        return ShadowPin(self, number)
+
+    def count_switches(self, port: int) -> None:
+        changed = self.shadow[port] ^ self.latch[port]
+        while changed:
+            bit = changed & -changed
+            counter = self.switch_counters.get(port * 8 + bit.bit_length() - 1)
+            if counter is not None:
+                counter.inc()
+            changed ^= bit
+
+    def get(self, number: int) -> bool:
+        return bool(self.shadow[number // 8] & (1 << (number % 8)))
+
+    def all_off(self) -> None:
+        with self.lock:
+            for number in self.switch_counters:
+                self.set(number, False)
+
+    def set(self, number: int, value: bool) -> None:
+        port, mask = number // 8, 1 << (number % 8)
+        with self.lock:
+            if value:
+                self.shadow[port] |= mask
+            else:
+                self.shadow[port] &= ~mask
+
+    def commit(self) -> int:
+        writes = 0
+        with self.lock:
+            if self.shadow[0] != self.latch[0]:
+                self.count_switches(0)
+                self.hardware.write_port(0, self.shadow[0])
+                self.latch[0] = self.shadow[0]
+                writes += 1
+            if self.shadow[1] != self.latch[1]:
+                self.count_switches(1)
+                self.hardware.write_port(1, self.shadow[1])
+                self.latch[1] = self.shadow[1]
+                writes += 1
+        return writes
+
+
+outputs = None
+
+
+class RelaySequence:
+    # relay steps that have to be spaced out in time, run from the timer service instead of sleeping.
+    # each delay counts from the previous step so a late tick never squeezes two steps into one commit
+    def __init__(self, name: str):
+        self.name = name
+        self.steps = []
+        self.timer = None
+
+    def start(self, steps: List[Tuple[float, callable]]) -> None:
+        self.cancel()
+        self.steps = list(steps)
+        self.schedule_next()
+
+    def schedule_next(self) -> None:
+        if self.steps:
+            self.timer = timers.call_later(self.steps[0][0], self.run_step, name=f"{self.name} relay sequence",
+                                           reason='devices')
+
+    def run_step(self) -> None:
+        _, step = self.steps.pop(0)
+        step()
+        self.schedule_next()
+
+    def cancel(self) -> None:
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.steps = []
+
+    def busy(self) -> bool:
+        return bool(self.steps)
+
+
 class Heater:
     def __init__(self):
         self.name = 'heater'
-        self.pin = mcp.get_pin(7)
-        self.pin.switch_to_output(value=False)
+        self.pin = outputs.pin(7, self.name)
         self.internal_state = False
-        self.last_change_time = time.time()
+        self.last_change_time = clock.time()
 
     def set_state(self, new_state: bool) -> None:
-        circ_pump_runtime = time.time() - cs.circpump.last_change_time
-        lockout_timer = time.time() - self.last_change_time
+        circ_pump_runtime = clock.time() - cs.circpump.last_change_time
+        lockout_timer = clock.time() - self.last_change_time
         if new_state and not cs.circpump.get_state():
             logger.info("Circ pump is not running. Make sure the circ pump runs at least 60 seconds before turning "
                         "the heater on. aborting.")
@@ -85,7 +290,8 @@ class Heater:
         else:
             self.pin.value = new_state
             self.internal_state = new_state
-            self.last_change_time = time.time()
+            usage.transition(self.name, self.internal_state)
+            self.last_change_time = clock.time()
             logger.info(f"Heater state set to {new_state}")
 
     def get_state(self) -> bool:
@@ -101,21 +307,32 @@ class Heater:
 class Circ_Pump:
     def __init__(self):
         self.name = 'circpump'
-        self.pin = mcp.get_pin(2)
-        self.pin.switch_to_output(value=False)
+        self.pin = outputs.pin(2, self.name)
         self.internal_state = False
-        self.last_change_time = time.time()
+        self.target = False
+        self.sequence = RelaySequence(self.name)
+        self.last_change_time = clock.time()
 
     def set_state(self, new_state: bool) -> None:
+        self.sequence.cancel()
+        self.target = new_state
         if not new_state and cs.heater.get_state():
-            # heater is on, we need to shut it off
+            # heater is on, we need to shut it off and keep the water moving for a bit before stopping
             cs.heater.set_state(False)
-            time.sleep(5)
+            self.sequence.start([(5, lambda: self.apply_state(False))])
+            return
+        self.apply_state(new_state)
+
+    def apply_state(self, new_state: bool) -> None:
         self.pin.value = new_state
         self.internal_state = new_state
-        self.last_change_time = time.time()
+        usage.transition(self.name, self.internal_state)
+        self.last_change_time = clock.time()
         logger.info(f"Circulation pump state set to {new_state}")
 
+    def get_target(self):
+        return self.target
+
     def get_state(self) -> bool:
         return self.internal_state
 
@@ -129,81 +346,84 @@ class Circ_Pump:
 class Main_Pump:
     def __init__(self, name: str, high_speed_pin: int, low_speed_pin: int):
         self.name = name
-        self.high_speed_pin = mcp.get_pin(high_speed_pin)
-        self.high_speed_pin.switch_to_output(value=False)
-        self.low_speed_pin = mcp.get_pin(low_speed_pin)
-        self.low_speed_pin.switch_to_output(value=False)
+        self.high_speed_pin = outputs.pin(high_speed_pin, name)
+        self.low_speed_pin = outputs.pin(low_speed_pin, name)
         self.internal_state = 'off'
+        self.target = 'off'
+        self.sequence = RelaySequence(self.name)
         self.timer = None
         self.filter_cycle_timer = None
         self.no_freeze_timer = None
-        self.last_change_time = time.time()
+        self.last_change_time = clock.time()
         if self.name == 'pump1':
             next_time = schedule_task_at(3, 0, self.auto_filter_cycle)
             logger.info(f"{self.name} next filter cycle scheduled at {next_time}")
 
     def set_state(self, new_state: bool, new_speed: str = 'low') -> None:
+        self.sequence.cancel()
         if not new_state:
             self.low_speed_pin.value = False
             self.high_speed_pin.value = False
             self.internal_state = 'off'
+            usage.transition(self.name, self.internal_state)
         elif new_state and new_speed == 'low':
             if self.high_speed_pin.value:
                 self.high_speed_pin.value = False
-                time.sleep(0.1)
-            self.low_speed_pin.value = True
-            self.internal_state = 'low'
+                self.sequence.start([(0.1, lambda: self.engage('low'))])
+            else:
+                self.engage('low')
         elif new_state and new_speed == 'high':
             if not (self.low_speed_pin.value or self.high_speed_pin.value):
-                self.low_speed_pin.value = True
-                time.sleep(1)
-            if self.low_speed_pin.value:
+                # start on low and step up to high once the motor is turning
+                self.engage('low')
+                self.sequence.start([(1, self.drop_low), (0.1, lambda: self.engage('high'))])
+            elif self.low_speed_pin.value:
                 self.low_speed_pin.value = False
-                time.sleep(0.1)
-            self.high_speed_pin.value = True
-            self.internal_state = 'high'
+                self.sequence.start([(0.1, lambda: self.engage('high'))])
+            else:
+                self.engage('high')
+        self.target = new_speed if new_state else 'off'
         self.reset_timer()
-        self.last_change_time = time.time()
+        self.last_change_time = clock.time()
         if new_state:
             logger.info(f"Main pump {self.name} state set to {new_state} with speed {new_speed}")
         else:
             logger.info(f"Main pump {self.name} state set to {new_state}")
 
-    def advance_state(self) -> None:
-        if not self.high_speed_pin.value and not self.low_speed_pin.value:
+    def engage(self, speed: str) -> None:
+        if speed == 'low':
             self.low_speed_pin.value = True
-            self.internal_state = 'low'
-        elif self.low_speed_pin.value:
-            self.low_speed_pin.value = False
-            time.sleep(0.1)
-            self.high_speed_pin.value = True
-            self.internal_state = 'high'
         else:
-            self.high_speed_pin.value = False
-            self.internal_state = 'off'
-        self.reset_timer()
-        self.last_change_time = time.time()
+            self.high_speed_pin.value = True
+        self.internal_state = speed
+        usage.transition(self.name, self.internal_state)
+
+    def drop_low(self) -> None:
+        self.low_speed_pin.value = False
+
+    def advance_state(self) -> None:
+        next_state = {'off': 'low', 'low': 'high', 'high': 'off'}[self.target]
+        self.set_state(next_state != 'off', next_state if next_state != 'off' else 'low')
         logger.info(f"Main pump {self.name} state advanced")
 
     def no_freeze_cycle(self) -> None:
         if not self.high_speed_pin.value and not self.low_speed_pin.value:
-            self.low_speed_pin.value = True
-            self.internal_state = 'low'
+            self.engage('low')
+            self.target = 'low'
             self.reset_freeze_timer()
-            self.last_change_time = time.time()
+            self.last_change_time = clock.time()
             logger.info(f"Main pump {self.name} no freeze cycle starting")
 
     def reset_timer(self) -> None:
         if self.timer:
             self.timer.cancel()
-        self.timer = threading.Timer(20 * 60, self.auto_turn_off)
-        self.timer.start()
+        self.timer = timers.call_later(20 * 60, self.auto_turn_off, name=f"{self.name} auto off", reason='devices')
 
     def reset_freeze_timer(self) -> None:
         if self.no_freeze_timer:
             self.no_freeze_timer.cancel()
-        self.no_freeze_timer = threading.Timer(1 * 60, self.auto_turn_off)
-        self.no_freeze_timer.start()
+        self.no_freeze_timer = timers.call_later(RULE_SETTINGS['freeze_run_time'], self.auto_turn_off,
+                                                 name=f"{self.name} no freeze off", reason='devices')
 
     def auto_turn_off(self) -> None:
         if self.high_speed_pin.value or self.low_speed_pin.value:
@@ -212,7 +432,7 @@ class Main_Pump:
 
     def auto_filter_cycle(self) -> None:
         if not self.high_speed_pin.value and not self.low_speed_pin.value:
-            if time.time() - self.last_change_time > 60 * 60:
+            if clock.time() - self.last_change_time > 60 * 60:
                 self.set_state(True, 'high')
                 logger.info(f"Main pump {self.name} auto filter cycle activated")
         # Schedule the next filter cycle at 3 AM
@@ -222,6 +442,9 @@ class Main_Pump:
     def get_state(self) -> str:
         return self.internal_state
 
+    def get_target(self) -> str:
+        return self.target
+
     def cleanup(self) -> None:
         self.set_state(False)
         if self.timer:
@@ -233,15 +456,15 @@ class Main_Pump:
 class Blower:
     def __init__(self):
         self.name = 'blower'
-        self.pin = mcp.get_pin(1)
-        self.pin.switch_to_output(value=False)
+        self.pin = outputs.pin(1, self.name)
         self.internal_state = False
-        self.last_change_time = time.time()
+        self.last_change_time = clock.time()
 
     def set_state(self, new_state: bool) -> None:
         self.pin.value = new_state
         self.internal_state = new_state
-        self.last_change_time = time.time()
+        usage.transition(self.name, self.internal_state)
+        self.last_change_time = clock.time()
         logger.info(f"Blower state set to {new_state}")
 
     def get_state(self) -> bool:
@@ -257,15 +480,15 @@ class Blower:
 class Fans:
     def __init__(self):
         self.name = 'fans'
-        self.pin = mcp.get_pin(10)
-        self.pin.switch_to_output(value=False)
+        self.pin = outputs.pin(10, self.name)
         self.internal_state = False
-        self.last_change_time = time.time()
+        self.last_change_time = clock.time()
 
     def set_state(self, new_state: bool) -> None:
         self.pin.value = new_state
         self.internal_state = new_state
-        self.last_change_time = time.time()
+        usage.transition(self.name, self.internal_state)
+        self.last_change_time = clock.time()
         logger.info(f"Fans state set to {new_state}")
 
     def get_state(self) -> bool:
@@ -281,16 +504,16 @@ class Fans:
 class Light:
     def __init__(self):
         self.name = 'light'
-        self.pin = mcp.get_pin(0)
-        self.pin.switch_to_output(value=False)
+        self.pin = outputs.pin(0, self.name)
         self.internal_state = False
         self.timer = None
-        self.last_change_time = time.time()
+        self.last_change_time = clock.time()
 
     def set_state(self, new_state: bool) -> None:
         self.pin.value = new_state
         self.internal_state = new_state
-        self.last_change_time = time.time()
+        usage.transition(self.name, self.internal_state)
+        self.last_change_time = clock.time()
         self.reset_timer()
         logger.info(f"Light state set to {new_state}")
 
@@ -305,8 +528,7 @@ class Light:
         if self.timer:
             self.timer.cancel()
         if self.pin.value:
-            self.timer = threading.Timer(60 * 60, self.auto_turn_off)
-            self.timer.start()
+            self.timer = timers.call_later(60 * 60, self.auto_turn_off, name="light auto off", reason='devices')
 
     def auto_turn_off(self) -> None:
         if self.pin.value:
@@ -322,18 +544,17 @@ class Light:
 class Ozone:
     def __init__(self):
         self.name = 'ozone'
-        self.pin = mcp.get_pin(9)
-        self.pin.switch_to_output(value=False)
+        self.pin = outputs.pin(9, self.name)
         self.internal_state = False
         self.timer = None
         self.schedule_timer = None
-        self.last_change_time = time.time()
+        self.last_change_time = clock.time()
         # Schedule the ozone run for 2 AM
         next_time = schedule_task_at(2, 0, self.run_ozone)
         logger.info(f"Next ozone run scheduled at {next_time}")
 
     def set_state(self, new_state: bool) -> None:
-        circ_pump_runtime = time.time() - cs.circpump.last_change_time
+        circ_pump_runtime = clock.time() - cs.circpump.last_change_time
         if new_state and not cs.circpump.get_state():
             logger.info("Circ pump is not running. Make sure the circ pump runs at least 30 seconds before turning "
                         "the ozone on. aborting.")
@@ -344,13 +565,13 @@ class Ozone:
         else:
             self.pin.value = new_state
             self.internal_state = new_state
-            self.last_change_time = time.time()
+            usage.transition(self.name, self.internal_state)
+            self.last_change_time = clock.time()
             logger.info(f"Ozone generator state set to {new_state}")
         if new_state:
             if self.timer:
                 self.timer.cancel()
-            self.timer = threading.Timer(60 * 60, self.auto_turn_off)
-            self.timer.start()
+            self.timer = timers.call_later(60 * 60, self.auto_turn_off, name="ozone auto off", reason='devices')
 
     def auto_turn_off(self) -> None:
         if self.pin.value:
@@ -378,63 +599,368 @@ class Ozone:
 
 
 class FlowSwitch:
-    def __init__(self):
-        self.flow = mcp.get_pin(8)
-        self.flow.direction = digitalio.Direction.INPUT
-        self.flow.pull = digitalio.Pull.UP
+    def __init__(self, interrupt_gpio: Optional[int] = FLOW_INTERRUPT_GPIO):
+        self.pin_number = 8
+        backend.setup_input(self.pin_number)
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.flowing = not backend.read_pin(self.pin_number)
+        self.pending_flow_time = None
+        self.last_rise_time = None
+        self.last_fall_time = None
+        self.last_read_time = clock.time()
+        self.interrupt_gpio = interrupt_gpio
+        self.interrupt_mode = backend.setup_interrupt(self.pin_number, interrupt_gpio, self.handle_interrupt)
+
+    def read_raw(self) -> bool:
+        # reading GPIOB also clears a pending interrupt on port B
+        self.last_read_time = clock.time()
+        return not (backend.read_port(1) >> (self.pin_number - 8)) & 1
+
+    def handle_interrupt(self, channel: int) -> None:
+        self.handle_edge(self.read_raw(), clock.time())
+
+    def handle_edge(self, raw_flow: bool, now: float) -> None:
+        # loss of flow is trusted right away, flow coming back has to settle for FLOW_DEBOUNCE first
+        lost = False
+        with self.lock:
+            if not raw_flow:
+                self.pending_flow_time = None
+                if self.flowing:
+                    self.flowing = False
+                    self.last_fall_time = now
+                    lost = True
+            elif not self.flowing and self.pending_flow_time is None:
+                self.pending_flow_time = now
+                timers.call_later(FLOW_DEBOUNCE, self.check_flow, name='flow debounce', reason='flow')
+        if lost:
+            for listener in self.listeners:
+                listener(False)
 
     def check_flow(self) -> bool:
-        return not self.flow.value
+        now = clock.time()
+        if not self.interrupt_mode:
+            if now - self.last_read_time >= FLOW_DEBOUNCE:
+                self.handle_edge(not backend.read_pin(self.pin_number), now)
+                self.last_read_time = now
+        elif now - self.last_read_time >= FLOW_RESYNC_INTERVAL:
+            self.handle_edge(self.read_raw(), now)
+        restored = False
+        with self.lock:
+            if self.pending_flow_time is not None and now - self.pending_flow_time >= FLOW_DEBOUNCE:
+                self.flowing = True
+                self.last_rise_time = self.pending_flow_time
+                self.pending_flow_time = None
+                restored = True
+        if restored:
+            for listener in self.listeners:
+                listener(True)
+        return self.flowing
+
+    def cleanup(self) -> None:
+        if self.interrupt_mode:
+            backend.remove_interrupt()
 
 
 class TemperatureSensor:
     def __init__(self, name: str, sensor_id: str):
         self.sensor_id = sensor_id
         self.name = name
-        self.device_folder = base_dir + sensor_id + '/w1_slave'
         self.temperature_c = None
         self.temperature_f = None
+        self.raw_c = None
+        self.raw_f = None
+        self.filter = SensorFilter()
         self.last_read_time = 0
+        self.read_seconds = sensor_read_seconds.labels(name)
+        self.crc_retries = sensor_crc_retries.labels(name)
+        self.crc_failures = sensor_crc_failures.labels(name)
         self.read_temp()
 
     def read_temp_raw(self) -> List[str]:
-        try:
-            time.sleep(1)
-            with open(self.device_folder, 'r') as file:
-                return file.readlines()
-        except IOError as e:
-            send_discord_hook(f"Error reading temperature sensor {self.name}: {e}")
-            fatal_error(f"Error reading temperature sensor {self.name}: {e}")
+        return backend.w1_read(self.sensor_id)
 
-    def read_temp(self) -> Tuple[float, float]:
-        current_time = time.time()
+    def sample(self) -> Optional[Tuple[float, float]]:
+        # reads and parses the sensor without touching the cached values, safe to call from a worker thread.
+        # a failed read raises IOError, the caller hands it to the control thread
+        started = time.perf_counter()
         lines = self.read_temp_raw()
-        while lines and lines[0].strip()[-3:] != 'YES':
+        retries = 0
+        while lines and lines[0].strip()[-3:] != 'YES' and retries < W1_CRC_RETRIES:
             lines = self.read_temp_raw()
+            retries += 1
+        self.read_seconds.observe(time.perf_counter() - started)
+        if retries:
+            self.crc_retries.inc(retries)
+        if not lines or lines[0].strip()[-3:] != 'YES':
+            self.crc_failures.inc()
+            logger.error(f"CRC check failed reading temperature sensor {self.name}")
+            return None
         equals_pos = lines[1].find('t=')
         if equals_pos != -1:
             try:
                 temp_string = lines[1][equals_pos + 2:]
                 temp_c = float(temp_string) / 1000.0
                 temp_f = (temp_c * 1.8) + 32
-                self.temperature_c, self.temperature_f = round(temp_c, 2), round(temp_f, 2)
-                self.last_read_time = current_time
+                return round(temp_c, 2), round(temp_f, 2)
             except (ValueError, IndexError) as e:
                 logger.error(f"Error parsing temperature sensor data: {e}")
+        return None
+
+    def update(self, temp_c: float, temp_f: float, read_time: float) -> None:
+        # every snapshot carries the last reading of each sensor, only a new one goes through the filter
+        if read_time <= self.last_read_time:
+            return
+        self.raw_c, self.raw_f = temp_c, temp_f
+        self.last_read_time = read_time
+        faulted = self.filter.fault
+        accepted = self.filter.update(temp_c, read_time)
+        # None until the first good reading, and again once a sensor fault drops the value
+        self.temperature_c = self.filter.filtered()
+        self.temperature_f = None if self.filter.value is None else round(self.filter.value * 1.8 + 32, 2)
+        if self.filter.fault and not faulted:
+            send_discord_hook(f"Temperature sensor {self.name} keeps reading {temp_c}C, its temperature is unknown")
+            logger.error(f"Temperature sensor {self.name} faulted, it keeps reading {temp_c}C")
+        elif not accepted:
+            logger.warning(f"Rejected reading of {temp_c}C from temperature sensor {self.name}")
+
+    def read_temp(self) -> Tuple[float, float]:
+        current_time = clock.time()
+        try:
+            reading = self.sample()
+        except IOError as e:
+            fatal_error(f"Error reading temperature sensor {self.name}: {e}")
+            return self.temperature_c, self.temperature_f
+        if reading:
+            self.update(reading[0], reading[1], current_time)
         return self.temperature_c, self.temperature_f
 
-    def f(self) -> float:
+    def f(self) -> Optional[float]:
         return self.temperature_f
 
-    def c(self) -> float:
+    def c(self) -> Optional[float]:
         return self.temperature_c
 
-    def cache_f(self) -> float:
+    def cache_f(self) -> Optional[float]:
         return self.temperature_f
 
+    def safety_f(self) -> Optional[float]:
+        temp_c = self.filter.safety()
+        return None if temp_c is None else round(temp_c * 1.8 + 32, 2)
+
+    def rate_f(self) -> float:
+        # degrees F per minute
+        return round(self.filter.rate * 1.8 * 60, 2)
+
+
+class SensorSnapshot(NamedTuple):
+    seq: int
+    timestamp: float
+    readings: Dict[str, Tuple[float, float, float]]  # sensor name -> (temp_c, temp_f, read_time)
+
+
+class SamplingPolicy:
+    def __init__(self, sensor: TemperatureSensor, priority: int = 5, interval: float = SENSOR_INTERVAL,
+                 resolution: int = 12):
+        self.sensor = sensor
+        self.priority = priority  # lower runs first, same as sched
+        self.interval = interval
+        self.resolution = resolution
+        self.applied_resolution = None
+        self.last_started = 0.0
+
+    def next_due(self) -> float:
+        # the next slot on a grid of the interval, so probes whose intervals divide each other come due together
+        # and can share a bulk conversion
+        return (math.floor(self.last_started / self.interval + 1e-9) + 1) * self.interval
+
+
+class SamplingScheduler:
+    def __init__(self, sensors: List[TemperatureSensor]):
+        self.policies = {sensor.name: SamplingPolicy(sensor) for sensor in sensors}
+        self.lock = threading.Lock()
+        self.state = None
+
+    def set_policy(self, name: str, priority: int, interval: float, resolution: int) -> None:
+        if resolution not in W1_CONVERSION_TIME:
+            raise ValueError(f"Unsupported DS18B20 resolution {resolution}")
+        with self.lock:
+            policy = self.policies[name]
+            policy.priority, policy.interval, policy.resolution = priority, interval, resolution
+
+    def apply_state(self, heater_on: bool, pumps_running: bool, freeze_risk: bool) -> bool:
+        state = (heater_on, pumps_running, freeze_risk)
+        if state == self.state:
+            return False
+        self.state = state
+        if heater_on:
+            # the high limit check is what matters while the heater fires, fast and coarse is fine at 150F
+            self.set_policy('heater1', 0, 0.25, 9)
+            self.set_policy('heater2', 0, 0.25, 9)
+        else:
+            self.set_policy('heater1', 2, 2.0, 11)
+            self.set_policy('heater2', 2, 2.0, 11)
+        if heater_on or pumps_running:
+            self.set_policy('water', 1, 1.0, 12)
+            self.set_policy('cabinet', 3, 2.0, 10)
+            self.set_policy('control_box', 3, 2.0, 10)
+        else:
+            self.set_policy('water', 1, 10.0, 12)
+            self.set_policy('cabinet', 3, 10.0, 10)
+            self.set_policy('control_box', 3, 10.0, 10)
+        if freeze_risk:
+            self.set_policy('ambient', 2, 10.0, 11)
+        else:
+            self.set_policy('ambient', 4, 60.0, 10)
+        logger.info(f"Sensor sampling updated for heater={heater_on} pumps={pumps_running} freeze={freeze_risk}")
+        return True
+
+    def due(self, now: float, exclude=()) -> List[SamplingPolicy]:
+        with self.lock:
+            due = [policy for name, policy in self.policies.items()
+                   if name not in exclude and policy.next_due() <= now]
+        return sorted(due, key=lambda policy: policy.priority)
+
+    def next_deadline(self) -> float:
+        with self.lock:
+            return min(policy.next_due() for policy in self.policies.values())
+
+    def everything(self) -> List[SamplingPolicy]:
+        with self.lock:
+            return sorted(self.policies.values(), key=lambda policy: policy.priority)
+
+    def conversion_time(self) -> float:
+        # every probe on the bus converts in a bulk conversion, so it takes as long as the finest resolution
+        with self.lock:
+            return max(W1_CONVERSION_TIME[policy.resolution] for policy in self.policies.values())
+
+
+class SensorAcquisition:
+    def __init__(self, sensors: List[TemperatureSensor]):
+        self.sensors = sensors
+        self.scheduler = SamplingScheduler(sensors)
+        self.executor = ThreadPoolExecutor(max_workers=len(sensors), thread_name_prefix='w1')
+        self.snapshot = SensorSnapshot(0, 0.0, {})
+        self.snapshot_lock = threading.Lock()
+        self.in_flight = set()
+        self.failures = {}  # sensor name -> IOError message, picked up by the control thread
+        self.listeners = []
+        self.bulk_supported = backend.w1_bulk_supported()
+        self.inline = False  # read on the calling thread instead of the pool, for a simulated bus
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        if not self.bulk_supported:
+            logger.warning("therm_bulk_read not available, each sensor will run its own conversion")
+
+    @property
+    def busy(self) -> bool:
+        return bool(self.in_flight)
+
+    def bulk_conversion(self) -> bool:
+        try:
+            if backend.w1_bulk_convert():
+                return True
+            logger.warning("Bulk temperature conversion timed out")
+        except IOError as e:
+            logger.error(f"Error starting bulk temperature conversion: {e}")
+        return False
+
+    def apply_resolution(self, policy: SamplingPolicy) -> None:
+        if policy.resolution == policy.applied_resolution:
+            return
+        try:
+            backend.w1_set_resolution(policy.sensor.sensor_id, policy.resolution)
+        except IOError as e:
+            logger.warning(f"Could not set resolution of temperature sensor {policy.sensor.name}: {e}")
+        policy.applied_resolution = policy.resolution
+
+    def read_sensor(self, policy: SamplingPolicy, converted: bool) -> None:
+        sensor = policy.sensor
+        try:
+            if not converted:
+                self.apply_resolution(policy)
+            reading = sensor.sample()
+            if reading:
+                self.publish(sensor.name, (reading[0], reading[1], clock.time()))
+        except IOError as e:
+            # the shutdown that follows touches every device, so it happens on the control thread, not here
+            with self.snapshot_lock:
+                self.failures[sensor.name] = str(e)
+            for listener in self.listeners:
+                listener(self.snapshot)
+        except Exception as e:
+            logger.error(f"Error sampling temperature sensor {sensor.name}: {e}")
+        finally:
+            with self.snapshot_lock:
+                self.in_flight.discard(sensor.name)
+            self.wake_event.set()
+
+    def publish(self, name: str, reading: Tuple[float, float, float]) -> None:
+        # swap in a new snapshot instead of mutating the old one, readers always see a complete snapshot
+        with self.snapshot_lock:
+            readings = dict(self.snapshot.readings)
+            readings[name] = reading
+            self.snapshot = SensorSnapshot(self.snapshot.seq + 1, clock.time(), readings)
+        for listener in self.listeners:
+            listener(self.snapshot)
+
+    def take_failures(self) -> Dict[str, str]:
+        with self.snapshot_lock:
+            failures, self.failures = self.failures, {}
+        return failures
+
+    def dispatch(self) -> None:
+        now = clock.time()
+        with self.snapshot_lock:
+            due = self.scheduler.due(now, exclude=set(self.in_flight))
+            if not due:
+                return
+            # a bulk conversion leaves every probe holding a fresh value and one not read straight after would
+            # return it stale later, so a bulk conversion reads the whole bus. worth it for two or more due probes
+            # as long as none of them is sampled faster than the conversion takes
+            bulk = (self.bulk_supported and len(due) > 1 and not self.in_flight
+                    and self.scheduler.conversion_time() <= min(policy.interval for policy in due))
+            group = self.scheduler.everything() if bulk else due
+            for policy in group:
+                self.in_flight.add(policy.sensor.name)
+                policy.last_started = now
+        if bulk:
+            for policy in group:
+                self.apply_resolution(policy)
+        converted = bulk and self.bulk_conversion()
+        for policy in group:
+            if self.inline:
+                self.read_sensor(policy, converted)
+            else:
+                self.executor.submit(self.read_sensor, policy, converted)
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            self.wake_event.clear()
+            try:
+                self.dispatch()
+            except Exception as e:
+                logger.error(f"Sensor acquisition dispatch failed: {e}")
+            self.wake_event.wait(min(1.0, max(0.01, self.scheduler.next_deadline() - clock.time())))
+
+    def update_policy(self, heater_on: bool, pumps_running: bool, freeze_risk: bool) -> None:
+        if self.scheduler.apply_state(heater_on, pumps_running, freeze_risk):
+            self.wake_event.set()
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='sensor_acquisition', daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wake_event.set()
+        self.executor.shutdown(wait=False)
+
 
 class ComponentSystem:
-    def __init__(self):
+    def __init__(self, sensor_ids: Dict[str, str] = SENSOR_IDS):
         self.heater = Heater()
         self.pump1 = Main_Pump('pump1', 6, 4)
         self.pump2 = Main_Pump('pump2', 5, 3)
@@ -443,56 +969,103 @@ class ComponentSystem:
         self.fans = Fans()
         self.light = Light()
         self.flow = FlowSwitch()
+        self.flow.listeners.append(self.flow_edge)
         self.ozone = Ozone()
-        self.temp_water = TemperatureSensor("water", "") # the second value is the 1-wire sensor address/id e.g. 28-000000000000
-        self.temp_heater1 = TemperatureSensor("heater1", "")
-        self.temp_heater2 = TemperatureSensor("heater2", "")
-        self.temp_ambient = TemperatureSensor("ambient", "")
-        self.temp_cabinet = TemperatureSensor("cabinet", "")
-        self.temp_control_box = TemperatureSensor("control_box", "")
+        self.devices = {device.name: device for device in [
+            self.heater, self.pump1, self.pump2, self.circpump, self.blower, self.fans, self.light, self.ozone
+        ]}
+        self.commands = CommandQueue()
+        self.commands_in_flight = []
+        self.command_lock = threading.Lock()
+        self.command_window = None  # clock time the held back commands get applied, None while none are waiting
+        self.wakeup = Wakeup()
+        self.tick_listeners = []
+        self.phase_seconds = {phase: tick_phase_seconds.labels(phase) for phase in TICK_PHASES}
+        self.commands.listeners.append(self.command_submitted)
+        timers.listeners.append(lambda timer: self.wakeup.notify('timer'))
+        self.temp_water = TemperatureSensor("water", sensor_ids['water'])
+        self.temp_heater1 = TemperatureSensor("heater1", sensor_ids['heater1'])
+        self.temp_heater2 = TemperatureSensor("heater2", sensor_ids['heater2'])
+        self.temp_ambient = TemperatureSensor("ambient", sensor_ids['ambient'])
+        self.temp_cabinet = TemperatureSensor("cabinet", sensor_ids['cabinet'])
+        self.temp_control_box = TemperatureSensor("control_box", sensor_ids['control_box'])
+        self.temp_sensors = [
+            self.temp_water, self.temp_heater1, self.temp_heater2,
+            self.temp_cabinet, self.temp_control_box, self.temp_ambient
+        ]
+        self.sensor_acquisition = SensorAcquisition(self.temp_sensors)
+        self.sensor_acquisition.listeners.append(lambda snapshot: self.wakeup.notify('sensors'))
+        self.sensor_seq = 0
+        self.history = HistoryStore()
+        self.history.flush_hooks.append(usage.flush)
+        # heating rate, losses and the stagnant probe offset, learned from history as it's written
+        self.thermal = ThermalModel()
+        self.history.flush_hooks.append(self.thermal.update)
+        for device in self.devices.values():
+            usage.transition(device.name, device.get_state())
         self.set_temperature = 99.0  # Default temperature in Fahrenheit
-        self.freeze_protection_temperature = 20
+        self.freeze_protection_temperature = RULE_SETTINGS['freeze_temperature']
         self.mode = 'automatic'  # Default mode is automatic
-        self.start_time = time.time()
-        self.loop_time = time.time()
-        self.temp_sensor_update_timer = time.time()
-        self.temp_sensor_round_robin = 0
+        self.start_time = clock.time()
+        self.loop_time = clock.time()
         self.sensor_read = False
+        self.alerts = AlertEngine(load_rules(), self.alert_input, notifier.notify)
+        self.sampling_update()
+
+    def main_pumps_off_time(self) -> float:
+        # seconds since both main pumps stopped, 0 while either of them runs
+        if self.pump1.get_state() != 'off' or self.pump2.get_state() != 'off':
+            return 0
+        return clock.time() - max(self.pump1.last_change_time, self.pump2.last_change_time)
+
+    def water_estimate(self) -> Optional[float]:
+        # the water probe sits in the circulation loop, with the main pumps off for a while it drifts away from the
+        # bulk of the water by an offset the thermal model learns from pump starts
+        if self.temp_water.f() is None:
+            return None
+        return round(self.temp_water.f() + self.thermal.correction(self.main_pumps_off_time()), 2)
+
+    def heater_probes_known(self) -> bool:
+        return None not in (self.temp_water.f(), self.temp_heater1.safety_f(), self.temp_heater2.safety_f())
 
     def automatic_heater_logic(self) -> None:
-        water_temp = self.temp_water.f()
-        # TODO logic for water temp offset based on how long the main pumps have been off
-        # need to collect temp data to know how to calculate this
+        settings = RULE_SETTINGS
+        water_temp = self.water_estimate()
+        if not self.heater_probes_known():
+            # heater_high_limit_check keeps the heater off, and nothing here compares against an unknown reading
+            return
         if water_temp < self.set_temperature and not self.circpump.get_state():
             logger.info('Turned circ pump on to heat')
             self.circpump.set_state(True)
         if self.flow.check_flow() and self.circpump.get_state():
-            if water_temp < self.set_temperature - 1 and not self.heater.get_state():
-                circ_pump_runtime = time.time() - self.circpump.last_change_time
-                if circ_pump_runtime >= 60:
+            if water_temp < self.set_temperature - settings['heater_on_below'] and not self.heater.get_state():
+                circ_pump_runtime = clock.time() - self.circpump.last_change_time
+                if circ_pump_runtime >= settings['heater_circ_delay']:
                     logger.info('Circ pump is running, flow switch active, turning heater on')
                     self.heater.set_state(True)
-            elif water_temp > self.set_temperature and self.heater.get_state():
+            elif water_temp > self.set_temperature + settings['heater_off_above'] and self.heater.get_state():
                 logger.info('Water up to temp, turning heater off')
                 self.heater.set_state(False)
         elif self.heater.get_state():
             self.heater.set_state(False)
 
     def automatic_blower_logic(self) -> None:
+        settings = RULE_SETTINGS
         cabinet_temp = self.temp_cabinet.f()
         control_box_temp = self.temp_control_box.f()
         water_temp = self.temp_water.f()
-        pump1_runtime = time.time() - self.pump1.last_change_time
-        pump2_runtime = time.time() - self.pump2.last_change_time
-        if cabinet_temp > 90 or control_box_temp > 100:
+        pump1_runtime = clock.time() - self.pump1.last_change_time
+        pump2_runtime = clock.time() - self.pump2.last_change_time
+        if (above(cabinet_temp, settings['blower_cabinet_on'])
+                or above(control_box_temp, settings['blower_control_box_on'])):
             if not self.blower.get_state():
                 logger.info('temperature condition met: turning blower on')
                 self.blower.set_state(True)
-        elif pump1_runtime >= 30 and self.pump1.get_state() != 'off':
+        elif pump1_runtime >= settings['blower_pump_delay'] and self.pump1.get_state() != 'off':
             if not self.blower.get_state():
                 logger.info('pump1 is running: turning blower on')
                 self.blower.set_state(True)
-        elif pump2_runtime >= 30 and self.pump2.get_state() != 'off':
+        elif pump2_runtime >= settings['blower_pump_delay'] and self.pump2.get_state() != 'off':
             if not self.blower.get_state():
                 logger.info('pump2 is running: turning blower on')
                 self.blower.set_state(True)
@@ -500,11 +1073,13 @@ class ComponentSystem:
             if not self.blower.get_state():
                 logger.info('ozone is running: turning blower on')
                 self.blower.set_state(True)
-        elif water_temp > self.set_temperature + 3:
+        elif above(water_temp, self.set_temperature + settings['blower_water_on']):
             if not self.blower.get_state():
                 logger.info('water temp is too high, turning blower on')
                 self.blower.set_state(True)
-        elif cabinet_temp < 80 and control_box_temp < 90 and water_temp < self.set_temperature + 2:
+        elif (below(cabinet_temp, settings['blower_cabinet_off'])
+              and below(control_box_temp, settings['blower_control_box_off'])
+              and below(water_temp, self.set_temperature + settings['blower_water_off'])):
             if self.blower.get_state():
                 logger.info('Conditions not met: turning blower off')
                 self.blower.set_state(False)
@@ -513,9 +1088,11 @@ class ComponentSystem:
             pass
 
     def automatic_fans_logic(self) -> None:
+        settings = RULE_SETTINGS
         cabinet_temp = self.temp_cabinet.f()
         control_box_temp = self.temp_control_box.f()
-        if cabinet_temp > 85 or control_box_temp > 90:
+        if (above(cabinet_temp, settings['fans_cabinet_on'])
+                or above(control_box_temp, settings['fans_control_box_on'])):
             if not self.fans.get_state():
                 logger.info('temperature condition met: turning fans on')
                 self.fans.set_state(True)
@@ -523,7 +1100,8 @@ class ComponentSystem:
             if not self.fans.get_state():
                 logger.info('ozone is running: turning fans on')
                 self.fans.set_state(True)
-        elif cabinet_temp < 80 and control_box_temp < 80:
+        elif (below(cabinet_temp, settings['fans_cabinet_off'])
+              and below(control_box_temp, settings['fans_control_box_off'])):
             if self.fans.get_state():
                 logger.info('Conditions not met: turning fans off')
                 self.fans.set_state(False)
@@ -532,29 +1110,80 @@ class ComponentSystem:
             pass
 
     def temp_sensor_update(self) -> None:
-        if time.time() - self.temp_sensor_update_timer > 1:
-            self.sensor_read = True
-            temp_sensors = [
-                self.temp_water, self.temp_heater1, self.temp_heater2,
-                self.temp_cabinet, self.temp_control_box, self.temp_ambient
-            ]
-            #print(f'reading sensor {temp_sensors[self.temp_sensor_round_robin].name}')
-            temp_sensors[self.temp_sensor_round_robin].read_temp()
-            self.temp_sensor_round_robin += 1
-            if self.temp_sensor_round_robin == len(temp_sensors):
-                self.temp_sensor_round_robin = 0
-            self.temp_sensor_update_timer = time.time()
-            self.sensor_read = False
+        # the acquisition thread does the slow 1-wire work, here we only pick up the latest snapshot
+        for name, error in self.sensor_acquisition.take_failures().items():
+            fatal_error(f"Error reading temperature sensor {name}: {error}")
+        snapshot = self.sensor_acquisition.snapshot
+        self.sensor_read = self.sensor_acquisition.busy
+        if snapshot.seq == self.sensor_seq:
+            return
+        for sensor in self.temp_sensors:
+            reading = snapshot.readings.get(sensor.name)
+            if reading:
+                sensor.update(*reading)
+        self.sensor_seq = snapshot.seq
+
+    def history_values(self) -> dict:
+        values = {sensor.name: sensor.cache_f() for sensor in self.temp_sensors}
+        for device in [self.heater, self.circpump, self.blower, self.fans, self.light, self.ozone]:
+            values[device.name] = int(device.get_state())
+        for pump in [self.pump1, self.pump2]:
+            values[pump.name] = ['off', 'low', 'high'].index(pump.get_state())
+        values['flow'] = int(self.flow.flowing)
+        values['set_temperature'] = self.set_temperature
+        return values
+
+    def record_history(self) -> None:
+        self.history.record(clock.time(), self.history_values())
+        timers.call_later(HISTORY_INTERVAL, self.record_history, name='history sample')
+
+    def alert_input(self, name: str):
+        # getter for an input an alert rule refers to, raises KeyError or ValueError for one that doesn't exist
+        kind, _, target = name.partition('.')
+        sensors = {sensor.name: sensor for sensor in self.temp_sensors}
+        if kind == 'temperature':
+            return sensors[target].f
+        if kind == 'rate':
+            return sensors[target].rate_f
+        if kind == 'sensor_age':
+            sensor = sensors[target]
+            return lambda: round(clock.time() - sensor.last_read_time)
+        if kind == 'device':
+            return self.devices[target].get_state
+        if name == 'flow':
+            return lambda: self.flow.flowing
+        if name == 'loop_time':
+            return lambda: round(clock.time() - self.loop_time, 1)
+        if name == 'set_temperature':
+            return lambda: self.set_temperature
+        if name == 'mode':
+            return lambda: self.mode
+        raise ValueError(name)
+
+    def sampling_update(self) -> None:
+        heater_on = self.heater.get_state()
+        pumps_running = (self.circpump.get_state() or self.pump1.get_state() != 'off'
+                         or self.pump2.get_state() != 'off')
+        ambient = self.temp_ambient.f()
+        # an unknown ambient counts as a freeze risk, so the ambient probe is sampled at the faster rate
+        freeze_risk = ambient is None or ambient < self.freeze_protection_temperature + 10
+        self.sensor_acquisition.update_policy(heater_on, pumps_running, freeze_risk)
 
     def freeze_protection(self) -> None:
-        if self.temp_ambient.f() < self.freeze_protection_temperature:
-            if time.time() - self.pump1.last_change_time > (60 * 60 * 4):
+        if below(self.temp_ambient.f(), self.freeze_protection_temperature):
+            if clock.time() - self.pump1.last_change_time > RULE_SETTINGS['freeze_pump1_interval']:
                 self.pump1.no_freeze_cycle()
-            if time.time() - self.pump2.last_change_time > 60:
+            if clock.time() - self.pump2.last_change_time > RULE_SETTINGS['freeze_pump2_interval']:
                 self.pump2.no_freeze_cycle()
 
     def heater_high_limit_check(self) -> None:
-        if self.temp_heater1.f() > 150 or self.temp_heater2.f() > 150:
+        # on the raw reading as well as the filtered one, the filter can trail a real fast rise by a few readings.
+        # a probe the heater depends on that has no reading is treated as over the limit
+        if not self.heater_probes_known():
+            if self.heater.get_state():
+                self.heater.set_state(False)
+                logger.warning("Emergency: Heater probe or water temperature unknown, heater off!")
+        elif self.temp_heater1.safety_f() > 150 or self.temp_heater2.safety_f() > 150:
             self.heater.set_state(False)
             logger.warning("Emergency: Heater temperature too high!")
 
@@ -563,34 +1192,214 @@ class ComponentSystem:
             self.heater.set_state(False)
             logger.warning("Emergency: No Flow detected while heater running!")
 
+    def command_target(self, device, commands: list):
+        # fold every command for a device from this window into one final state, so rapid toggles cancel out
+        # instead of chattering the relays
+        target = device.get_target() if hasattr(device, 'get_target') else device.get_state()
+        for command in commands:
+            if command.action == 'set':
+                target = command.value
+            elif command.action == 'advance':
+                target = {'off': 'low', 'low': 'high', 'high': 'off'}[target]
+            else:
+                target = not target
+        return target
+
+    def apply_target(self, device, target) -> None:
+        current = device.get_target() if hasattr(device, 'get_target') else device.get_state()
+        if target == current:
+            return
+        if isinstance(device, Main_Pump):
+            device.set_state(target != 'off', target if target != 'off' else 'low')
+        else:
+            device.set_state(target)
+
+    def apply_order(self, name: str, target) -> tuple:
+        if target in (False, 'off'):
+            return 0, SHUTDOWN_ORDER.index(name)
+        return 1, STARTUP_ORDER.index(name)
+
+    def command_submitted(self, command) -> None:
+        # runs on the submitting thread. the first command opens a window and a timer wakes the loop when it
+        # closes, everything submitted until then is folded together by process_commands
+        with self.command_lock:
+            if self.command_window is None:
+                self.command_window = clock.time() + COMMAND_WINDOW
+                timers.call_at(self.command_window, lambda: None, name='command window')
+
+    def take_commands(self) -> list:
+        with self.command_lock:
+            if self.command_window is None or clock.time() < self.command_window:
+                return []
+            self.command_window = None
+            return self.commands.drain()
+
+    def process_commands(self) -> bool:
+        by_device = {}
+        for command in self.take_commands():
+            if command.device == 'setpoint':
+                self.change_setpoint(command.value)
+                command.complete('done', {'state': self.set_temperature})
+            elif command.device == 'mode':
+                self.change_mode(command.value)
+                command.complete('done', {'state': self.mode})
+            else:
+                by_device.setdefault(command.device, []).append(command)
+        targets = {name: self.command_target(self.devices[name], commands) for name, commands in by_device.items()}
+        for name in sorted(by_device, key=lambda name: self.apply_order(name, targets[name])):
+            commands = by_device[name]
+            device = self.devices[name]
+            target = targets[name]
+            if len(commands) > 1:
+                logger.info(f"Coalesced {len(commands)} commands for {name} into {target}")
+            for command in commands:
+                command.status = 'running'
+            try:
+                self.apply_target(device, target)
+            except Exception as e:
+                logger.error(f"Command for {name} failed: {e}")
+                for command in commands:
+                    command.complete('failed', {'error': str(e)})
+                continue
+            self.commands_in_flight.append((device, target, commands))
+        still_running = []
+        for device, target, commands in self.commands_in_flight:
+            if hasattr(device, 'sequence') and device.sequence.busy():
+                still_running.append((device, target, commands))
+                continue
+            # a device can refuse a change, e.g. the heater lockout, report that instead of success
+            status = 'done' if device.get_state() == target else 'rejected'
+            for command in commands:
+                command.complete(status, {'state': device.get_state()})
+        self.commands_in_flight = still_running
+        return bool(by_device)
+
+    def flow_edge(self, flowing: bool) -> None:
+        # can be called from the interrupt thread, so it only wakes the loop. devices, usage and the output latch
+        # belong to the control thread, and flow_check() cuts the heater on the wake this causes
+        self.wakeup.notify('flow')
+
+    def change_setpoint(self, temperature: float) -> None:
+        self.set_temperature = temperature
+        self.wakeup.notify('setpoint')
+
+    def change_mode(self, mode: str) -> None:
+        self.mode = mode
+        self.wakeup.notify('mode')
+
+    def max_loop_interval(self) -> float:
+        if EVENT_DRIVEN_LOOP and self.flow.interrupt_mode:
+            return LOOP_MAX_INTERVAL
+        return LOOP_INTERVAL
+
+    def phase_done(self, phase: str, mark: float) -> float:
+        now = time.perf_counter()
+        self.phase_seconds[phase].observe(now - mark)
+        return now
+
+    def faulted_tick(self) -> None:
+        # after a fatal error nothing may switch a device back on: commands are refused, due timers are dropped
+        # without running, the rules don't run and the outputs are held off. state still goes out to the API
+        in_flight = [command for _, _, commands in self.commands_in_flight for command in commands]
+        for command in self.commands.drain() + in_flight:
+            command.complete('rejected', {'error': fault})
+        self.commands_in_flight = []
+        timers.pop_due(clock.time())
+        self.temp_sensor_update()
+        outputs.all_off()
+        outputs.commit()
+        self.alerts.evaluate(clock.time())
+        self.loop_time = clock.time()
+        for listener in self.tick_listeners:
+            listener(self)
+
+    def tick(self, reasons: set) -> None:
+        if fault is not None:
+            self.faulted_tick()
+            return
+        started = mark = time.perf_counter()
+        reasons |= timers.run_due()  # scheduled tasks and relay sequence steps, tagged with what they change
+        mark = self.phase_done('timers', mark)
+        if self.process_commands():
+            reasons.add('devices')
+        mark = self.phase_done('commands', mark)
+        self.temp_sensor_update()
+        mark = self.phase_done('temp_sensor_update', mark)
+        if fault is not None:
+            # a sensor failure just latched the fault, none of the rules may run on this tick either
+            self.faulted_tick()
+            return
+        self.sampling_update()
+        mark = self.phase_done('sampling_update', mark)
+        for rule, automatic_only, triggers in CONTROL_RULES:
+            if automatic_only and self.mode != 'automatic':
+                continue
+            if 'periodic' in reasons or reasons & triggers:
+                mark = time.perf_counter()
+                getattr(self, rule)()
+                self.phase_done(rule, mark)
+        mark = time.perf_counter()
+        # the safety checks are cheap, they run on every wake whatever the reason
+        self.heater_high_limit_check()
+        mark = self.phase_done('heater_high_limit_check', mark)
+        self.flow_check()
+        mark = self.phase_done('flow_check', mark)
+        outputs.commit()  # every pin change from this tick goes out together
+        mark = self.phase_done('commit', mark)
+        self.alerts.evaluate(clock.time())
+        mark = self.phase_done('alerts', mark)
+        self.loop_time = clock.time()
+        for listener in self.tick_listeners:
+            listener(self)
+        self.phase_done('listeners', mark)
+        tick_seconds.observe(time.perf_counter() - started)
+
+    def state_signature(self) -> tuple:
+        # cheap stand-in for get_state() to tell whether a tick changed anything it shows, from cached values only.
+        # the state carries ages in whole seconds, so the signature changes at least once a second
+        return (tuple((sensor.raw_f, sensor.temperature_f, sensor.filter.fault) for sensor in self.temp_sensors),
+                tuple(device.get_state() for device in self.devices.values()), self.flow.flowing,
+                self.set_temperature, self.mode, fault, tuple(self.alerts.active()), self.sensor_read,
+                int(clock.time()))
+
     def get_state(self) -> dict:
-        temp_sensors = [
-            self.temp_water, self.temp_heater1, self.temp_heater2,
-            self.temp_cabinet, self.temp_control_box, self.temp_ambient
-        ]
         devices = [self.heater, self.circpump, self.blower, self.fans, self.light, self.ozone]
         pumps = [self.pump1, self.pump2]
         return {
             'set_temperature': self.set_temperature,
             'mode': self.mode,
-            'temperatures': {sensor.name: sensor.cache_f() for sensor in temp_sensors},
+            'fault': fault,
+            'temperatures': {sensor.name: sensor.cache_f() for sensor in self.temp_sensors},
+            'sensors': {
+                sensor.name: {
+                    'raw': sensor.raw_f,
+                    'filtered': sensor.cache_f(),
+                    'rate': sensor.rate_f(),
+                    'rejected': sensor.filter.total_rejected,
+                    'fault': sensor.filter.fault,
+                } for sensor in self.temp_sensors
+            },
             'devices': {
                 device.name: {
                     'state': device.get_state(),
-                    'last_change_time': round(time.time() - device.last_change_time),
+                    'last_change_time': round(clock.time() - device.last_change_time),
                 } for device in devices
             },
             'main_pumps': {
                 pump.name: {
                     'state': pump.get_state(),
-                    'last_change_time': round(time.time() - pump.last_change_time),
+                    'last_change_time': round(clock.time() - pump.last_change_time),
                 } for pump in pumps
             },
-            'flow_switch': self.flow.check_flow(),
+            'flow_switch': self.flow.flowing,
             'start_time': self.start_time,
-            'loop_time': round(time.time() - self.loop_time),
-            'current_time': time.time(),
-            'sensor_read': self.sensor_read
+            'loop_time': round(clock.time() - self.loop_time),
+            'current_time': round(clock.time()),
+            'sensor_read': self.sensor_read,
+            'alerts': self.alerts.active(),
+            'thermal': self.thermal.state(self.temp_water.cache_f(), self.temp_ambient.cache_f(),
+                                          self.set_temperature, self.main_pumps_off_time(),
+                                          self.pump1.get_state() != 'off' or self.pump2.get_state() != 'off'),
         }
 
     def cleanup(self) -> None:
@@ -598,41 +1407,134 @@ class ComponentSystem:
         for comp in [self.heater, self.pump1, self.pump2, self.circpump, self.blower, self.fans, self.light,
                      self.ozone]:
             comp.cleanup()
-
-
-cs = ComponentSystem()
-
-
-async def tub_loop():
-    while True:
-        scheduler.run(blocking=False)  # Run scheduled tasks
-        cs.temp_sensor_update()
-        if cs.mode == 'automatic':
-            cs.automatic_heater_logic()
-            cs.automatic_blower_logic()
-            cs.automatic_fans_logic()
-            cs.freeze_protection()
-        cs.heater_high_limit_check()
-        cs.flow_check()
-        cs.loop_time = time.time()
-        await asyncio.sleep(0.2)
+        outputs.commit()
+        self.flow.cleanup()
+        self.sensor_acquisition.stop()
+        self.history.stop()
+
+
+cs = None
+init_lock = threading.Lock()
+
+
+def init_system(hardware=None, system_clock=None) -> ComponentSystem:
+    # builds the component system the first time it is needed, on the real board unless given another backend
+    global backend, clock, outputs, cs
+    with init_lock:
+        if cs is None:
+            if system_clock is not None:
+                clock = system_clock
+            backend = hardware if hardware is not None else PiBackend()
+            outputs = OutputBank(backend)
+            cs = ComponentSystem(getattr(backend, 'sensor_ids', SENSOR_IDS))
+    return cs
+
+
+async def tub_loop(until: Optional[float] = None):
+    cs.wakeup.bind(asyncio.get_running_loop())
+    reasons = {'periodic'}
+    last_periodic = 0
+    while until is None or clock.time() < until:
+        now = clock.time()
+        if now - last_periodic >= cs.max_loop_interval():
+            reasons.add('periodic')
+        if 'periodic' in reasons:
+            last_periodic = now
+        cs.tick(reasons)
+        if not EVENT_DRIVEN_LOOP:
+            await clock.pause(LOOP_INTERVAL)
+            reasons = {'periodic'}
+            continue
+        timeout = last_periodic + cs.max_loop_interval() - clock.time()
+        next_deadline = timers.next_deadline()
+        if next_deadline is not None:
+            timeout = min(timeout, next_deadline - clock.time())
+        reasons = await clock.wait(cs.wakeup, max(0.0, timeout))
+
+
+def on_state_change(listener: Callable[[ComponentSystem], None]) -> Callable[[ComponentSystem], None]:
+    # wraps a tick listener so it only runs on a tick that changed the state, building and diffing the whole
+    # state on every tick is most of a poll mode tick
+    last = [None]
+
+    def changed(system: ComponentSystem) -> None:
+        signature = system.state_signature()
+        if signature != last[0]:
+            last[0] = signature
+            listener(system)
+    return changed
 
 
 def handle_exit_tub(*args) -> None:
+    if cs is None:
+        return
     logger.info("Received shutdown signal, performing hardware cleanup.")
     cs.cleanup()
     logger.info("Cleanup completed. Exiting now.")
     send_discord_hook("Received shutdown signal, performing hardware cleanup.")
+    notifier.stop()
+
+
+class LocalControl:
+    # what the API talks to when the control loop runs in the same process, see tub_ipc.RemoteControl
+    def __init__(self):
+        init_system()
+
+    def get_state(self) -> dict:
+        return cs.get_state()
+
+    def device_names(self) -> list:
+        return list(cs.devices)
+
+    def submit(self, device: str, action: str, value=None):
+        return cs.commands.submit(device, action, value)
+
+    def submit_batch(self, items: list) -> list:
+        return cs.commands.submit_batch(items)
+
+    def get_command(self, command_id: int):
+        return cs.commands.get(command_id)
+
+    def change_setpoint(self, temperature: float) -> None:
+        cs.change_setpoint(temperature)
+
+    def change_mode(self, mode: str) -> None:
+        cs.change_mode(mode)
+
+    def pending_timers(self) -> list:
+        return timers.pending()
+
+    def history_recent(self, since: float) -> list:
+        return cs.history.recent(since)
+
+    def subscribe(self, callback) -> None:
+        cs.tick_listeners.append(on_state_change(lambda system: callback(system.get_state())))
+
+    def metrics(self) -> None:
+        # same process, the API's own registry render already has everything
+        return None
 
 
 def start_tub_system():
+    init_system()
     send_discord_hook('hottub started')
+    cs.sensor_acquisition.start()
+    cs.history.start()
+    cs.record_history()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.create_task(tub_loop())
     loop.run_forever()
 
 
+def stop_tub_system() -> None:
+    if cs is None:
+        return
+    loop = cs.wakeup.loop
+    if loop is not None:
+        loop.call_soon_threadsafe(loop.stop)
+
+
 if __name__ == "__main__":
     try:
         start_tub_system()
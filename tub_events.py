@@ -0,0 +1,38 @@
+import asyncio
+import threading
+from typing import Optional, Set
+
+
+class Wakeup:
+    # collects the reasons the control loop should run again and wakes it from any thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reasons = set()
+        self.loop = None
+        self.event = None
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def notify(self, reason: str) -> None:
+        with self.lock:
+            pending = bool(self.reasons)
+            self.reasons.add(reason)
+        # a wake is already on its way if there were reasons waiting, no need to poke the loop again
+        if not pending and self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout: Optional[float]) -> Set[str]:
+        if not self.reasons:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.event.clear()
+        return self.drain()
+
+    def drain(self) -> Set[str]:
+        with self.lock:
+            reasons, self.reasons = self.reasons, set()
+        return reasons
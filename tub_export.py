@@ -0,0 +1,87 @@
+import csv
+import io
+import json
+import time
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+EXPORT_FORMATS = ['csv', 'ndjson', 'arrow'] if pyarrow else ['csv', 'ndjson']
+EXPORT_MEDIA_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+EXPORT_CHUNK = 5000  # rows formatted and sent at a time
+# seconds to sleep between chunks, keeps an export from hogging the CPU the control loop runs on
+EXPORT_PAUSE = 0.02
+
+
+def columns(tier: int) -> list:
+    if tier == 0:
+        return ['timestamp', 'channel', 'value']
+    return ['timestamp', 'channel', 'count', 'min', 'max', 'avg']
+
+
+def chunked(rows, size: int = EXPORT_CHUNK):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+            time.sleep(EXPORT_PAUSE)
+    if chunk:
+        yield chunk
+
+
+def export_csv(rows, names: list):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for chunk in chunked(rows):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def export_ndjson(rows, names: list):
+    for chunk in chunked(rows):
+        yield ''.join(json.dumps(dict(zip(names, row)), separators=(',', ':')) + '\n' for row in chunk).encode()
+
+
+def export_arrow(rows, names: list):
+    # an Arrow IPC stream, one record batch per chunk
+    fields = [pyarrow.field(name, pyarrow.float64()) for name in names]
+    fields[1] = pyarrow.field('channel', pyarrow.string())
+    if 'count' in names:
+        fields[2] = pyarrow.field('count', pyarrow.int64())
+    schema = pyarrow.schema(fields)
+    sink = io.BytesIO()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+
+    def drain() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    yield drain()
+    for chunk in chunked(rows):
+        writer.write_batch(pyarrow.record_batch([list(column) for column in zip(*chunk)], schema=schema))
+        yield drain()
+    writer.close()
+    yield drain()
+
+
+EXPORTERS = {'csv': export_csv, 'ndjson': export_ndjson, 'arrow': export_arrow}
+
+
+def export(rows, export_format: str, tier: int = 0):
+    return EXPORTERS[export_format](rows, columns(tier))
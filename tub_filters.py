@@ -0,0 +1,103 @@
+from collections import deque
+from typing import Optional
+
+SENSOR_MEDIAN_WINDOW = 3  # readings in the running median, odd, small keeps the added lag under one sample
+SENSOR_EWMA_ALPHA = 0.5  # weight of the newest median in the smoothed value
+SENSOR_RATE_ALPHA = 0.3  # smoothing of the rate of change estimate
+SENSOR_MAX_RATE = 1.0  # degrees C per second, anything faster than this is a bad read, not the water
+SENSOR_RATE_SLACK = 0.5  # degrees C allowed on top of the rate limit for quantization and timing jitter
+SENSOR_REJECT_LIMIT = 5  # consecutive rate limited readings before we believe them and start over
+SENSOR_FAULT_LIMIT = 5  # consecutive impossible readings before the value is dropped and the sensor is faulted
+# the DS18B20 reports 85.0 after a power-on reset that never ran a conversion, and its range is -55 to 125
+DS18B20_POWER_ON_C = 85.0
+DS18B20_RANGE_C = (-55.0, 125.0)
+
+
+class SensorFilter:
+    # streaming filter for one temperature sensor, constant state whatever the sample count
+    def __init__(self, window: int = SENSOR_MEDIAN_WINDOW, alpha: float = SENSOR_EWMA_ALPHA,
+                 max_rate: float = SENSOR_MAX_RATE):
+        self.window = deque(maxlen=window)
+        self.alpha = alpha
+        self.max_rate = max_rate
+        self.raw = None
+        self.accepted = None  # last raw reading that passed, the yardstick for the next one
+        self.value = None
+        self.rate = 0.0  # degrees C per second
+        self.last_time = None
+        self.rejected = 0
+        self.invalid = 0
+        self.total_rejected = 0
+        self.fault = False  # reading nothing but impossible values, the value is unknown until a good reading
+
+    def in_range(self, temp_c: float) -> bool:
+        # a reading the sensor could have taken, whatever the rate limit thinks of it
+        if not DS18B20_RANGE_C[0] <= temp_c <= DS18B20_RANGE_C[1]:
+            return False
+        if temp_c != DS18B20_POWER_ON_C:
+            return True
+        return self.accepted is not None and abs(self.accepted - temp_c) <= SENSOR_RATE_SLACK * 4
+
+    def plausible(self, temp_c: float, read_time: float) -> bool:
+        # the rate limit, for a reading that is already in range
+        if self.accepted is None:
+            return True
+        elapsed = max(read_time - self.last_time, 0.0)
+        return abs(temp_c - self.accepted) <= self.max_rate * elapsed + SENSOR_RATE_SLACK
+
+    def reset(self) -> None:
+        # the rate is kept, update works out the one across the step itself
+        self.window.clear()
+        self.accepted = None
+        self.value = None
+        self.last_time = None
+
+    def update(self, temp_c: float, read_time: float) -> bool:
+        # returns whether the reading was used, a rejected reading leaves the filtered value as it was
+        self.raw = temp_c
+        if not self.in_range(temp_c):
+            # never believed however often it repeats, a disconnected DS18B20 reads -127 for as long as it's out
+            self.invalid += 1
+            self.total_rejected += 1
+            if self.invalid >= SENSOR_FAULT_LIMIT and not self.fault:
+                self.fault = True
+                self.reset()
+            return False
+        self.invalid = 0
+        self.fault = False
+        if not self.plausible(temp_c, read_time):
+            self.rejected += 1
+            self.total_rejected += 1
+            if self.rejected < SENSOR_REJECT_LIMIT:
+                return False
+            # the same story that many times in a row is a real step, e.g. a probe that was replaced or a heater
+            # element running dry. the rate is taken across the whole rejected run so a fast rise still shows
+            previous, since = self.value, self.last_time
+            self.reset()
+            if previous is not None and read_time > since:
+                self.rate = (temp_c - previous) / (read_time - since)
+        self.rejected = 0
+        self.accepted = temp_c
+        self.window.append(temp_c)
+        median = sorted(self.window)[len(self.window) // 2]
+        if self.value is None:
+            self.value = median
+        else:
+            previous = self.value
+            self.value = self.alpha * median + (1 - self.alpha) * previous
+            elapsed = read_time - self.last_time
+            if elapsed > 0:
+                rate = (self.value - previous) / elapsed
+                self.rate = SENSOR_RATE_ALPHA * rate + (1 - SENSOR_RATE_ALPHA) * self.rate
+        self.last_time = read_time
+        return True
+
+    def filtered(self) -> Optional[float]:
+        return None if self.value is None else round(self.value, 2)
+
+    def safety(self) -> Optional[float]:
+        # for limit checks: the higher of the filtered value and the latest in range raw reading, the rate limit
+        # can hold a real fast rise back for a few readings and a cutoff must not wait for it
+        if self.raw is None or not self.in_range(self.raw):
+            return self.value
+        return self.raw if self.value is None else max(self.raw, self.value)
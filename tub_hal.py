@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from tub_metrics import registry
+
+logger = logging.getLogger(__name__)
+
+MCP23017_ADDRESS = 0x20  # MCP23017 w/ A0 set
+W1_BASE_DIR = '/sys/bus/w1/devices/'
+W1_BULK_TIMEOUT = 1.0  # seconds to wait for a bulk conversion to finish
+
+i2c_transactions = registry.counter('hotcon_i2c_transactions_total', "Register reads and writes on the MCP23017",
+                                    ['op'])
+
+
+class SystemClock:
+    def time(self) -> float:
+        return time.time()
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+    async def pause(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+
+    async def wait(self, wakeup, timeout: float) -> set:
+        return await wakeup.wait(timeout)
+
+
+class VirtualClock:
+    # simulated time for a single threaded control loop. time only moves while the loop waits, and it jumps
+    # straight to the next thing that can happen: the wait timeout, or the earliest deadline a source reports
+    def __init__(self, start: Optional[float] = None):
+        self.current = time.time() if start is None else start
+        self.listeners = []  # called with the new time after every advance, e.g. to step a simulation
+        self.deadline_sources = []  # callables returning the next time something is due, or None
+
+    def time(self) -> float:
+        return self.current
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self.current)
+
+    def sleep(self, seconds: float) -> None:
+        self.advance(seconds)
+
+    def advance(self, seconds: float) -> None:
+        self.current += max(seconds, 0.0)
+        for listener in self.listeners:
+            listener(self.current)
+
+    async def pause(self, seconds: float) -> None:
+        self.advance(seconds)
+        await asyncio.sleep(0)
+
+    async def wait(self, wakeup, timeout: float) -> set:
+        target = self.current + max(timeout, 0.0)
+        while not wakeup.reasons and self.current < target:
+            deadlines = [deadline for deadline in (source() for source in self.deadline_sources)
+                         if deadline is not None and deadline > self.current]
+            self.advance(min([target] + deadlines) - self.current)
+        await asyncio.sleep(0)  # anything else scheduled on the loop, e.g. API requests, gets its turn
+        return wakeup.drain()
+
+
+class PiBackend:
+    # the real board: relays and the flow switch on an MCP23017 over I2C, DS18B20 probes through the w1 sysfs
+    def __init__(self, address: int = MCP23017_ADDRESS, base_dir: str = W1_BASE_DIR):
+        import board
+        import busio
+        import digitalio
+        from adafruit_mcp230xx.mcp23017 import MCP23017
+        self.digitalio = digitalio
+        self.i2c = busio.I2C(board.SCL, board.SDA)
+        self.mcp = MCP23017(self.i2c, address=address)
+        self.inputs = {}
+        self.i2c_reads = i2c_transactions.labels('read')
+        self.i2c_writes = i2c_transactions.labels('write')
+        os.system('modprobe w1-gpio')
+        os.system('modprobe w1-therm')
+        self.base_dir = base_dir
+        self.bulk_read_path = base_dir + 'w1_bus_master1/therm_bulk_read'
+        self.interrupt_gpio = None
+
+    def read_port(self, port: int) -> int:
+        self.i2c_reads.inc()
+        return self.mcp.gpioa if port == 0 else self.mcp.gpiob
+
+    def write_port(self, port: int, value: int) -> None:
+        self.i2c_writes.inc()
+        if port == 0:
+            self.mcp.gpioa = value
+        else:
+            self.mcp.gpiob = value
+
+    def setup_output(self, number: int) -> None:
+        self.mcp.get_pin(number).switch_to_output(value=False)
+
+    def setup_input(self, number: int) -> None:
+        pin = self.mcp.get_pin(number)
+        pin.direction = self.digitalio.Direction.INPUT
+        pin.pull = self.digitalio.Pull.UP
+        self.inputs[number] = pin
+
+    def read_pin(self, number: int) -> bool:
+        self.i2c_reads.inc()
+        return self.inputs[number].value
+
+    def setup_interrupt(self, number: int, gpio: Optional[int], callback: Callable[[int], None]) -> bool:
+        if gpio is None:
+            return False
+        try:
+            import RPi.GPIO as GPIO
+        except ImportError:
+            logger.warning("RPi.GPIO is not available, polling the flow switch instead")
+            return False
+        mask = 1 << number
+        self.mcp.interrupt_configuration &= ~mask  # compare against the previous value, so any change interrupts
+        self.mcp.interrupt_enable |= mask
+        self.mcp.clear_ints()
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(gpio, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(gpio, GPIO.FALLING, callback=callback)
+        self.interrupt_gpio = gpio
+        logger.info(f"Flow switch using interrupt on GPIO {gpio}")
+        return True
+
+    def remove_interrupt(self) -> None:
+        if self.interrupt_gpio is not None:
+            import RPi.GPIO as GPIO
+            GPIO.remove_event_detect(self.interrupt_gpio)
+
+    def w1_read(self, sensor_id: str) -> List[str]:
+        with open(self.base_dir + sensor_id + '/w1_slave', 'r') as file:
+            return file.readlines()
+
+    def w1_set_resolution(self, sensor_id: str, bits: int) -> None:
+        with open(self.base_dir + sensor_id + '/resolution', 'w') as file:
+            file.write(f'{bits}\n')
+
+    def w1_bulk_supported(self) -> bool:
+        return os.path.exists(self.bulk_read_path)
+
+    def w1_bulk_convert(self) -> bool:
+        # one Convert T for every probe on the bus, the w1_slave reads that follow return the converted value
+        with open(self.bulk_read_path, 'w') as file:
+            file.write('trigger\n')
+        deadline = time.time() + W1_BULK_TIMEOUT
+        while time.time() < deadline:
+            with open(self.bulk_read_path, 'r') as file:
+                if file.read().strip() != '-1':
+                    return True
+            time.sleep(0.01)
+        return False
@@ -0,0 +1,308 @@
+import heapq
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PATH = 'history.db'
+HISTORY_INTERVAL = 1.0  # seconds between recorded samples
+RING_SIZE = 3600  # most recent samples kept in memory
+FLUSH_INTERVAL = 60  # seconds between batched writes to disk
+PRUNE_INTERVAL = 60 * 60
+# retention tiers: raw samples for a day, then min/max/avg buckets of one minute, ten minutes and one hour
+RAW_RETENTION = 24 * 60 * 60
+ROLLUP_TIERS = [
+    # (bucket seconds, retention seconds)
+    (60, 30 * 24 * 60 * 60),
+    (10 * 60, 365 * 24 * 60 * 60),
+    (60 * 60, 5 * 365 * 24 * 60 * 60),
+]
+HISTORY_POINTS = 500  # points per series a chart gets when it doesn't ask for a number
+MAX_HISTORY_POINTS = 5000
+HISTORY_METHODS = ['minmax', 'lttb']
+LTTB_OVERSAMPLE = 4  # buckets fetched per output point before LTTB picks which ones to keep
+EXPORT_PAGE = 2000  # rows read per channel per query while exporting
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS samples (channel INTEGER NOT NULL, ts REAL NOT NULL, value REAL NOT NULL, "
+    "PRIMARY KEY (channel, ts)) WITHOUT ROWID",
+] + [
+    f"CREATE TABLE IF NOT EXISTS rollup_{bucket} (channel INTEGER NOT NULL, bucket INTEGER NOT NULL, "
+    f"count INTEGER NOT NULL, min REAL NOT NULL, max REAL NOT NULL, sum REAL NOT NULL, "
+    f"PRIMARY KEY (channel, bucket)) WITHOUT ROWID"
+    for bucket, _ in ROLLUP_TIERS
+]
+
+
+def connect(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path, check_same_thread=False)
+    # WAL with synchronous=NORMAL only syncs on checkpoints, which keeps the SD card writes down
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class HistoryStore:
+    # recent samples live in a ring buffer in memory, a writer thread spills them to SQLite in batches and keeps
+    # the rollup tiers up to date as it goes, so nothing on disk is ever rescanned to build them
+    def __init__(self, path: str = HISTORY_PATH, ring_size: int = RING_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.ring = deque(maxlen=ring_size)
+        self.pending = []
+        self.db = None
+        self.channel_ids = {}
+        self.last_prune = 0
+        self.flush_hooks = []  # called with the connection inside every flush transaction
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def record(self, timestamp: float, values: Dict[str, float]) -> None:
+        sample = (timestamp, {name: float(value) for name, value in values.items() if value is not None})
+        with self.lock:
+            self.ring.append(sample)
+            self.pending.append(sample)
+
+    def recent(self, since: float = 0) -> List[Tuple[float, Dict[str, float]]]:
+        with self.lock:
+            return [sample for sample in self.ring if sample[0] >= since]
+
+    def open(self) -> None:
+        if self.db is None:
+            self.db = connect(self.path)
+            for statement in SCHEMA:
+                self.db.execute(statement)
+            self.channel_ids = dict(self.db.execute("SELECT name, id FROM channels").fetchall())
+            self.db.commit()
+
+    def channel_id(self, name: str) -> int:
+        if name not in self.channel_ids:
+            cursor = self.db.execute("INSERT INTO channels (name) VALUES (?)", (name,))
+            self.channel_ids[name] = cursor.lastrowid
+        return self.channel_ids[name]
+
+    def flush(self) -> int:
+        # nothing to write to until start() or open() made the database, a store that never ran must not create
+        # one on shutdown, e.g. after a fatal error during startup
+        if self.db is None:
+            return 0
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending and not self.flush_hooks:
+            return 0
+        rows = []
+        rollups = {bucket: {} for bucket, _ in ROLLUP_TIERS}
+        for timestamp, values in pending:
+            for name, value in values.items():
+                channel = self.channel_id(name)
+                rows.append((channel, round(timestamp, 3), value))
+                for bucket, aggregates in rollups.items():
+                    key = (channel, int(timestamp // bucket * bucket))
+                    aggregate = aggregates.get(key)
+                    if aggregate is None:
+                        aggregates[key] = [1, value, value, value]
+                    else:
+                        aggregate[0] += 1
+                        aggregate[1] = min(aggregate[1], value)
+                        aggregate[2] = max(aggregate[2], value)
+                        aggregate[3] += value
+        # one transaction per flush, the rollups merge into buckets already partly on disk
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO samples (channel, ts, value) VALUES (?, ?, ?)", rows)
+            for bucket, aggregates in rollups.items():
+                self.db.executemany(
+                    f"INSERT INTO rollup_{bucket} (channel, bucket, count, min, max, sum) VALUES (?, ?, ?, ?, ?, ?) "
+                    f"ON CONFLICT (channel, bucket) DO UPDATE SET count = count + excluded.count, "
+                    f"min = min(min, excluded.min), max = max(max, excluded.max), sum = sum + excluded.sum",
+                    [(channel, start, *aggregate) for (channel, start), aggregate in aggregates.items()])
+            for hook in self.flush_hooks:
+                hook(self.db)
+        return len(rows)
+
+    def prune(self, now: float) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM samples WHERE ts < ?", (now - RAW_RETENTION,))
+            for bucket, retention in ROLLUP_TIERS:
+                self.db.execute(f"DELETE FROM rollup_{bucket} WHERE bucket < ?", (now - retention,))
+        self.last_prune = now
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+                now = self.clock()
+                if now - self.last_prune >= PRUNE_INTERVAL:
+                    self.prune(now)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write history: {e}")
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.open()
+            self.thread = threading.Thread(target=self.run, name='history_writer', daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(5)
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to write history on shutdown: {e}")
+
+
+def lttb(times: list, values: list, points: int) -> Tuple[list, list]:
+    # largest triangle three buckets, keeps the points that matter visually when thinning a series
+    if points >= len(values) or points < 3:
+        return times, values
+    sampled_times, sampled_values = [times[0]], [values[0]]
+    every = (len(values) - 2) / (points - 2)
+    a = 0
+    for i in range(points - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(values))
+        if next_end > end:
+            avg_time = sum(times[end:next_end]) / (next_end - end)
+            avg_value = sum(values[end:next_end]) / (next_end - end)
+        else:
+            avg_time, avg_value = times[-1], values[-1]
+        best, best_area = start, -1
+        for j in range(start, end):
+            area = abs((times[a] - avg_time) * (values[j] - values[a]) - (times[a] - times[j]) * (avg_value - values[a]))
+            if area > best_area:
+                best, best_area = j, area
+        sampled_times.append(times[best])
+        sampled_values.append(values[best])
+        a = best
+    sampled_times.append(times[-1])
+    sampled_values.append(values[-1])
+    return sampled_times, sampled_values
+
+
+def select_tier(width: float, age: float) -> int:
+    # the coarsest tier that still gives at least one bucket per requested point, 0 is the raw samples. if that
+    # tier has already dropped the start of the range, step up to one that still has it
+    tiers = [(0, RAW_RETENTION)] + ROLLUP_TIERS
+    index = 0
+    for i, (bucket, _) in enumerate(tiers):
+        if bucket <= width:
+            index = i
+    while index < len(tiers) - 1 and tiers[index][1] < age:
+        index += 1
+    return tiers[index][0]
+
+
+class HistoryReader:
+    # query side of the history store, only ever reads the rollup tier that fits the requested resolution
+    def __init__(self, path: str = HISTORY_PATH, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = None
+
+    def open(self) -> bool:
+        if self.db is None and os.path.exists(self.path):
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+        return self.db is not None
+
+    def channels(self) -> Dict[str, int]:
+        if not self.open():
+            return {}
+        with self.lock:
+            return dict(self.db.execute("SELECT name, id FROM channels").fetchall())
+
+    def buckets(self, channel: int, tier: int, start: float, end: float, width: float) -> Tuple[Dict[int, list], float]:
+        if tier == 0:
+            table, column, aggregates = 'samples', 'ts', 'count(*), min(value), max(value), sum(value)'
+        else:
+            table, column, aggregates = f'rollup_{tier}', 'bucket', 'sum(count), min(min), max(max), sum(sum)'
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT CAST(({column} - ?) / ? AS INTEGER) AS slot, {aggregates} FROM {table} "
+                f"WHERE channel = ? AND {column} >= ? AND {column} < ? GROUP BY slot",
+                (start, width, channel, start, end)).fetchall()
+            flushed = self.db.execute("SELECT max(ts) FROM samples WHERE channel = ?", (channel,)).fetchone()[0]
+        return {row[0]: list(row[1:]) for row in rows}, flushed or 0
+
+    def query(self, channels: Optional[List[str]] = None, start: Optional[float] = None, end: Optional[float] = None,
+              points: int = HISTORY_POINTS, method: str = 'minmax', recent: list = ()) -> dict:
+        # recent is the in-memory ring from the recorder, anything in it the writer hasn't flushed yet gets merged in
+        end = self.clock() if end is None else end
+        start = end - 24 * 60 * 60 if start is None else start
+        points = max(1, min(points, MAX_HISTORY_POINTS))
+        slots = points * LTTB_OVERSAMPLE if method == 'lttb' else points
+        width = max((end - start) / slots, 1e-3)
+        tier = select_tier(width, self.clock() - start)
+        known = self.channels()
+        series = {}
+        if channels is None:
+            channels = sorted(set(known).union(*(values for _, values in recent[-1:])))
+        for name in channels:
+            buckets, flushed = self.buckets(known[name], tier, start, end, width) if name in known else ({}, 0)
+            for timestamp, values in recent:
+                value = values.get(name)
+                if value is None or round(timestamp, 3) <= flushed or not start <= timestamp < end:
+                    continue
+                slot = int((timestamp - start) / width)
+                bucket = buckets.get(slot)
+                if bucket is None:
+                    buckets[slot] = [1, value, value, value]
+                else:
+                    bucket[0] += 1
+                    bucket[1] = min(bucket[1], value)
+                    bucket[2] = max(bucket[2], value)
+                    bucket[3] += value
+            ordered = sorted(buckets.items())
+            times = [round(start + slot * width, 3) for slot, _ in ordered]
+            if method == 'lttb':
+                times, values = lttb(times, [round(b[3] / b[0], 3) for _, b in ordered], points)
+                series[name] = {'t': times, 'value': values}
+            else:
+                series[name] = {
+                    't': times,
+                    'min': [b[1] for _, b in ordered],
+                    'max': [b[2] for _, b in ordered],
+                    'avg': [round(b[3] / b[0], 3) for _, b in ordered],
+                }
+        return {'start': start, 'end': end, 'width': width, 'tier': tier, 'method': method, 'series': series}
+
+    def channel_rows(self, db: sqlite3.Connection, name: str, channel: int, tier: int, start: float, end: float):
+        # keyset paging, every page is its own short read so a long export never pins the WAL
+        if tier == 0:
+            sql = "SELECT ts, value FROM samples WHERE channel = ? AND ts > ? AND ts < ? ORDER BY ts LIMIT ?"
+        else:
+            sql = (f"SELECT bucket, count, min, max, round(sum / count, 3) FROM rollup_{tier} "
+                   f"WHERE channel = ? AND bucket > ? AND bucket < ? ORDER BY bucket LIMIT ?")
+        last = start - 1e-3
+        while True:
+            page = db.execute(sql, (channel, last, end, EXPORT_PAGE)).fetchall()
+            for row in page:
+                yield (row[0], name) + row[1:]
+            if len(page) < EXPORT_PAGE:
+                return
+            last = page[-1][0]
+
+    def rows(self, channels: Optional[List[str]] = None, start: float = 0, end: Optional[float] = None,
+             tier: int = 0):
+        # every channel in time order, merged lazily so memory stays the same whatever the range
+        if not os.path.exists(self.path):
+            return
+        end = self.clock() if end is None else end
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            known = dict(db.execute("SELECT name, id FROM channels").fetchall())
+            names = [name for name in channels if name in known] if channels is not None else sorted(known)
+            yield from heapq.merge(*(self.channel_rows(db, name, known[name], tier, start, end) for name in names))
+        finally:
+            db.close()
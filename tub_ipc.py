@@ -0,0 +1,277 @@
+import itertools
+import json
+import logging
+import mmap
+import os
+import signal
+import struct
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import get_context, shared_memory
+from typing import Optional, Tuple
+
+from tub_commands import Command, COMMAND_HISTORY
+from tub_metrics import registry
+
+logger = logging.getLogger(__name__)
+
+STATE_BLOCK_NAME = 'hotcon_state'
+STATE_BLOCK_SIZE = 64 * 1024
+STATE_WATCH_INTERVAL = 0.05  # seconds between seqno checks when the API process watches for new state
+SEQLOCK_RETRIES = 100
+SEQLOCK_BACKOFF = 0.0005  # seconds to sleep before retrying a read that overlapped a write
+CONTROL_PROCESS_CPU = None  # pin the control process to this core, e.g. 3, None lets the kernel decide
+
+# seqno, payload length. the seqno is odd while the writer is in the middle of an update
+HEADER = struct.Struct('<QI')
+SEQNO = struct.Struct('<Q')
+LENGTH = struct.Struct('<I')
+
+
+class ControlUnavailable(Exception):
+    # the control process hasn't published its first state yet, or is gone
+    pass
+
+
+class SharedStateBlock:
+    # seqlock over a /dev/shm block: one writer in the control process, any number of read-only mappings
+    def __init__(self, name: str = STATE_BLOCK_NAME, writable: bool = False):
+        self.file = open('/dev/shm/' + name, 'r+b' if writable else 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.seq = SEQNO.unpack_from(self.map, 0)[0]
+
+    def write(self, payload: bytes) -> None:
+        if HEADER.size + len(payload) > len(self.map):
+            logger.error(f"State payload of {len(payload)} bytes does not fit the shared state block")
+            return
+        SEQNO.pack_into(self.map, 0, self.seq + 1)
+        self.map[HEADER.size:HEADER.size + len(payload)] = payload
+        LENGTH.pack_into(self.map, SEQNO.size, len(payload))
+        self.seq += 2
+        SEQNO.pack_into(self.map, 0, self.seq)
+
+    def seqno(self) -> int:
+        return SEQNO.unpack_from(self.map, 0)[0]
+
+    def read(self) -> Optional[Tuple[int, bytes]]:
+        for _ in range(SEQLOCK_RETRIES):
+            seq, length = HEADER.unpack_from(self.map, 0)
+            if not seq & 1:
+                payload = self.map[HEADER.size:HEADER.size + length]
+                if SEQNO.unpack_from(self.map, 0)[0] == seq:
+                    return seq, payload
+            # the writer is another process, spinning would only keep it off the CPU
+            time.sleep(SEQLOCK_BACKOFF)
+        return None
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+
+class ControlServer:
+    # lives in the control process, publishes the state block after every tick and serves the command pipe
+    def __init__(self, conn, block: SharedStateBlock):
+        self.conn = conn
+        self.block = block
+        self.send_lock = threading.Lock()
+
+    def send(self, message: tuple) -> None:
+        with self.send_lock:
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to send to the API process: {e}")
+
+    def publish(self, cs, timers) -> None:
+        payload = {'state': cs.get_state(), 'timers': timers.pending()}
+        self.block.write(json.dumps(payload).encode())
+
+    def serve(self, cs, stop) -> None:
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                logger.warning("Command pipe closed, stopping the control loop")
+                stop()
+                return
+            kind = message[0]
+            if kind == 'command':
+                _, request_id, device, action, value = message
+                command = cs.commands.submit(device, action, value)
+                command.add_done_callback(
+                    lambda done, request_id=request_id: self.send(('done', request_id, done.status, done.result)))
+            elif kind == 'batch':
+                _, requests = message
+                commands = cs.commands.submit_batch([request[1:] for request in requests])
+                for request, command in zip(requests, commands):
+                    command.add_done_callback(
+                        lambda done, request_id=request[0]: self.send(('done', request_id, done.status, done.result)))
+            elif kind == 'setpoint':
+                cs.change_setpoint(message[1])
+            elif kind == 'mode':
+                cs.change_mode(message[1])
+            elif kind == 'metrics':
+                self.send(('reply', message[1], registry.render()))
+            elif kind == 'shutdown':
+                stop()
+                return
+
+
+class RemoteControl:
+    # the API side of a split deployment, state comes from the shared block and commands go over the pipe
+    def __init__(self, conn, block_name: str = STATE_BLOCK_NAME):
+        self.conn = conn
+        self.block = SharedStateBlock(block_name)
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.commands = OrderedDict()
+        self.requests = {}  # request id -> Command standing in for a reply that isn't a device command
+        self.cached_seq = None
+        self.cached = {'state': {}, 'timers': []}
+        self.thread = threading.Thread(target=self.receive, name='control_pipe', daemon=True)
+        self.thread.start()
+
+    def send(self, message: tuple) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+    def receive(self) -> None:
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                logger.error("Control process pipe closed")
+                return
+            if message[0] == 'done':
+                _, request_id, status, result = message
+                command = self.commands.get(request_id)
+                if command:
+                    command.complete(status, result)
+            elif message[0] == 'reply':
+                _, request_id, result = message
+                request = self.requests.pop(request_id, None)
+                if request:
+                    request.complete('done', result)
+
+    def snapshot(self) -> dict:
+        seq = self.block.seqno()
+        if seq != self.cached_seq:
+            read = self.block.read()
+            if read and read[1]:
+                self.cached_seq = read[0]
+                self.cached = json.loads(read[1])
+        if self.cached_seq is None:
+            raise ControlUnavailable("The control loop has not published its state yet.")
+        return self.cached
+
+    def get_state(self) -> dict:
+        return self.snapshot()['state']
+
+    def device_names(self) -> list:
+        state = self.get_state()
+        return list(state.get('devices', {})) + list(state.get('main_pumps', {}))
+
+    def submit(self, device: str, action: str, value=None) -> Command:
+        command = Command(next(self.ids), device, action, value)
+        self.commands[command.id] = command
+        while len(self.commands) > COMMAND_HISTORY and next(iter(self.commands.values())).done():
+            self.commands.popitem(last=False)
+        self.send(('command', command.id, device, action, value))
+        return command
+
+    def submit_batch(self, items: list) -> list:
+        commands = [Command(next(self.ids), device, action, value) for device, action, value in items]
+        for command in commands:
+            self.commands[command.id] = command
+        self.send(('batch', [(command.id, command.device, command.action, command.value) for command in commands]))
+        return commands
+
+    def get_command(self, command_id: int) -> Optional[Command]:
+        return self.commands.get(command_id)
+
+    def change_setpoint(self, temperature: float) -> None:
+        self.send(('setpoint', temperature))
+
+    def change_mode(self, mode: str) -> None:
+        self.send(('mode', mode))
+
+    def pending_timers(self) -> list:
+        return self.snapshot()['timers']
+
+    def history_recent(self, since: float) -> list:
+        # the ring buffer lives in the control process, history here lags by up to one flush interval
+        return []
+
+    def metrics(self) -> Command:
+        # rendered in the control process, where the loop's metrics are recorded
+        request = Command(next(self.ids), 'metrics', 'render')
+        self.requests[request.id] = request
+        while len(self.requests) > COMMAND_HISTORY:  # replies that never came, e.g. the process died
+            self.requests.pop(next(iter(self.requests)))
+        self.send(('metrics', request.id))
+        return request
+
+    def subscribe(self, callback) -> None:
+        def watch():
+            seq = None
+            while True:
+                if self.block.seqno() != seq:
+                    try:
+                        state = self.get_state()
+                        seq = self.cached_seq
+                        callback(state)
+                    except ControlUnavailable:
+                        pass
+                time.sleep(STATE_WATCH_INTERVAL)
+
+        threading.Thread(target=watch, name='state_watch', daemon=True).start()
+
+
+def run_control_process(conn, block_name: str, cpu: Optional[int]) -> None:
+    # the terminal's ctrl-c goes to the whole process group, shutdown is driven by the API process instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    import tub_control
+    tub_control.init_system()
+    server = ControlServer(conn, SharedStateBlock(block_name, writable=True))
+    tub_control.cs.tick_listeners.append(tub_control.on_state_change(lambda cs: server.publish(cs, tub_control.timers)))
+    signal.signal(signal.SIGTERM, lambda *args: tub_control.stop_tub_system())
+    threading.Thread(target=server.serve, args=(tub_control.cs, tub_control.stop_tub_system),
+                     name='command_pipe', daemon=True).start()
+    try:
+        tub_control.start_tub_system()
+    finally:
+        tub_control.handle_exit_tub()
+
+
+class ControlProcess:
+    def __init__(self, block_name: str = STATE_BLOCK_NAME, cpu: Optional[int] = CONTROL_PROCESS_CPU):
+        self.block_name = block_name
+        try:
+            shared_memory.SharedMemory(name=block_name).unlink()  # left over from a crash
+        except FileNotFoundError:
+            pass
+        self.shm = shared_memory.SharedMemory(name=block_name, create=True, size=STATE_BLOCK_SIZE)
+        # spawn, so the API process never imports tub_control and never touches the hardware
+        context = get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_control_process, args=(child_conn, block_name, cpu),
+                                       name='tub_control', daemon=True)
+
+    def start(self) -> RemoteControl:
+        self.process.start()
+        return RemoteControl(self.conn, self.block_name)
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(('shutdown',))
+        except (OSError, ValueError):
+            pass
+        self.process.join(10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,158 @@
+import math
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Sequence, Tuple
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from a quick tick phase on the Pi up to a stalled I2C bus or a 1-wire read that ran into its retries
+TIMING_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Shards:
+    # one accumulator per writing thread, so an update never takes a lock or races another writer, a scrape sums
+    # them all. a scrape that catches a shard in the middle of an update is at most one observation behind
+    def __init__(self, size: int):
+        self.size = size
+        self.local = threading.local()
+        self.shards = []
+
+    def mine(self) -> list:
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = [0] * self.size
+            self.shards.append(shard)
+        return shard
+
+    def totals(self) -> list:
+        totals = [0] * self.size
+        for shard in list(self.shards):
+            for index, value in enumerate(shard):
+                totals[index] += value
+        return totals
+
+
+class Counter:
+    def __init__(self):
+        self.shards = Shards(1)
+
+    def inc(self, amount: float = 1) -> None:
+        self.shards.mine()[0] += amount
+
+    def samples(self, name: str, labels: str) -> list:
+        return [f"{name}{labels} {format_value(self.shards.totals()[0])}"]
+
+
+class Histogram:
+    # per bucket counts, made cumulative when rendered, then the sum of every observation
+    def __init__(self, buckets: Sequence[float] = TIMING_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.shards = Shards(len(self.buckets) + 2)
+
+    def observe(self, value: float) -> None:
+        shard = self.shards.mine()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def samples(self, name: str, labels: str) -> list:
+        totals = self.shards.totals()
+        prefix = labels[:-1] + ',' if labels else '{'
+        lines = []
+        count = 0
+        for bound, observed in zip(self.buckets + (math.inf,), totals):
+            count += observed
+            lines.append(f"{name}_bucket{prefix}le=\"{format_value(bound)}\"}} {count}")
+        lines.append(f"{name}_sum{labels} {format_value(totals[-1])}")
+        lines.append(f"{name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    # read when scraped, nothing to record
+    def __init__(self, function: Callable[[], float]):
+        self.function = function
+
+    def samples(self, name: str, labels: str) -> list:
+        try:
+            value = self.function()
+        except Exception:
+            value = math.nan
+        return [f"{name}{labels} {format_value(math.nan if value is None else value)}"]
+
+
+class Family:
+    def __init__(self, name: str, description: str, kind: str, label_names: Tuple[str, ...], make: Callable):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.label_names = label_names
+        self.make = make
+        self.children: Dict[tuple, object] = {}
+
+    def labels(self, *values):
+        # look the child up once and keep it, the update itself is the cheap part
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes labels {', '.join(self.label_names)}")
+            child = self.children.setdefault(values, self.make())
+        return child
+
+    def render(self) -> list:
+        description = self.description.replace('\\', '\\\\').replace('\n', '\\n')
+        lines = [f"# HELP {self.name} {description}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self.children.items()):
+            pairs = ','.join(f'{label}="{escape(value)}"' for label, value in zip(self.label_names, values))
+            lines.extend(child.samples(self.name, '{' + pairs + '}' if pairs else ''))
+        return lines
+
+
+class Registry:
+    # the metrics of one process. every family belongs to the process that records it: tub_control and tub_hal in
+    # the control process, tub_api in the API process, so a split deployment can just append the two scrapes
+    def __init__(self):
+        self.families: Dict[str, Family] = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, description: str, kind: str, label_names: Sequence[str], make: Callable):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(name, description, kind, tuple(label_names), make)
+            elif family.kind != kind:
+                raise ValueError(f"{name} is already registered as a {family.kind}")
+        return family
+
+    def counter(self, name: str, description: str, label_names: Sequence[str] = ()) -> Family:
+        return self.register(name, description, 'counter', label_names, Counter)
+
+    def histogram(self, name: str, description: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = TIMING_BUCKETS) -> Family:
+        return self.register(name, description, 'histogram', label_names, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, description: str, function: Callable[[], float]) -> Family:
+        family = self.register(name, description, 'gauge', (), lambda: Gauge(function))
+        family.labels()
+        return family
+
+    def render(self) -> str:
+        lines = []
+        for family in list(self.families.values()):
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+registry = Registry()
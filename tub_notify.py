@@ -0,0 +1,173 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_QUEUE_SIZE = 64  # distinct messages waiting to go out, the oldest is dropped past this
+NOTIFY_TIMEOUT = (3, 10)  # connect and read timeouts in seconds for one webhook post
+NOTIFY_RETRIES = 4
+NOTIFY_BACKOFF = 2  # seconds before the first retry, doubled on every retry after that
+NOTIFY_MAX_BACKOFF = 60
+NOTIFY_MIN_INTERVAL = 2  # seconds between two sends to the same sink, discord allows about 30 a minute
+NOTIFY_DEDUP_WINDOW = 5 * 60  # seconds an identical message is held back after it was sent
+NOTIFY_SHUTDOWN_TIMEOUT = 5  # seconds shutdown waits for the queue to drain
+
+
+class NotificationError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DiscordSink:
+    def __init__(self, url: str, timeout=NOTIFY_TIMEOUT):
+        self.name = 'discord'
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()  # keeps the TLS connection to discord open between messages
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.last_send = 0
+
+    def send(self, text: str) -> None:
+        try:
+            response = self.session.post(self.url, data=json.dumps({"content": text}),
+                                         headers={"Content-Type": "application/json"}, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise NotificationError(str(e))
+        if response.status_code == 429:
+            raise NotificationError("rate limited", float(response.headers.get('Retry-After', NOTIFY_BACKOFF)))
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            raise NotificationError(str(e))
+
+
+class MemorySink:
+    # stand-in for a real sink in tests, keeps what it was sent and can be told to fail the next few sends
+    def __init__(self, failures: int = 0):
+        self.name = 'memory'
+        self.messages = []
+        self.failures = failures
+        self.last_send = 0
+
+    def send(self, text: str) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise NotificationError("simulated failure")
+        self.messages.append(text)
+
+
+class Notification:
+    def __init__(self, key: str, message: str, now: float):
+        self.key = key
+        self.message = message
+        self.count = 1
+        self.first_time = now
+
+    def text(self) -> str:
+        return self.message if self.count == 1 else f"{self.message} (x{self.count})"
+
+
+class Notifier:
+    # the caller only ever enqueues, a background thread does the sending. repeats of a queued message are folded
+    # into it, and a message that went out recently is held back and counted instead of sent again
+    def __init__(self, sinks: Optional[List] = None, queue_size: int = NOTIFY_QUEUE_SIZE,
+                 min_interval: float = NOTIFY_MIN_INTERVAL, dedup_window: float = NOTIFY_DEDUP_WINDOW):
+        self.sinks = sinks or []
+        self.queue_size = queue_size
+        self.min_interval = min_interval
+        self.dedup_window = dedup_window
+        self.condition = threading.Condition()
+        self.queue = OrderedDict()  # key -> Notification
+        self.sent = {}  # key -> (time sent, repeats held back since)
+        self.sending = False
+        self.dropped = 0
+        self.stopped = False
+        self.thread = None
+
+    def notify(self, message: str, key: Optional[str] = None) -> None:
+        if not self.sinks:
+            return
+        key = key or message
+        now = time.time()
+        with self.condition:
+            pending = self.queue.get(key)
+            if pending is not None:
+                pending.count += 1
+                return
+            sent = self.sent.get(key)
+            if sent is not None and now - sent[0] < self.dedup_window:
+                self.sent[key] = (sent[0], sent[1] + 1)
+                return
+            notification = Notification(key, message, now)
+            if sent is not None and sent[1]:
+                notification.count += sent[1]
+            if len(self.queue) >= self.queue_size:
+                self.queue.popitem(last=False)
+                self.dropped += 1
+            self.queue[key] = notification
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='notifier', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def deliver(self, sink, text: str) -> bool:
+        delay = NOTIFY_BACKOFF
+        for attempt in range(NOTIFY_RETRIES + 1):
+            wait = sink.last_send + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                sink.send(text)
+                sink.last_send = time.time()
+                return True
+            except NotificationError as e:
+                sink.last_send = time.time()
+                if attempt == NOTIFY_RETRIES or self.stopped:
+                    logger.error(f"Giving up on {sink.name} notification after {attempt + 1} attempts: {e}")
+                    return False
+                logger.warning(f"{sink.name} notification failed, retrying in {e.retry_after or delay}s: {e}")
+                time.sleep(e.retry_after or delay)
+                delay = min(delay * 2, NOTIFY_MAX_BACKOFF)
+        return False
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.sending = False
+                    self.condition.notify_all()
+                    if self.stopped:
+                        return
+                    self.condition.wait()
+                _, notification = self.queue.popitem(last=False)
+                self.sending = True
+                self.sent = {key: sent for key, sent in self.sent.items()
+                             if time.time() - sent[0] < self.dedup_window}
+                self.sent[notification.key] = (time.time(), 0)
+            for sink in self.sinks:
+                self.deliver(sink, notification.text())
+
+    def flush(self, timeout: float = NOTIFY_SHUTDOWN_TIMEOUT) -> bool:
+        # wait for everything queued to go out, used on shutdown so the last messages aren't lost
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.queue or self.sending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def stop(self, timeout: float = NOTIFY_SHUTDOWN_TIMEOUT) -> None:
+        self.flush(timeout)
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
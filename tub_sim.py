@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from tub_hal import VirtualClock
+
+logger = logging.getLogger(__name__)
+
+# relay outputs on the expander as wired in tub_control, and the flow switch input
+SIM_PINS = {
+    'light': 0, 'blower': 1, 'circpump': 2, 'pump2_low': 3, 'pump1_low': 4, 'pump2_high': 5, 'pump1_high': 6,
+    'heater': 7, 'ozone': 9, 'fans': 10,
+}
+SIM_FLOW_PIN = 8
+SIM_SENSOR_IDS = {name: f'28-sim-{name}' for name in ['water', 'heater1', 'heater2', 'ambient', 'cabinet',
+                                                        'control_box']}
+
+SIM_WATER_CAPACITY = 1500 * 4186  # J per C, about 1500 litres
+SIM_HEATER_POWER = 5500  # W
+SIM_WATER_LOSS = 30  # W per C to ambient with the cover on
+SIM_JETS_LOSS = 150  # W per C on top of that while the jets or blower run
+SIM_PUMP_HEAT = {'low': 300, 'high': 1200}  # W of pump motor heat that ends up in the water
+SIM_HEATER_RISE = 6  # C the heater probes sit above the water with flow
+SIM_DRY_HEATER = 250  # C a heater element heads for without flow
+SIM_PROBE_TAU = 20  # seconds
+SIM_CABINET_TAU = 900
+SIM_CONTROL_BOX_TAU = 600
+# with only the circ pump moving water the probe in its loop drifts away from the bulk of the water, the main pumps
+# mix it back within a minute or two
+SIM_STRATIFICATION = -0.8  # C the probe settles at relative to the mixed water
+SIM_STRATIFY_TAU = 2 * 60 * 60
+SIM_MIX_TAU = 40
+
+
+def relax(value: float, target: float, dt: float, tau: float) -> float:
+    # exact first order step, stable for any dt
+    return target + (value - target) * math.exp(-dt / tau)
+
+
+class ThermalModel:
+    # lumped model of the tub: water, heater probes, cabinet and control box, with a daily ambient swing. all C
+    def __init__(self, water: float = 37.0, ambient_mean: float = 10.0, ambient_swing: float = 6.0):
+        self.water = water
+        self.ambient_mean = ambient_mean
+        self.ambient_swing = ambient_swing
+        self.heater = water
+        self.probe_offset = 0.0
+        self.settle(time.time())
+
+    def settle(self, timestamp: float) -> None:
+        # start the air temperatures where they would be at this time of day
+        self.ambient = self.ambient_at(timestamp)
+        self.cabinet = self.ambient + 4
+        self.control_box = self.cabinet + 5
+
+    def ambient_at(self, timestamp: float) -> float:
+        local = time.localtime(timestamp)
+        hour = local.tm_hour + local.tm_min / 60
+        return self.ambient_mean + self.ambient_swing * math.sin(2 * math.pi * (hour - 9) / 24)
+
+    def step(self, dt: float, timestamp: float, on: dict, flowing: bool) -> None:
+        if dt <= 0:
+            return
+        self.ambient = self.ambient_at(timestamp)
+        pump_speeds = [speed for speed in (on['pump1'], on['pump2']) if speed != 'off']
+        heating = on['heater'] and flowing
+        power = (SIM_HEATER_POWER if heating else 0) + sum(SIM_PUMP_HEAT[speed] for speed in pump_speeds)
+        loss = SIM_WATER_LOSS + (SIM_JETS_LOSS if pump_speeds or on['blower'] else 0)
+        self.water = relax(self.water, self.ambient + power / loss, dt, SIM_WATER_CAPACITY / loss)
+        if on['heater'] and not flowing:
+            heater_target = SIM_DRY_HEATER
+        else:
+            heater_target = self.water + (SIM_HEATER_RISE if heating else 0)
+        self.heater = relax(self.heater, heater_target, dt, SIM_PROBE_TAU)
+        if pump_speeds:
+            self.probe_offset = relax(self.probe_offset, 0.0, dt, SIM_MIX_TAU)
+        else:
+            self.probe_offset = relax(self.probe_offset, SIM_STRATIFICATION, dt, SIM_STRATIFY_TAU)
+        cabinet_target = self.ambient + 4 + 8 * len(pump_speeds) + (3 if on['heater'] else 0)
+        if on['fans']:
+            cabinet_target -= 0.6 * (cabinet_target - self.ambient)
+        self.cabinet = relax(self.cabinet, cabinet_target, dt, SIM_CABINET_TAU)
+        self.control_box = relax(self.control_box, self.cabinet + 5, dt, SIM_CONTROL_BOX_TAU)
+
+    def reading(self, name: str) -> float:
+        if name in ('heater1', 'heater2'):
+            return self.heater
+        if name == 'water':
+            return self.water + self.probe_offset
+        return getattr(self, name)
+
+
+class SimBackend:
+    # stands in for tub_hal.PiBackend: keeps the expander ports in memory, derives flow from the pump relays and
+    # answers 1-wire reads from the thermal model. on a VirtualClock the model steps every time the clock moves, on
+    # a real one it catches up whenever the control side reads or writes
+    def __init__(self, clock, model: Optional[ThermalModel] = None, glitch_rate: float = 0.0,
+                 seed: int = 0):
+        self.clock = clock
+        self.model = model or ThermalModel()
+        self.ports = [0, 0]
+        self.sensor_ids = SIM_SENSOR_IDS
+        self.sensor_names = {sensor_id: name for name, sensor_id in SIM_SENSOR_IDS.items()}
+        self.resolutions = {}
+        self.glitch_rate = glitch_rate
+        self.random = random.Random(seed)
+        self.interrupt_callback = None
+        self.flowing = False
+        self.on = self.outputs()
+        self.last_step = clock.time()
+        self.model.settle(self.last_step)
+        self.lock = threading.RLock()  # the sensor thread and the control loop both read on a real clock
+        self.lazy = not isinstance(clock, VirtualClock)
+        if not self.lazy:
+            clock.listeners.append(self.step)
+
+    def catch_up(self) -> None:
+        if self.lazy:
+            with self.lock:
+                self.step(self.clock.time())
+
+    def pin(self, number: int) -> bool:
+        return bool(self.ports[number // 8] & (1 << (number % 8)))
+
+    def outputs(self) -> dict:
+        def pump(name):
+            if self.pin(SIM_PINS[name + '_high']):
+                return 'high'
+            return 'low' if self.pin(SIM_PINS[name + '_low']) else 'off'
+        on = {name: self.pin(number) for name, number in SIM_PINS.items()}
+        on['pump1'] = pump('pump1')
+        on['pump2'] = pump('pump2')
+        return on
+
+    def step(self, now: float) -> None:
+        on = self.on
+        self.model.step(now - self.last_step, now, on, self.flowing)
+        self.last_step = max(now, self.last_step)
+        flowing = on['circpump'] or on['pump1'] != 'off' or on['pump2'] != 'off'
+        if flowing != self.flowing:
+            self.flowing = flowing
+            if self.interrupt_callback:
+                self.interrupt_callback(0)
+
+    def read_port(self, port: int) -> int:
+        self.catch_up()
+        value = self.ports[port]
+        if port == SIM_FLOW_PIN // 8:
+            flow_mask = 1 << (SIM_FLOW_PIN % 8)
+            value = value & ~flow_mask | (0 if self.flowing else flow_mask)  # the switch pulls low with flow
+        return value
+
+    def write_port(self, port: int, value: int) -> None:
+        self.catch_up()
+        self.ports[port] = value
+        self.on = self.outputs()
+        self.catch_up()  # flow follows the pumps straight away
+
+    def setup_output(self, number: int) -> None:
+        pass
+
+    def setup_input(self, number: int) -> None:
+        pass
+
+    def read_pin(self, number: int) -> bool:
+        return bool(self.read_port(number // 8) & (1 << (number % 8)))
+
+    def setup_interrupt(self, number: int, gpio: Optional[int], callback) -> bool:
+        # same contract as PiBackend, no interrupt line configured means the flow switch gets polled
+        if gpio is None:
+            return False
+        self.interrupt_callback = callback
+        return True
+
+    def remove_interrupt(self) -> None:
+        self.interrupt_callback = None
+
+    def w1_read(self, sensor_id: str) -> list:
+        self.catch_up()
+        temp_c = self.model.reading(self.sensor_names[sensor_id])
+        step = 0.5 / 2 ** (self.resolutions.get(sensor_id, 12) - 9)
+        temp_c = round(temp_c / step) * step
+        if self.glitch_rate and self.random.random() < self.glitch_rate:
+            temp_c = 85.0
+        return ["72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n", f"72 01 4b 46 7f ff 0e 10 57 t={round(temp_c * 1000)}\n"]
+
+    def w1_set_resolution(self, sensor_id: str, bits: int) -> None:
+        self.resolutions[sensor_id] = bits
+
+    def w1_bulk_supported(self) -> bool:
+        return True
+
+    def w1_bulk_convert(self) -> bool:
+        return True
+
+
+def run_scenario(hours: float = 24, start: Optional[float] = None, water: float = 37.0, ambient_mean: float = 10.0,
+                 ambient_swing: float = 6.0, set_temperature: Optional[float] = None, glitch_rate: float = 0.0,
+                 history: Optional[str] = None) -> dict:
+    # runs the real ComponentSystem and tub_loop against the simulated tub on virtual time. tub_control keeps
+    # one system per process, so this runs once per process. with a history path the run is recorded there,
+    # flushed on virtual time, which also feeds the thermal model
+    import tub_control
+    from tub_history import HistoryStore, FLUSH_INTERVAL
+    clock = VirtualClock(start)
+    sim = SimBackend(clock, ThermalModel(water, ambient_mean, ambient_swing), glitch_rate)
+    system = tub_control.init_system(sim, clock)
+    acquisition = system.sensor_acquisition
+    acquisition.inline = True
+    clock.listeners.append(lambda now: acquisition.dispatch())
+    clock.deadline_sources.append(acquisition.scheduler.next_deadline)
+    if set_temperature is not None:
+        system.change_setpoint(set_temperature)
+    if history is not None:
+        store = HistoryStore(history, clock=clock.time)
+        store.open()
+        store.flush_hooks = system.history.flush_hooks
+        system.history = store
+        system.record_history()
+        next_flush = [clock.time() + FLUSH_INTERVAL]
+
+        def flush(now):
+            if now >= next_flush[0]:
+                store.flush()
+                next_flush[0] = now + FLUSH_INTERVAL
+        clock.listeners.append(flush)
+    ticks = []
+    alerts = []
+    system.tick_listeners.append(lambda cs: ticks.append(1))
+    system.alerts.notify = lambda message, key: alerts.append(f"{datetime.fromtimestamp(clock.time())} {message}")
+    started = clock.time()
+    wall_start = time.perf_counter()
+    asyncio.run(tub_control.tub_loop(until=started + hours * 3600))
+    wall = time.perf_counter() - wall_start
+    if history is not None:
+        system.history.flush()
+    runtime = {}
+    for (period, _, device, state), (seconds, starts, kwh) in tub_control.usage.checkpoint(clock.time()).items():
+        if period != 'month':
+            continue
+        entry = runtime.setdefault(device, {'seconds': {}, 'starts': 0, 'kwh': 0.0})
+        entry['seconds'][state] = round(entry['seconds'].get(state, 0) + seconds)
+        entry['starts'] += starts
+        entry['kwh'] = round(entry['kwh'] + kwh, 3)
+    return {
+        'simulated_hours': hours,
+        'wall_seconds': round(wall, 3),
+        'speedup': round(hours * 3600 / wall) if wall else None,
+        'ticks': len(ticks),
+        'temperatures': {sensor.name: sensor.f() for sensor in system.temp_sensors},
+        'usage': runtime,
+        'alerts': alerts,
+        'thermal': system.get_state()['thermal'],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the control loop against a simulated tub on virtual time")
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--start', help="local start time, e.g. 2024-01-15T00:00, defaults to now")
+    parser.add_argument('--water', type=float, default=37.0, help="starting water temperature in C")
+    parser.add_argument('--ambient', type=float, default=10.0, help="mean ambient temperature in C")
+    parser.add_argument('--swing', type=float, default=6.0, help="daily ambient swing in C")
+    parser.add_argument('--setpoint', type=float, help="set temperature in F")
+    parser.add_argument('--glitch-rate', type=float, default=0.0, help="share of sensor reads that return 85.0C")
+    parser.add_argument('--history', help="record the run to this history database")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    start_time = datetime.fromisoformat(args.start).timestamp() if args.start else None
+    result = run_scenario(args.hours, start_time, args.water, args.ambient, args.swing, args.setpoint,
+                          args.glitch_rate, args.history)
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import threading
+from typing import Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODINGS = ['json', 'msgpack'] if msgpack else ['json']
+
+
+def diff_state(old: dict, new: dict):
+    # changed subtrees of new compared to old, plus the paths of keys that went away
+    changes = {}
+    removed = []
+    for key, value in new.items():
+        if key not in old:
+            changes[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            sub_changes, sub_removed = diff_state(old[key], value)
+            if sub_changes:
+                changes[key] = sub_changes
+            removed.extend([key] + path for path in sub_removed)
+        elif value != old[key]:
+            changes[key] = value
+    removed.extend([key] for key in old if key not in new)
+    return changes, removed
+
+
+def encode(message: dict, encoding: str):
+    if encoding == 'msgpack':
+        return msgpack.packb(message)
+    return json.dumps(message, separators=(',', ':'), ensure_ascii=False)
+
+
+class StateSnapshot:
+    def __init__(self, version: int, state: dict, changes: dict, removed: list):
+        self.version = version
+        self.state = state
+        self.changes = changes
+        self.removed = removed
+        self.encoded = {}
+
+    def cached(self, key, build):
+        # anything derived from a snapshot is built once per version no matter how many clients ask for it
+        if key not in self.encoded:
+            self.encoded[key] = build(self)
+        return self.encoded[key]
+
+    def message(self, kind: str, encoding: str = 'json'):
+        return self.cached((kind, encoding), lambda snapshot: encode(snapshot.build_message(kind), encoding))
+
+    def build_message(self, kind: str) -> dict:
+        if kind == 'legacy':
+            return self.state
+        if kind == 'snapshot':
+            return {'type': 'snapshot', 'version': self.version, 'state': self.state}
+        message = {'type': 'delta', 'version': self.version, 'base': self.version - 1, 'changes': self.changes}
+        if self.removed:
+            message['removed'] = self.removed
+        return message
+
+
+class StateFeed:
+    # versioned copy of ComponentSystem.get_state(), the version only moves when something in it changed
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+        self.loop = None
+        self.changed = None
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.changed = asyncio.Event()
+
+    def publish(self, state: dict) -> bool:
+        with self.lock:
+            if self.current is not None and state == self.current.state:
+                return False
+            if self.current is None:
+                self.current = StateSnapshot(1, state, state, [])
+            else:
+                changes, removed = diff_state(self.current.state, state)
+                self.current = StateSnapshot(self.current.version + 1, state, changes, removed)
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wake)
+        return True
+
+    def wake(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    @property
+    def version(self) -> int:
+        return self.current.version if self.current else 0
+
+    async def wait(self, after_version: int, timeout: Optional[float] = None) -> Optional[StateSnapshot]:
+        # the next snapshot newer than after_version, or whatever is current once the timeout runs out
+        if self.version <= after_version:
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.current
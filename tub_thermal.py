@@ -0,0 +1,251 @@
+import logging
+import math
+import time
+from collections import deque
+from typing import Dict, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tub_history import HISTORY_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+THERMAL_WINDOW = 10 * 60  # seconds of history behind each heating/loss observation
+THERMAL_HALF_LIFE = 14 * 24 * 60 * 60  # seconds until an observation counts half, lets the fit follow the seasons
+THERMAL_BACKFILL = 30 * 24 * 60 * 60  # history read from the one minute rollups when the model starts
+THERMAL_BACKFILL_TIER = 60
+THERMAL_MAX_GAP = 5  # seconds of missing samples bridged with the last value
+THERMAL_MIN_WINDOWS = 12  # observations, and as many with the heater on, before the fit is trusted
+THERMAL_MIX_TIME = 3 * 60  # seconds a main pump has to run before the water counts as mixed
+THERMAL_MAX_EVENTS = 200  # main pump starts kept for the stagnant water fit
+THERMAL_MIN_EVENTS = 5
+THERMAL_TAU_RANGE = (5 * 60, 12 * 60 * 60)  # seconds, time constants tried for the stagnant water drift
+THERMAL_TAU_STEPS = 32
+THERMAL_MAX_CORRECTION = 3.0  # F
+THERMAL_CHANNELS = ['water', 'ambient', 'heater', 'flow', 'pump1', 'pump2']
+
+
+def fill_gaps(values, limit: int):
+    # carry the last value over runs of at most limit missing samples, longer gaps stay missing
+    index = np.where(np.isnan(values), 0, np.arange(len(values)))
+    np.maximum.accumulate(index, out=index)
+    filled = values[index]
+    filled[np.arange(len(values)) - index > limit] = np.nan
+    return filled
+
+
+def load_grid(db, names: list, start: float, end: float, step: float, tier: int = 0):
+    # history on a uniform grid of step seconds from the raw samples, or from the averages of a rollup tier. a
+    # channel with no value in a slot is NaN there. returns (None, None) when a channel was never recorded
+    ids = dict(db.execute("SELECT name, id FROM channels").fetchall())
+    count = int((end - start) // step)
+    if count <= 0 or any(name not in ids for name in names):
+        return None, None
+    if tier:
+        query = f"SELECT bucket, sum / count FROM rollup_{tier} WHERE channel = ? AND bucket >= ? AND bucket < ?"
+    else:
+        query = "SELECT ts, value FROM samples WHERE channel = ? AND ts >= ? AND ts < ?"
+    times = start + step * np.arange(count)
+    data = {}
+    for name in names:
+        rows = np.array(db.execute(query, (ids[name], start, end)).fetchall(), dtype=float).reshape(-1, 2)
+        values = np.full(count, np.nan)
+        index = ((rows[:, 0] - start) // step).astype(int)
+        keep = (index >= 0) & (index < count)
+        values[index[keep]] = rows[keep, 1]
+        data[name] = fill_gaps(values, int(THERMAL_MAX_GAP // step))
+    return times, data
+
+
+class ThermalModel:
+    # water temperature as dT/dt = heating * heater + loss * (ambient - water) + jets * main pumps, in F and
+    # seconds. every observation is the change over one window against the inputs summed over it, so the fit is a
+    # 3x3 least squares problem kept as running normal equations that new history is folded into as it's written.
+    # separately, every main pump start measures how far the probe reading was off from the mixed water, which
+    # gives the correction for the reading after the pumps have been off a while
+    def __init__(self):
+        self.normal = None  # X'X
+        self.target = None  # X'y
+        self.windows = 0.0  # weighted observation count
+        self.heating_windows = 0.0
+        self.data_time = None  # newest observation folded in, the forgetting factor counts from it
+        self.coefficients = None  # (heating, loss, jets) once they make physical sense
+        self.window_cursor = 0.0
+        self.load_cursor = None
+        self.last_jets_time = -math.inf
+        self.last_event_time = -math.inf
+        self.events = deque(maxlen=THERMAL_MAX_EVENTS)  # (off seconds, reading change, input sums)
+        self.stagnant = None  # (scale F, time constant seconds)
+        self.fit_time = 0.0  # seconds the last update took
+        self.disabled = np is None
+        if self.disabled:
+            logger.warning("numpy is not installed, the thermal model is disabled")
+
+    def observe(self, times, data: Dict[str, object], step: float) -> None:
+        # folds a uniform grid of history into the fit, windows and pump starts already seen are skipped
+        n = len(times)
+        water, ambient, heater, flow = data['water'], data['ambient'], data['heater'], data['flow']
+        jets = np.minimum(np.fmax(data['pump1'], data['pump2']), 1.0)
+        valid = np.isfinite(water) & np.isfinite(ambient) & np.isfinite(heater) & np.isfinite(jets) & (flow == 1)
+        # one column at a time, a few months of 1 Hz samples shouldn't need a copy of everything per step
+        inputs = [np.where(valid, column, 0.0) for column in (heater, ambient - water, jets)]
+
+        width = max(int(round(THERMAL_WINDOW / step)), 1)
+        first = int(np.searchsorted(times, self.window_cursor - step / 2))
+        count = (n - 1 - first) // width
+        if count > 0:
+            span = slice(first, first + count * width)
+            sums = np.column_stack([column[span].reshape(count, width).sum(axis=1) for column in inputs]) * step
+            edges = first + width * np.arange(count + 1)
+            change = water[edges[1:]] - water[edges[:-1]]
+            ok = valid[span].reshape(count, width).all(axis=1) & valid[edges[1:]]
+            self.add_windows(sums[ok], change[ok], times[edges[:-1]][ok] + THERMAL_WINDOW)
+            self.window_cursor = times[first] + count * width * step
+
+        # pump starts: the reading just before the start against the reading once the water is mixed
+        mix = max(int(math.ceil(THERMAL_MIX_TIME / step)), 1)
+        running = jets > 0
+        on_index = np.flatnonzero(running)
+        starts = on_index[1:][np.diff(on_index) > 1]
+        if len(on_index) and on_index[0] > 0:
+            starts = np.concatenate(([on_index[0]], starts))
+        starts = starts[np.isfinite(jets[starts - 1]) & (times[starts] > self.last_event_time)]
+        # when the pumps last ran before each start, from this grid or the last one
+        previous = np.searchsorted(on_index, starts) - 1
+        last_on = np.where(previous >= 0, times[on_index[np.maximum(previous, 0)]], self.last_jets_time)
+        starts, last_on = starts[np.isfinite(last_on)], last_on[np.isfinite(last_on)]
+        pending = starts[starts + mix >= n]
+        complete = starts + mix < n
+        starts, last_on = starts[complete], last_on[complete]
+        if len(starts):
+            # only ever looked at around the starts, so count and sum through index lookups instead of cumsums
+            invalid, off_index = np.flatnonzero(~valid), np.flatnonzero(~running)
+            before, mixed = starts - 1, starts + mix
+            ok = ((np.searchsorted(invalid, mixed, 'right') == np.searchsorted(invalid, before))
+                  & (np.searchsorted(off_index, mixed, 'right') == np.searchsorted(off_index, starts)))
+            before, mixed, off = before[ok], mixed[ok], times[starts[ok]] - last_on[ok]
+            if len(before):
+                edges = np.column_stack([before, mixed]).ravel()
+                input_sums = [np.add.reduceat(column, edges)[::2] * step for column in inputs]
+                for i, j, off_seconds, *sums in zip(before, mixed, off, *input_sums):
+                    self.events.append((float(off_seconds), float(water[j] - water[i]),
+                                        tuple(float(value) for value in sums)))
+            self.last_event_time = float(times[starts[-1]])
+        self.fit_stagnant()
+
+        next_start = min([self.window_cursor] + [times[i - 1] for i in pending])
+        seen = on_index[times[on_index] < next_start]
+        if len(seen):
+            self.last_jets_time = float(times[seen[-1]])
+        self.load_cursor = float(next_start)
+
+    def add_windows(self, sums, change, ends) -> None:
+        if not len(change):
+            return
+        newest = float(ends[-1])
+        weights = 0.5 ** ((newest - ends) / THERMAL_HALF_LIFE)
+        if self.normal is None:
+            self.normal, self.target = np.zeros((3, 3)), np.zeros(3)
+        else:
+            decay = 0.5 ** (max(newest - self.data_time, 0.0) / THERMAL_HALF_LIFE)
+            self.normal *= decay
+            self.target *= decay
+            self.windows *= decay
+            self.heating_windows *= decay
+        weighted = sums * weights[:, None]
+        self.normal += weighted.T @ sums
+        self.target += weighted.T @ change
+        self.windows += float(weights.sum())
+        self.heating_windows += float(weights[sums[:, 0] > 0].sum())
+        self.data_time = newest
+        self.solve()
+
+    def solve(self) -> None:
+        if self.windows < THERMAL_MIN_WINDOWS or self.heating_windows < THERMAL_MIN_WINDOWS:
+            return
+        heating, loss, jets = np.linalg.lstsq(self.normal, self.target, rcond=None)[0]
+        if heating <= 0 or loss <= 0:
+            logger.info(f"Thermal fit came out unphysical, heating {heating:.3g} loss {loss:.3g}, keeping the last")
+            return
+        self.coefficients = (float(heating), float(loss), float(jets))
+
+    def fit_stagnant(self) -> None:
+        if len(self.events) < THERMAL_MIN_EVENTS or self.coefficients is None:
+            return
+        events = list(self.events)
+        off = np.array([event[0] for event in events])
+        # the part of each change the heater, losses and pumps account for isn't the probe catching up
+        offset = np.array([event[1] for event in events]) - np.array([event[2] for event in events]) @ np.array(
+            self.coefficients)
+        taus = np.geomspace(*THERMAL_TAU_RANGE, THERMAL_TAU_STEPS)
+        basis = 1 - np.exp(-off[:, None] / taus[None, :])
+        scale = (basis * offset[:, None]).sum(axis=0) / np.maximum((basis ** 2).sum(axis=0), 1e-12)
+        error = ((offset[:, None] - basis * scale) ** 2).sum(axis=0)
+        best = int(np.argmin(error))
+        self.stagnant = (float(scale[best]), float(taus[best]))
+
+    def update(self, db) -> None:
+        # history flush hook, runs on the writer thread inside its transaction. the first call reads the one
+        # minute rollups for a backfill, every call after that only the raw samples written since the last one
+        if self.disabled:
+            return
+        started = time.perf_counter()
+        try:
+            newest = db.execute("SELECT max(ts) FROM samples WHERE channel = "
+                                "(SELECT id FROM channels WHERE name = 'water')").fetchone()[0]
+            if newest is None:
+                return
+            if self.load_cursor is None:
+                end = newest // THERMAL_BACKFILL_TIER * THERMAL_BACKFILL_TIER
+                start = end - THERMAL_BACKFILL
+                times, data = load_grid(db, THERMAL_CHANNELS, start, end, THERMAL_BACKFILL_TIER, THERMAL_BACKFILL_TIER)
+                if times is not None:
+                    self.observe(times, data, THERMAL_BACKFILL_TIER)
+                self.window_cursor = self.load_cursor = end
+                self.last_jets_time = -math.inf  # the minute buckets are too coarse to carry over
+            start = self.load_cursor // HISTORY_INTERVAL * HISTORY_INTERVAL
+            end = start + ((newest - start) // HISTORY_INTERVAL + 1) * HISTORY_INTERVAL
+            times, data = load_grid(db, THERMAL_CHANNELS, start, end, HISTORY_INTERVAL)
+            if times is not None:
+                self.observe(times, data, HISTORY_INTERVAL)
+        except Exception as e:
+            logger.error(f"Failed to update the thermal model: {e}")
+        self.fit_time = time.perf_counter() - started
+
+    def correction(self, off_seconds: float) -> float:
+        # F to add to the water reading after the main pumps have been off this long
+        if self.stagnant is None or off_seconds <= 0:
+            return 0.0
+        scale, tau = self.stagnant
+        value = scale * (1 - math.exp(-off_seconds / tau))
+        return max(-THERMAL_MAX_CORRECTION, min(THERMAL_MAX_CORRECTION, value))
+
+    def time_to(self, target: float, water: float, ambient: float, jets: bool = False) -> Optional[float]:
+        # seconds of heating to bring the water to target, None when the heater can't get it there
+        if water >= target:
+            return 0.0
+        if self.coefficients is None:
+            return None
+        heating, loss, jets_rate = self.coefficients
+        equilibrium = ambient + (heating + (jets_rate if jets else 0.0)) / loss
+        if equilibrium <= target:
+            return None
+        return math.log((equilibrium - water) / (equilibrium - target)) / loss
+
+    def state(self, water: Optional[float], ambient: Optional[float], set_temperature: float, off_seconds: float,
+              jets: bool = False) -> dict:
+        correction = self.correction(off_seconds)
+        estimate = None if water is None else water + correction
+        eta = None if estimate is None or ambient is None else self.time_to(set_temperature, estimate, ambient, jets)
+        heating, loss, _ = self.coefficients or (None, None, None)
+        return {
+            'water_estimate': None if estimate is None else round(estimate, 1),
+            'correction': round(correction, 1),
+            'time_to_setpoint': None if eta is None else round(eta / 60),  # minutes
+            'heating_rate': None if heating is None else round(heating * 3600, 2),  # F per hour
+            'loss_rate': None if loss is None else round(loss * 3600, 4),  # per hour, times (water - ambient) in F
+            'stagnant_tau': None if self.stagnant is None else round(self.stagnant[1] / 60),  # minutes
+        }
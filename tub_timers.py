@@ -0,0 +1,109 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    def __init__(self, service: 'TimerService', deadline: float, callback: Callable, args: tuple, name: str,
+                 reason: Optional[str] = None):
+        self.service = service
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.name = name
+        self.reason = reason  # wake reason the control loop gets when this fires, e.g. 'devices', or None
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self) -> None:
+        self.service.cancel(self)
+
+    def active(self) -> bool:
+        return not (self.cancelled or self.fired)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'deadline': self.deadline,
+            'remaining': round(max(0.0, self.deadline - self.service.clock()), 1),
+        }
+
+
+class TimerService:
+    # one heap of deadlines for every timer in the system, callbacks fire from run_due() on the control thread.
+    # cancel only flags the entry, it is dropped when it reaches the top of the heap or on the next compaction
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.heap = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.cancelled_count = 0
+        self.listeners = []
+
+    def call_at(self, deadline: float, callback: Callable, *args, name: Optional[str] = None,
+                reason: Optional[str] = None) -> Timer:
+        timer = Timer(self, deadline, callback, args, name or getattr(callback, '__qualname__', 'timer'), reason)
+        with self.lock:
+            first = not self.heap or deadline < self.heap[0][0]
+            heapq.heappush(self.heap, (deadline, next(self.counter), timer))
+        if first:
+            for listener in self.listeners:
+                listener(timer)
+        return timer
+
+    def call_later(self, delay: float, callback: Callable, *args, name: Optional[str] = None,
+                   reason: Optional[str] = None) -> Timer:
+        return self.call_at(self.clock() + delay, callback, *args, name=name, reason=reason)
+
+    def cancel(self, timer: Timer) -> None:
+        with self.lock:
+            if not timer.active():
+                return
+            timer.cancelled = True
+            self.cancelled_count += 1
+            if self.cancelled_count > 32 and self.cancelled_count > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if entry[2].active()]
+                heapq.heapify(self.heap)
+                self.cancelled_count = 0
+
+    def pop_due(self, now: float) -> List[Timer]:
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                timer = heapq.heappop(self.heap)[2]
+                if timer.cancelled:
+                    self.cancelled_count -= 1
+                    continue
+                timer.fired = True
+                due.append(timer)
+        return due
+
+    def run_due(self) -> Set[str]:
+        # returns the wake reasons of the timers that fired, bookkeeping timers like the history sample have none
+        due = self.pop_due(self.clock())
+        reasons = set()
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.error(f"Timer {timer.name} failed: {e}")
+            if timer.reason:
+                reasons.add(timer.reason)
+        return reasons
+
+    def next_deadline(self) -> Optional[float]:
+        with self.lock:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+                self.cancelled_count -= 1
+            return self.heap[0][0] if self.heap else None
+
+    def pending(self) -> List[dict]:
+        with self.lock:
+            timers = sorted((entry for entry in self.heap if entry[2].active()), key=lambda entry: entry[:2])
+        return [entry[2].to_dict() for entry in timers]
@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional
+
+from tub_history import HISTORY_PATH
+
+# watts drawn in each state, nameplate numbers for the energy estimate, adjust them to match your equipment
+DEVICE_POWER = {
+    'heater': {'on': 5500},
+    'circpump': {'on': 90},
+    'pump1': {'low': 450, 'high': 1800},
+    'pump2': {'low': 450, 'high': 1800},
+    'blower': {'on': 1000},
+    'fans': {'on': 25},
+    'light': {'on': 12},
+    'ozone': {'on': 20},
+}
+USAGE_PERIODS = {'hour': '%Y-%m-%dT%H', 'day': '%Y-%m-%d', 'month': '%Y-%m'}
+# how far back a usage report goes when it isn't given a start, in seconds
+USAGE_DEFAULT_SPAN = {'hour': 24 * 60 * 60, 'day': 30 * 24 * 60 * 60, 'month': 365 * 24 * 60 * 60}
+
+USAGE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS usage (period TEXT NOT NULL, bucket TEXT NOT NULL, device TEXT NOT NULL, "
+    "state TEXT NOT NULL, seconds REAL NOT NULL, starts INTEGER NOT NULL, kwh REAL NOT NULL, "
+    "PRIMARY KEY (period, bucket, device, state)) WITHOUT ROWID"
+)
+
+
+def state_name(state) -> str:
+    if isinstance(state, bool):
+        return 'on' if state else 'off'
+    return str(state)
+
+
+class UsageAccounting:
+    # running totals per hour, day and month, updated on every state transition. only the deltas since the
+    # last flush are kept in memory, the history writer adds them to the totals on disk
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.current = {}  # device -> (state, since)
+        self.pending = {}  # (period, bucket, device, state) -> [seconds, starts, kwh]
+        self.schema_ready = False
+
+    def transition(self, device: str, state, now: Optional[float] = None) -> None:
+        now = self.clock() if now is None else now
+        state = state_name(state)
+        with self.lock:
+            previous = self.current.get(device)
+            if previous is not None and previous[0] == state:
+                return
+            if previous is not None:
+                self.accrue(device, previous[0], previous[1], now)
+                # a start is a device going into a running state, switching it off isn't one
+                self.add(now, device, state, starts=0 if state == 'off' else 1)
+            self.current[device] = (state, now)
+
+    def accrue(self, device: str, state: str, since: float, until: float) -> None:
+        # split at local hour boundaries so every bucket gets exactly its share of the interval, the buckets are
+        # local time and a zone can sit a half or quarter hour off UTC
+        start = since
+        while start < until:
+            local = time.localtime(start)
+            edge = min(until, start - start % 60 - local.tm_min * 60 + 3600)
+            self.add(start, device, state, seconds=edge - start)
+            start = edge
+
+    def add(self, timestamp: float, device: str, state: str, seconds: float = 0.0, starts: int = 0) -> None:
+        local = time.localtime(timestamp)
+        kwh = seconds * DEVICE_POWER.get(device, {}).get(state, 0) / 3.6e6
+        for period, bucket_format in USAGE_PERIODS.items():
+            key = (period, time.strftime(bucket_format, local), device, state)
+            total = self.pending.get(key)
+            if total is None:
+                self.pending[key] = [seconds, starts, kwh]
+            else:
+                total[0] += seconds
+                total[1] += starts
+                total[2] += kwh
+
+    def checkpoint(self, now: float) -> dict:
+        # bring the open intervals up to now and hand over everything accumulated since the last checkpoint
+        with self.lock:
+            for device, (state, since) in self.current.items():
+                self.accrue(device, state, since, now)
+                self.current[device] = (state, now)
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def flush(self, db: sqlite3.Connection) -> None:
+        # runs inside the history writer's transaction, so usage costs no extra fsync
+        if not self.schema_ready:
+            db.execute(USAGE_SCHEMA)
+            self.schema_ready = True
+        pending = self.checkpoint(self.clock())
+        db.executemany(
+            "INSERT INTO usage (period, bucket, device, state, seconds, starts, kwh) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (period, bucket, device, state) DO UPDATE SET seconds = seconds + excluded.seconds, "
+            "starts = starts + excluded.starts, kwh = kwh + excluded.kwh",
+            [key + tuple(total) for key, total in pending.items()])
+
+
+class UsageReader:
+    def __init__(self, path: str = HISTORY_PATH, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = None
+
+    def open(self) -> bool:
+        if self.db is None and os.path.exists(self.path):
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+        return self.db is not None
+
+    def report(self, period: str = 'day', start: Optional[str] = None, end: Optional[str] = None,
+               devices: Optional[List[str]] = None) -> dict:
+        # start and end are bucket labels in the period's format, e.g. 2024-01-31 for days, both inclusive
+        if start is None:
+            start = time.strftime(USAGE_PERIODS[period], time.localtime(self.clock() - USAGE_DEFAULT_SPAN[period]))
+        rows = []
+        if self.open():
+            sql = "SELECT bucket, device, state, seconds, starts, kwh FROM usage WHERE period = ? AND bucket >= ?"
+            params = [period, start]
+            if end is not None:
+                sql += " AND bucket <= ?"
+                params.append(end)
+            with self.lock:
+                try:
+                    rows = self.db.execute(sql + " ORDER BY bucket", params).fetchall()
+                except sqlite3.OperationalError:
+                    rows = []  # nothing flushed yet, the table doesn't exist
+        buckets = {}
+        totals = {}
+        for bucket, device, state, seconds, starts, kwh in rows:
+            if devices is not None and device not in devices:
+                continue
+            for entry in [buckets.setdefault(bucket, {}).setdefault(device, {}), totals.setdefault(device, {})]:
+                by_state = entry.setdefault('seconds', {})
+                by_state[state] = round(by_state.get(state, 0) + seconds, 1)
+                entry['starts'] = entry.get('starts', 0) + starts
+                entry['kwh'] = round(entry.get('kwh', 0) + kwh, 4)
+        for entry in [device for bucket in buckets.values() for device in bucket.values()] + list(totals.values()):
+            recorded = sum(entry['seconds'].values())
+            running = recorded - entry['seconds'].get('off', 0)
+            entry['duty_cycle'] = round(running / recorded, 4) if recorded else 0
+        return {'period': period, 'start': start, 'end': end, 'buckets': buckets, 'totals': totals}